@@ -0,0 +1,529 @@
+"""
+Отчёты о продажах по сводкам (rollup) в отдельной базе.
+
+Сводки хранятся в своём файле SQLite (ANALYTICS_DATABASE), поэтому отчёты
+не читают основную базу магазина:
+- sales_by_product — выручка, штуки и число заказов по товару и статусу;
+- sales_by_category — то же по категории (category_id = 0 — все категории,
+  число заказов в ней — различные заказы);
+каждая — в разрезах hour, day и month (bucket — 'YYYY-MM-DD HH',
+'YYYY-MM-DD', 'YYYY-MM') и со строками status = '*' по всем статусам.
+
+Сводки обновляются инкрементально по журналу order_changes основной базы
+(его пишут триггеры на orders и order_items): refresh() читает записи
+после водяного знака, для каждого затронутого заказа вычитает его прежний
+вклад (снимок в counted_orders) и прибавляет текущий. Поэтому смена
+статуса (например, оплата) или правка позиций переносит заказ
+между строками сводок, а повторная обработка ничего не меняет.
+Первое обновление (и отставание дальше хранимого журнала) строит
+сводки по всем заказам.
+
+Отчёт за произвольный период собирается из месячных строк для целых
+месяцев и дневных — для неполных, так что год — это 12 месяцев, а не
+365 дней или сотни тысяч заказов.
+"""
+
+import calendar
+import csv
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+GRAINS = ('hour', 'day', 'month')
+
+# category_id строки «все категории» в sales_by_category
+ALL_CATEGORIES = 0
+# category_id позиций, товара которых уже нет в каталоге
+NO_CATEGORY = -1
+# status строк по всем статусам: отчёт без фильтра по статусу
+# читает одну строку вместо строки на каждый статус
+ALL_STATUSES = '*'
+
+MEASURES = "ROUND(SUM(revenue), 2) AS revenue, SUM(units) AS units, SUM(orders) AS orders"
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)",
+    """
+    CREATE TABLE IF NOT EXISTS sales_by_product (
+        grain TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        revenue REAL NOT NULL,
+        units INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        PRIMARY KEY (grain, status, bucket, product_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_by_category (
+        grain TEXT NOT NULL,
+        bucket TEXT NOT NULL,
+        category_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        revenue REAL NOT NULL,
+        units INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        PRIMARY KEY (grain, status, bucket, category_id)
+    ) WITHOUT ROWID
+    """,
+    # Учтённый вклад каждого заказа: статус, час и позиции
+    # [[product_id, category_id, выручка, штуки], ...]
+    """
+    CREATE TABLE IF NOT EXISTS counted_orders (
+        order_id INTEGER PRIMARY KEY,
+        status TEXT NOT NULL,
+        hour TEXT NOT NULL,
+        lines TEXT NOT NULL
+    )
+    """,
+    # Названия для отчётов (копии из основной базы)
+    "CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, name TEXT, category_id INTEGER)",
+    "CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT)",
+]
+
+ROLLUP_TABLES = (('sales_by_product', 'product_id'), ('sales_by_category', 'category_id'))
+
+
+def connect(path):
+    """
+    Соединение с базой сводок (создаёт схему при необходимости).
+    """
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    ensure_schema(conn)
+    return conn
+
+
+def ensure_schema(conn):
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                 (key, value))
+
+
+# === Обновление сводок ===
+
+def load_orders(source, order_ids):
+    """
+    Текущий вклад заказов из основной базы: {order_id: (status, hour, lines)
+    или None для удалённого заказа} и {product_id: (name, category_id)}.
+    """
+    current, products = {}, {}
+    order_ids = list(order_ids)
+    for start in range(0, len(order_ids), 500):
+        batch = order_ids[start:start + 500]
+        placeholders = ','.join(['?'] * len(batch))
+        lines = {}
+        for order_id, product_id, name, category_id, revenue, units in source.execute(f"""
+            SELECT oi.order_id, oi.product_id, p.name, COALESCE(p.category_id, {NO_CATEGORY}),
+                   oi.quantity * oi.price, oi.quantity
+            FROM order_items oi LEFT JOIN products p ON p.id = oi.product_id
+            WHERE oi.order_id IN ({placeholders})
+        """, batch):
+            lines.setdefault(order_id, []).append([product_id, category_id, round(revenue, 2), units])
+            products[product_id] = (name, category_id)
+        found = {}
+        for order_id, status, order_date in source.execute(
+                f"SELECT id, status, order_date FROM orders WHERE id IN ({placeholders})", batch):
+            if order_date:
+                found[order_id] = (status, str(order_date)[:13], lines.get(order_id, []))
+        for order_id in batch:
+            current[order_id] = found.get(order_id)
+    return current, products
+
+
+def add_contribution(deltas, contribution, sign):
+    """
+    Добавляет в deltas ({(таблица, grain, bucket, измерение, статус): [выручка, штуки, заказы]})
+    вклад заказа со знаком sign.
+    """
+    status, hour, lines = contribution
+    categories = {}
+    for _, category_id, revenue, units in lines:
+        totals = categories.setdefault(category_id, [0.0, 0])
+        totals[0] += revenue
+        totals[1] += units
+    categories[ALL_CATEGORIES] = [sum(line[2] for line in lines), sum(line[3] for line in lines)]
+
+    # Смена статуса заказа взаимно гасится в строках ALL_STATUSES
+    # и не пишет в них ничего
+    for grain, bucket in (('hour', hour), ('day', hour[:10]), ('month', hour[:7])):
+        for row_status in (status, ALL_STATUSES):
+            for product_id, _, revenue, units in lines:
+                delta = deltas.setdefault(('sales_by_product', grain, bucket, product_id, row_status), [0.0, 0, 0])
+                delta[0] += sign * revenue
+                delta[1] += sign * units
+                delta[2] += sign
+            for category_id, (revenue, units) in categories.items():
+                delta = deltas.setdefault(('sales_by_category', grain, bucket, category_id, row_status), [0.0, 0, 0])
+                delta[0] += sign * revenue
+                delta[1] += sign * units
+                delta[2] += sign
+
+
+def apply_orders(target, current, products=None):
+    """
+    Заменяет учтённый вклад заказов current ({order_id: вклад или None})
+    текущим. Вызывается внутри транзакции target.
+    """
+    order_ids = list(current)
+    previous = {}
+    for start in range(0, len(order_ids), 500):
+        batch = order_ids[start:start + 500]
+        for order_id, status, hour, lines in target.execute(
+                f"SELECT order_id, status, hour, lines FROM counted_orders "
+                f"WHERE order_id IN ({','.join(['?'] * len(batch))})", batch):
+            previous[order_id] = (status, hour, json.loads(lines))
+
+    deltas = {}
+    for order_id, contribution in current.items():
+        if order_id in previous:
+            add_contribution(deltas, previous[order_id], -1)
+        if contribution is not None:
+            add_contribution(deltas, contribution, 1)
+
+    for table, dimension in ROLLUP_TABLES:
+        rows = [(grain, bucket, key, status, round(revenue, 2), units, orders)
+                for (name, grain, bucket, key, status), (revenue, units, orders) in deltas.items()
+                if name == table and (orders or units or abs(revenue) >= 0.005)]
+        target.executemany(f"""
+            INSERT INTO {table} (grain, bucket, {dimension}, status, revenue, units, orders)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (grain, status, bucket, {dimension}) DO UPDATE
+            SET revenue = ROUND(revenue + excluded.revenue, 2),
+                units = units + excluded.units,
+                orders = orders + excluded.orders
+        """, rows)
+        # Строки, из которых ушли все заказы, удаляются
+        target.executemany(f"""
+            DELETE FROM {table} WHERE grain = ? AND bucket = ? AND {dimension} = ? AND status = ? AND orders <= 0
+        """, [row[:4] for row in rows if row[6] < 0])
+
+    target.executemany("DELETE FROM counted_orders WHERE order_id = ?",
+                       [(order_id,) for order_id, contribution in current.items() if contribution is None])
+    target.executemany("INSERT OR REPLACE INTO counted_orders (order_id, status, hour, lines) VALUES (?, ?, ?, ?)",
+                       [(order_id, contribution[0], contribution[1], json.dumps(contribution[2]))
+                        for order_id, contribution in current.items() if contribution is not None])
+    if products:
+        target.executemany("INSERT OR REPLACE INTO products (id, name, category_id) VALUES (?, ?, ?)",
+                           [(product_id, name, category_id) for product_id, (name, category_id) in products.items()
+                            if name is not None])
+
+
+def sync_categories(source, target):
+    target.executemany("INSERT OR REPLACE INTO categories (id, name) VALUES (?, ?)",
+                       [tuple(row) for row in source.execute("SELECT id, name FROM categories")])
+
+
+def rebuild(source, target, batch_size=2000):
+    """
+    Строит сводки заново по всем заказам одной транзакцией: отчёты
+    до её фиксации видят прежние сводки. Возвращает число заказов.
+    """
+    started = time.perf_counter()
+    target.execute("BEGIN IMMEDIATE")
+    try:
+        # Водяной знак — до чтения заказов: изменения во время
+        # перестроения будут применены следующим обновлением
+        watermark = source.execute("SELECT COALESCE(MAX(seq), 0) FROM order_changes").fetchone()[0]
+        for table in ('sales_by_product', 'sales_by_category', 'counted_orders', 'products', 'categories'):
+            target.execute(f"DELETE FROM {table}")
+        sync_categories(source, target)
+        last_id, count = 0, 0
+        while True:
+            order_ids = [row[0] for row in source.execute(
+                "SELECT id FROM orders WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size))]
+            if not order_ids:
+                break
+            apply_orders(target, *load_orders(source, order_ids))
+            last_id = order_ids[-1]
+            count += len(order_ids)
+        set_meta(target, 'watermark', watermark)
+        set_meta(target, 'refreshed_at', time.time())
+        target.commit()
+    except BaseException:
+        target.rollback()
+        raise
+    logger.info(f"Сводки отчётов построены: {count} заказов за {time.perf_counter() - started:.1f} с")
+    return count
+
+
+def refresh(source, target, batch_size=1000):
+    """
+    Применяет изменения заказов из журнала order_changes после водяного
+    знака. Без водяного знака (первый запуск) или если журнал уже
+    не содержит нужных записей — rebuild(). Возвращает число обработанных заказов.
+    """
+    processed = 0
+    while True:
+        watermark = get_meta(target, 'watermark')
+        first, last = source.execute("SELECT MIN(seq), MAX(seq) FROM order_changes").fetchone()
+        if watermark is None or (first is not None and first > watermark + 1):
+            if watermark is not None:
+                logger.warning("Журнал изменений заказов ушёл дальше сводок, перестроение")
+            return processed + rebuild(source, target)
+        if last is None or last <= watermark:
+            break
+
+        rows = source.execute("SELECT seq, order_id FROM order_changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                              (watermark, batch_size)).fetchall()
+        current, products = load_orders(source, sorted({order_id for _, order_id in rows}))
+        target.execute("BEGIN IMMEDIATE")
+        try:
+            # Другой процесс мог обновить сводки, пока читались заказы
+            if get_meta(target, 'watermark') != watermark:
+                target.rollback()
+                continue
+            apply_orders(target, current, products)
+            set_meta(target, 'watermark', rows[-1][0])
+            target.commit()
+        except BaseException:
+            target.rollback()
+            raise
+        processed += len(current)
+
+    with target:
+        sync_categories(source, target)
+        set_meta(target, 'refreshed_at', time.time())
+    return processed
+
+
+class AnalyticsRefresher:
+    """
+    Фоновый поток, обновляющий сводки раз в interval секунд.
+    source_pool — пул соединений основной базы, path — база сводок.
+    """
+
+    def __init__(self, source_pool, path, interval=30.0):
+        self.source_pool = source_pool
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _loop(self):
+        target = connect(self.path)
+        try:
+            while not self._stop.is_set():
+                source = self.source_pool.acquire()
+                try:
+                    started = time.perf_counter()
+                    processed = refresh(source, target)
+                    if processed:
+                        logger.info(f"Сводки отчётов: {processed} заказов за "
+                                    f"{(time.perf_counter() - started) * 1000:.0f} мс")
+                except Exception as e:
+                    logger.error(f"Ошибка обновления сводок: {e}")
+                finally:
+                    self.source_pool.release(source)
+                self._stop.wait(self.interval)
+        finally:
+            target.close()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='analytics-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+
+# === Отчёты ===
+
+def spans(start, end):
+    """
+    Разбивает период [start, end] (date) на отрезки сводок:
+    [(grain, первый bucket, последний bucket)] — целые месяцы
+    месячными строками, остальные дни — дневными.
+    """
+    result = []
+    day = start
+    while day <= end:
+        month_end = day.replace(day=calendar.monthrange(day.year, day.month)[1])
+        if day.day == 1 and month_end <= end:
+            grain, bucket, day = 'month', day.strftime('%Y-%m'), month_end + timedelta(days=1)
+        else:
+            grain, bucket, day = 'day', day.isoformat(), day + timedelta(days=1)
+        if result and result[-1][0] == grain:
+            result[-1][2] = bucket
+        else:
+            result.append([grain, bucket, bucket])
+    return [tuple(span) for span in result]
+
+
+def status_filter(statuses):
+    """
+    Условие на статус: перечисленные статусы или строки ALL_STATUSES.
+    """
+    if statuses:
+        return f"status IN ({','.join(['?'] * len(statuses))})", list(statuses)
+    return "status = ?", [ALL_STATUSES]
+
+
+def period_rows(table, columns, start, end, condition, params):
+    """
+    Подзапрос (с параметрами), выбирающий columns строк сводки table
+    за период [start, end] с дополнительным условием condition. Каждый
+    отрезок spans() — отдельная часть UNION ALL, которая читается одним
+    диапазоном первичного ключа.
+    """
+    parts, values = [], []
+    for grain, first, last in spans(start, end):
+        parts.append(f"SELECT {columns} FROM {table} WHERE grain = ? AND bucket BETWEEN ? AND ? AND {condition}")
+        values += [grain, first, last, *params]
+    if not parts:
+        return f"SELECT {columns} FROM {table} WHERE 0", []
+    return ' UNION ALL '.join(parts), values
+
+
+def totals(conn, start, end, statuses=None):
+    status_sql, status_params = status_filter(statuses)
+    rows, params = period_rows('sales_by_category', 'revenue, units, orders', start, end,
+                               f"category_id = ? AND {status_sql}", [ALL_CATEGORIES, *status_params])
+    row = conn.execute(f"SELECT {MEASURES} FROM ({rows})", params).fetchone()
+    return {'revenue': row['revenue'] or 0.0, 'units': row['units'] or 0, 'orders': row['orders'] or 0}
+
+
+def series(conn, grain, start, end, statuses=None):
+    """
+    Выручка, штуки и заказы по часам, дням или месяцам периода.
+    """
+    low, high = {
+        'hour': (f"{start.isoformat()} 00", f"{end.isoformat()} 23"),
+        'day': (start.isoformat(), end.isoformat()),
+        'month': (start.strftime('%Y-%m'), end.strftime('%Y-%m')),
+    }[grain]
+    status_sql, status_params = status_filter(statuses)
+    return [dict(row) for row in conn.execute(f"""
+        SELECT bucket, {MEASURES} FROM sales_by_category
+        WHERE grain = ? AND bucket BETWEEN ? AND ? AND category_id = ? AND {status_sql}
+        GROUP BY bucket ORDER BY bucket
+    """, [grain, low, high, ALL_CATEGORIES, *status_params])]
+
+
+def top_products(conn, start, end, statuses=None, limit=20, order_by='revenue'):
+    """
+    Самые продаваемые товары периода (по выручке или штукам).
+    Названия подставляются только для отобранных limit товаров.
+    """
+    order_by = 'units' if order_by == 'units' else 'revenue'
+    status_sql, status_params = status_filter(statuses)
+    rows, params = period_rows('sales_by_product', 'product_id, revenue, units, orders', start, end,
+                               status_sql, status_params)
+    return [dict(row) for row in conn.execute(f"""
+        SELECT t.product_id, COALESCE(p.name, '#' || t.product_id) AS name, t.revenue, t.units, t.orders
+        FROM (SELECT product_id, {MEASURES} FROM ({rows})
+              GROUP BY product_id ORDER BY {order_by} DESC LIMIT ?) t
+        LEFT JOIN products p ON p.id = t.product_id
+        ORDER BY t.{order_by} DESC
+    """, [*params, limit])]
+
+
+def by_category(conn, start, end, statuses=None):
+    status_sql, status_params = status_filter(statuses)
+    rows, params = period_rows('sales_by_category', 'category_id, revenue, units, orders', start, end,
+                               f"category_id != ? AND {status_sql}", [ALL_CATEGORIES, *status_params])
+    return [dict(row) for row in conn.execute(f"""
+        SELECT t.category_id, COALESCE(c.name, 'Без категории') AS name, t.revenue, t.units, t.orders
+        FROM (SELECT category_id, {MEASURES} FROM ({rows}) GROUP BY category_id) t
+        LEFT JOIN categories c ON c.id = t.category_id
+        ORDER BY t.revenue DESC
+    """, params)]
+
+
+def by_status(conn, start, end):
+    rows, params = period_rows('sales_by_category', 'status, revenue, units, orders', start, end,
+                               "category_id = ? AND status != ?", [ALL_CATEGORIES, ALL_STATUSES])
+    return [dict(row) for row in conn.execute(
+        f"SELECT status, {MEASURES} FROM ({rows}) GROUP BY status ORDER BY revenue DESC", params)]
+
+
+# === Выгрузка ===
+
+EXPORT_COLUMNS = ['order_id', 'hour', 'product_id', 'category_id', 'status', 'revenue', 'units']
+
+
+def export_lines(conn):
+    """
+    Позиции учтённых заказов из базы сводок (основная база не читается):
+    кортежи в порядке EXPORT_COLUMNS.
+    """
+    for order_id, status, hour, lines in conn.execute(
+            "SELECT order_id, status, hour, lines FROM counted_orders ORDER BY order_id"):
+        for product_id, category_id, revenue, units in json.loads(lines):
+            yield order_id, hour, product_id, category_id, status, revenue, units
+
+
+def export_csv(conn, stream):
+    writer = csv.writer(stream)
+    writer.writerow(EXPORT_COLUMNS)
+    count = 0
+    for row in export_lines(conn):
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+def export_npz(conn, path):
+    """
+    Колоночная выгрузка для numpy: по массиву на столбец, час — datetime64[h],
+    статус — коды с расшифровкой в status_labels. Возвращает число строк.
+    """
+    if numpy is None:
+        raise RuntimeError("Для выгрузки npz нужен numpy")
+    columns = {name: [] for name in EXPORT_COLUMNS}
+    for row in export_lines(conn):
+        for name, value in zip(EXPORT_COLUMNS, row):
+            columns[name].append(value)
+    labels = sorted(set(columns['status']))
+    codes = {label: code for code, label in enumerate(labels)}
+    numpy.savez_compressed(
+        path,
+        order_id=numpy.array(columns['order_id'], dtype=numpy.int64),
+        hour=numpy.array([hour.replace(' ', 'T') for hour in columns['hour']], dtype='datetime64[h]'),
+        product_id=numpy.array(columns['product_id'], dtype=numpy.int64),
+        category_id=numpy.array(columns['category_id'], dtype=numpy.int64),
+        status=numpy.array([codes[status] for status in columns['status']], dtype=numpy.int16),
+        status_labels=numpy.array(labels),
+        revenue=numpy.array(columns['revenue'], dtype=numpy.float64),
+        units=numpy.array(columns['units'], dtype=numpy.int64),
+    )
+    return len(columns['order_id'])
+
+
+def parse_period(start, end, default_days=30, today=None):
+    """
+    Период отчёта из строк 'YYYY-MM-DD'; по умолчанию — последние default_days дней.
+    Выбрасывает ValueError при некорректной дате.
+    """
+    today = today or date.today()
+    end = date.fromisoformat(end) if end else today
+    start = date.fromisoformat(start) if start else end - timedelta(days=default_days - 1)
+    if start > end:
+        start, end = end, start
+    return start, end
@@ -1,12 +1,34 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, session, flash, g, jsonify, Response, abort, send_file
+from markupsafe import Markup
 import sqlite3
 import os
 import logging
 import re
-from werkzeug.security import generate_password_hash, check_password_hash
+import json
+import base64
+import secrets
+import click
+import functools
+import time
+import threading
+import contextlib
 from datetime import datetime
+from db import ConnectionPool, ReplicaSet, refresh_snapshot
+from cache import LRUCache
+from cart_store import MemoryCartStore, SQLiteCartStore
+from profiling import QueryProfiler, prometheus_metrics
+from passwords import HasherBusy, PasswordHasher
+from ratelimit import RateLimiter
+from fragments import FragmentCache
+from reservations import ExpirySweeper, Reservations, held_by_others
+from images import FORMATS, ImageError, ImagePipeline, save_upload
+from facets import AGE_BANDS, BATTERIES, FACETS, PRICE_BUCKETS, FacetIndex, bitmap_of, facet_sql
+from recommendations import RecommendationRefresher, Recommender, related_products
+import analytics
+import jobs
+import payments
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
@@ -14,21 +36,160 @@ app.secret_key = os.environ.get('SECRET_KEY', '2113')
 
 # Абсолютный путь к базе данных
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DATABASE = os.path.join(BASE_DIR, 'toy_store.db')
+DATABASE = os.environ.get('DATABASE', os.path.join(BASE_DIR, 'toy_store.db'))
 logger.info(f"Используется база данных: {DATABASE}")
 
+# Профилирование SQL (SQL_PROFILING=1): время, строки, N+1 и медленные
+# запросы с планом. Выключено — пул открывает обычные соединения.
+query_profiler = None
+if os.environ.get('SQL_PROFILING', '0') == '1':
+    query_profiler = QueryProfiler(
+        slow_ms=float(os.environ.get('SQL_SLOW_MS', 100)),
+        n_plus_one=int(os.environ.get('SQL_N_PLUS_ONE', 5)),
+    )
+
+# Пул соединений: каждый поток-обработчик переиспользует свои соединения
+db_pool = ConnectionPool(
+    DATABASE,
+    max_idle=int(os.environ.get('DB_POOL_SIZE', 4)),
+    factory=query_profiler.connection_factory() if query_profiler else sqlite3.Connection,
+)
+
+# Реплики для чтения каталога и истории заказов (через запятую).
+# Это снимки основной базы (flask replica refresh) или сама основная
+# база — тогда чтение идёт отдельным пулом соединений только на чтение.
+REPLICA_DATABASES = [path.strip() for path in os.environ.get('REPLICA_DATABASES', '').split(',') if path.strip()]
+for path in [path for path in REPLICA_DATABASES if not os.path.exists(path)]:
+    logger.warning(f"Реплика {path} не найдена, чтение пойдёт в основную базу")
+    REPLICA_DATABASES.remove(path)
+replicas = ReplicaSet(
+    REPLICA_DATABASES,
+    max_idle=int(os.environ.get('DB_POOL_SIZE', 4)),
+    factory=query_profiler.connection_factory() if query_profiler else sqlite3.Connection,
+)
+
+# Сколько секунд после своей записи пользователь читает из основной базы
+# на маршрутах с read_your_writes (не меньше интервала обновления снимков)
+app.config.setdefault('REPLICA_MAX_LAG', float(os.environ.get('REPLICA_MAX_LAG', 60)))
+
 def get_db():
     """
-    Устанавливает соединение с базой данных и возвращает его.
+    Возвращает соединение с базой данных для текущего запроса.
+    Соединение берётся из пула один раз на контекст приложения
+    и возвращается в пул в close_db() при любом исходе запроса.
     Использует Row factory для доступа к колонкам по именам.
     """
-    try:
-        conn = sqlite3.connect(DATABASE)
-        conn.row_factory = sqlite3.Row
-        return conn
-    except sqlite3.Error as e:
-        print(f"Ошибка подключения к базе данных: {e}")
-        return None
+    if 'db' not in g:
+        try:
+            g.db = db_pool.acquire()
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка подключения к базе данных: {e}")
+            return None
+    return g.db
+
+
+def replica_route(read_your_writes=False):
+    """
+    Декоратор маршрута только для чтения: get_read_db() в нём берёт
+    соединение к реплике. С read_your_writes=True пользователь, недавно
+    что-то записавший (remember_write()), читает из основной базы,
+    пока реплика могла не успеть получить его изменения.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            last_write = session.get('last_write_at')
+            g.use_replica = bool(replicas) and not (
+                read_your_writes and last_write and time.time() - last_write < app.config['REPLICA_MAX_LAG'])
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_read_db():
+    """
+    Соединение для чтения: к реплике на маршрутах replica_route,
+    иначе то же, что get_db(). Ошибка подключения к реплике
+    не ломает страницу — чтение переходит в основную базу.
+    """
+    if not g.get('use_replica'):
+        return get_db()
+    if 'read_db' not in g:
+        pool = replicas.pick()
+        try:
+            g.read_db = (pool, pool.acquire())
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка подключения к реплике {pool.database}: {e}")
+            g.use_replica = False
+            return get_db()
+    return g.read_db[1]
+
+
+def remember_write():
+    """
+    Отмечает в сессии время записи пользователя для read_your_writes.
+    """
+    session['last_write_at'] = time.time()
+
+
+if query_profiler:
+    @app.before_request
+    def start_query_profile():
+        query_profiler.start_request()
+
+    @app.teardown_request
+    def finish_query_profile(exception=None):
+        query_profiler.finish_request(request.endpoint)
+
+
+def release_db():
+    """
+    Досрочно возвращает соединение запроса в пул (например, перед
+    долгим ожиданием внешнего сервиса). Следующий get_db() возьмёт новое.
+    """
+    conn = g.pop('db', None)
+    if conn is not None:
+        db_pool.release(conn)
+
+
+@app.teardown_appcontext
+def close_db(exception=None):
+    """
+    Возвращает соединения текущего запроса в пул.
+    """
+    release_db()
+    read_db = g.pop('read_db', None)
+    if read_db is not None:
+        pool, conn = read_db
+        pool.release(conn)
+
+
+# Хранилище корзин: 'sqlite' (таблица cart_items) или 'memory' (для тестов)
+app.config.setdefault('CART_STORE', os.environ.get('CART_STORE', 'sqlite'))
+cart_store = MemoryCartStore() if app.config['CART_STORE'] == 'memory' else SQLiteCartStore(get_db)
+
+# Резервы товаров в корзинах: RESERVATION_TTL — срок резерва (с),
+# RESERVATION_RECHECK — сколько помнить исчерпанный остаток в памяти
+reservations = Reservations(
+    ttl=float(os.environ.get('RESERVATION_TTL', 900)),
+    recheck=float(os.environ.get('RESERVATION_RECHECK', 1.0)),
+)
+
+
+def cart_owner(create=False):
+    """
+    Возвращает ключ корзины текущего посетителя: "user:<id>" после входа
+    или "anon:<token>" для гостя. Токен гостя записывается в сессию
+    один раз (при create=True), дальше cookie при работе с корзиной не меняется.
+    """
+    if session.get('loggedin'):
+        return f"user:{session['user_id']}"
+    token = session.get('cart_token')
+    if not token:
+        if not create:
+            return None
+        token = session['cart_token'] = secrets.token_urlsafe(16)
+    return f"anon:{token}"
 
 def init_db():
     """
@@ -39,7 +200,7 @@ def init_db():
         logger.info("База данных не найдена, запуск инициализации")
         try:
             from init_db import init_db as init_db_script
-            init_db_script()
+            init_db_script(DATABASE)
             logger.info("База данных успешно инициализирована")
         except ImportError:
             logger.error("Ошибка: Модуль init_db не найден")
@@ -47,70 +208,546 @@ def init_db():
             logger.error(f"Ошибка инициализации БД: {str(e)}")
     else:
         logger.info("База данных уже существует")
-    if not os.path.exists(DATABASE):
-        from init_db import init_db
-        init_db()
-        print("База данных инициализирована")
+        from migrations import check_plans, migrate
+        conn = sqlite3.connect(DATABASE, timeout=30)
+        try:
+            migrate(conn)
+            for description, plan in check_plans(conn):
+                logger.warning(f"Запрос «{description}» не использует ожидаемый индекс: {plan}")
+        finally:
+            conn.close()
+    analytics.connect(ANALYTICS_DATABASE).close()
 
 
-@app.route('/')
-def index():
+# Хэширование паролей в отдельных процессах: вход и регистрация
+# не занимают GIL потоков, обслуживающих каталог
+password_hasher = PasswordHasher(
+    method=os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000'),
+    workers=int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+    max_in_flight=int(os.environ.get('PASSWORD_HASH_MAX_IN_FLIGHT', 8)),
+)
+
+# Ограничение частоты попыток входа и регистрации (AUTH_RATE_LIMIT=0 — выключить):
+# с одного IP и на один email
+app.config.setdefault('AUTH_RATE_LIMIT', os.environ.get('AUTH_RATE_LIMIT', '1') == '1')
+ip_limiter = RateLimiter(
+    capacity=int(os.environ.get('AUTH_IP_BURST', 20)),
+    rate=float(os.environ.get('AUTH_IP_PER_MINUTE', 20)) / 60,
+)
+email_limiter = RateLimiter(
+    capacity=int(os.environ.get('AUTH_EMAIL_BURST', 5)),
+    rate=float(os.environ.get('AUTH_EMAIL_PER_MINUTE', 5)) / 60,
+)
+
+
+def auth_retry_after(email):
     """
-    Главная страница. Отображает каталог товаров с возможностью фильтрации
-    по категории, возрасту и поисковому запросу.
+    Проверяет лимиты попыток для IP посетителя и email.
+    Возвращает 0, если попытка разрешена, иначе через сколько секунд повторить.
     """
-    conn = get_db()
-    cursor = conn.cursor()
+    if not app.config['AUTH_RATE_LIMIT']:
+        return 0
+    ip_key = request.remote_addr or 'unknown'
+    email_key = email.strip().lower()
+    if not ip_limiter.allow(ip_key):
+        return ip_limiter.retry_after(ip_key)
+    if not email_limiter.allow(email_key):
+        return email_limiter.retry_after(email_key)
+    return 0
+
+
+def auth_rejected(template, message, status, retry_after):
+    """
+    Ответ на отклонённую попытку входа/регистрации: та же форма
+    с сообщением, код 429/503 и заголовок Retry-After.
+    """
+    flash(message, 'danger')
+    response = app.make_response((render_template(template), status))
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
+
+# Кэш каталога в памяти процесса: список категорий, карточки товаров
+# и результаты выборок каталога. TTL ограничивает устаревание данных,
+# если каталог меняет другой процесс; изменения в этом процессе
+# сбрасывают кэш сразу через invalidate_products()/invalidate_catalog().
+catalog_cache = LRUCache(
+    max_size=int(os.environ.get('CATALOG_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('CATALOG_CACHE_TTL', 60)),
+)
+
+
+# Версия каталога (таблица catalog_version) кэшируется на CATALOG_VERSION_TTL
+# секунд: ответ 304 на повторный запрос не обращается ни к SQLite, ни к шаблонам.
+# Изменения в других процессах становятся видны не позже чем через TTL.
+version_cache = LRUCache(max_size=1, ttl=float(os.environ.get('CATALOG_VERSION_TTL', 1)))
+
+# Соль ETag меняется при каждом запуске: после обновления шаблонов
+# закэшированные клиентами страницы не будут считаться актуальными
+ETAG_SALT = os.environ.get('ETAG_SALT') or secrets.token_hex(4)
+
+app.config.setdefault('CATALOG_HTTP_MAX_AGE', int(os.environ.get('CATALOG_HTTP_MAX_AGE', 0)))
+
+
+def catalog_version():
+    """
+    Возвращает (версия, время изменения, счётчик изменений резервов)
+    каталога или None, если таблица версии ещё не создана.
+    """
+    def read():
+        try:
+            row = get_read_db().execute(
+                "SELECT version, updated_at, holds FROM catalog_version WHERE id = 1").fetchone()
+        except sqlite3.Error as e:
+            logger.warning(f"Версия каталога недоступна: {e}")
+            return None
+        if row is None:
+            return None
+        return row['version'], datetime.strptime(row['updated_at'], '%Y-%m-%d %H:%M:%S'), row['holds']
+
+    return version_cache.get_or_set(('catalog_version',), read)
+
+
+def http_cached(view=None, holds=False):
+    """
+    HTTP-кэширование страниц каталога по версии каталога.
+
+    Ответ получает сильный ETag из версии каталога (и id пользователя
+    после входа: шапка страницы зависит от сессии) и Cache-Control:
+    public для гостей — такие страницы может хранить прокси/CDN,
+    private для вошедших. If-None-Match с текущим ETag (или, для гостей,
+    If-Modified-Since не раньше изменения каталога) получает 304 без
+    вызова обработчика. Страницы с флеш-сообщениями не кэшируются.
+
+    holds=True добавляет в ETag счётчик изменений резервов — для страниц,
+    показывающих остаток за вычетом резервов корзин (он меняется без смены
+    версии каталога); такие страницы проверяются только по ETag.
+    """
+    if view is None:
+        return functools.partial(http_cached, holds=holds)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = catalog_version()
+        if version is None or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        number, updated_at, holds_changes = version
+        user_id = session.get('user_id') if session.get('loggedin') else None
+        etag = f"{ETAG_SALT}-{number}" + (f"-u{user_id}" if user_id else '')
+        if holds:
+            etag += f"-h{holds_changes}"
+
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        else:
+            not_modified = (user_id is None and not holds and request.if_modified_since is not None
+                            and request.if_modified_since.replace(tzinfo=None) >= updated_at)
+
+        if not_modified:
+            response = app.response_class(status=304)
+        else:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        if user_id:
+            response.headers['Cache-Control'] = 'private, no-cache'
+        else:
+            response.last_modified = updated_at
+            response.headers['Cache-Control'] = f"public, max-age={app.config['CATALOG_HTTP_MAX_AGE']}"
+        response.vary.add('Cookie')
+        return response
+
+    return wrapper
+
+
+# Отрендеренные фрагменты страниц: карточки товаров (ключ — id товара
+# и версия каталога) и варианты навигационной панели
+fragment_cache = FragmentCache(max_bytes=int(os.environ.get('FRAGMENT_CACHE_BYTES', 16 * 1024 * 1024)))
+
+
+@app.template_global()
+def product_card(product):
+    """
+    HTML карточки товара для списка каталога (через кэш фрагментов).
+    Без версии каталога карточка рендерится без кэширования.
+    """
+    template = app.jinja_env.get_template('_product_card.html')
+    version = catalog_version()
+    if version is None:
+        return Markup(template.render(product=product))
+    return fragment_cache.get_or_render(('card', product['id'], version[0]),
+                                        lambda: template.render(product=product))
+
+
+@app.template_global()
+def navbar():
+    """
+    HTML навигационной панели: общий вариант для гостей
+    и отдельный для каждого вошедшего пользователя.
+    """
+    if session.get('loggedin'):
+        key = ('navbar', session.get('user_id'), session.get('full_name'))
+    else:
+        key = ('navbar',)
+    return fragment_cache.get_or_render(
+        key, lambda: app.jinja_env.get_template('_navbar.html').render(session=session, admin=is_admin()))
+
+
+# Производные изображения (миниатюры, карточки, страница товара) с дисковым кэшем
+image_pipeline = ImagePipeline(
+    os.path.join(BASE_DIR, 'static', 'images'),
+    os.environ.get('IMAGE_CACHE_DIR', os.path.join(BASE_DIR, 'image_cache')),
+    quality=int(os.environ.get('IMAGE_QUALITY', 80)),
+)
+app.config.setdefault('IMAGE_MAX_AGE', int(os.environ.get('IMAGE_MAX_AGE', 365 * 86400)))
+app.config.setdefault('MAX_CONTENT_LENGTH', int(os.environ.get('MAX_UPLOAD_BYTES', 5 * 1024 * 1024)))
+UPLOAD_SUBDIR = 'uploads'
+
+
+@app.template_global()
+def image_url(filename, variant='card', ext='jpg'):
+    """
+    Адрес производного изображения с хэшем содержимого.
+    Для отсутствующего файла — адрес заглушки; для исходника уже варианта —
+    наибольший вариант, не увеличивающий его.
+    """
+    filename = image_pipeline.resolve(filename)
+    available = [name for name, _ in image_pipeline.variants(filename)]
+    if variant not in available:
+        variant = available[-1]
+    return url_for('image_asset', filename=filename, name=image_pipeline.name(filename, variant, ext))
+
+
+@app.template_global()
+def image_srcset(filename, ext='jpg'):
+    """
+    srcset из всех вариантов изображения с их шириной.
+    Пустая строка, если формат ext недоступен (без Pillow — кроме jpg).
+    """
+    if ext != 'jpg' and not image_pipeline.enabled:
+        return ''
+    filename = image_pipeline.resolve(filename)
+    return ', '.join(f"{image_url(filename, variant, ext)} {width}w"
+                     for variant, width in image_pipeline.variants(filename))
+
+
+@app.route('/img/<path:filename>/<name>')
+def image_asset(filename, name):
+    """
+    Производное изображение. Адрес содержит хэш содержимого, поэтому
+    ответ кэшируется навсегда (immutable); по устаревшему хэшу —
+    перенаправление на текущий адрес.
+    """
+    parsed = image_pipeline.parse(name)
+    if parsed is None or image_pipeline.source_path(filename) is None:
+        abort(404)
+    variant, _, ext = parsed
+    current = image_pipeline.name(filename, variant, ext)
+    if name != current:
+        return redirect(url_for('image_asset', filename=filename, name=current))
+    try:
+        path = image_pipeline.render(filename, variant, ext)
+    except OSError as e:
+        logger.error(f"Не удалось построить {filename} ({variant}, {ext}): {e}")
+        abort(404)
+    mimetype = FORMATS[ext][1] if ext in FORMATS else None
+    response = send_file(path, mimetype=mimetype, max_age=app.config['IMAGE_MAX_AGE'])
+    response.headers['Cache-Control'] = f"public, max-age={app.config['IMAGE_MAX_AGE']}, immutable"
+    return response
+
+
+@jobs.handler('image_derivatives')
+def build_image_derivatives(conn, payload):
+    """
+    Задача: заранее строит все варианты загруженного изображения.
+    """
+    image_pipeline.build(payload['filename'])
+
+
+def invalidate_products(product_ids):
+    """
+    Сбрасывает кэш после изменения товаров (остатков, цен):
+    карточки этих товаров и все закэшированные выборки каталога,
+    так как товар мог появиться в них или исчезнуть.
+    """
+    for product_id in product_ids:
+        catalog_cache.delete(('product', int(product_id)))
+    catalog_cache.delete_where(lambda key: key[0] == 'listing')
+    version_cache.clear()
+
+
+def invalidate_catalog():
+    """
+    Полностью сбрасывает кэш каталога (изменились категории или товары целиком).
+    """
+    catalog_cache.clear()
+    version_cache.clear()
+
+
+def get_categories():
+    """
+    Возвращает список категорий (через кэш каталога).
+    """
+    return catalog_cache.get_or_set(
+        ('categories',),
+        lambda: get_read_db().execute("SELECT * FROM categories").fetchall())
+
+
+# Сортировки каталога: выражение ключа и направление.
+# Ключ всегда дополняется p.id — это даёт строгий порядок для курсора.
+CATALOG_SORTS = {
+    'newest': ('p.id', 'DESC'),
+    'price': ('p.price', 'ASC'),
+    'price_desc': ('p.price', 'DESC'),
+    'name': ('p.name', 'ASC'),
+    'relevance': ('bm25(products_fts, 10.0, 2.0, 3.0, 1.0)', 'ASC'),
+}
+
+app.config.setdefault('CATALOG_PAGE_SIZE', int(os.environ.get('CATALOG_PAGE_SIZE', 24)))
+app.config.setdefault('CATALOG_MAX_PAGE_SIZE', 100)
+
+
+def encode_cursor(sort_key, row_id):
+    """
+    Кодирует позицию в списке (значение ключа сортировки, id) в строку для URL.
+    """
+    raw = json.dumps([sort_key, row_id], ensure_ascii=False).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Разбирает курсор из URL. Возвращает кортеж (ключ, id)
+    или None, если курсор отсутствует или повреждён.
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        sort_key, row_id = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(row_id, int) or not isinstance(sort_key, (int, float, str)):
+        return None
+    return sort_key, row_id
+
+
+def keyset_query(query, params, key_expr, id_expr, direction, per_page):
+    """
+    Дописывает к запросу постраничную выборку по курсору (keyset):
+    условие (ключ, id) относительно курсора after/before из request.args,
+    ORDER BY и LIMIT per_page + 1 (лишняя строка показывает, есть ли
+    следующая страница). Для страницы «назад» порядок обращается,
+    а keyset_page() затем разворачивает результат.
+    Возвращает (query, params, backward).
+    """
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before')) if not after else None
+    backward = before is not None
+    position = before if backward else after
+    params = list(params)
+    if position:
+        op = '>' if (direction == 'ASC') != backward else '<'
+        query += f" AND ({key_expr}, {id_expr}) {op} (?, ?)"
+        params.extend(position)
+
+    order = direction if not backward else ('DESC' if direction == 'ASC' else 'ASC')
+    query += f" ORDER BY {key_expr} {order}, {id_expr} {order} LIMIT ?"
+    params.append(per_page + 1)
+    return query, params, backward
+
+
+def keyset_page(rows, per_page, backward, cursor_of):
+    """
+    Обрезает выборку keyset_query() до страницы и строит ссылки
+    на соседние страницы текущего маршрута с теми же аргументами.
+    cursor_of(row) возвращает пару (ключ сортировки, id) строки.
+    Возвращает (rows, prev_url, next_url).
+    """
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+
+    has_next = has_more if not backward else True
+    has_prev = has_more if backward else bool(decode_cursor(request.args.get('after')))
+
+    # lists(): фасеты с несколькими выбранными значениями повторяются в URL
+    page_args = {k: v for k, v in request.args.lists() if k not in ('after', 'before')}
+    page_args.update(request.view_args or {})
+    next_url = prev_url = None
+    if rows and has_next:
+        next_url = url_for(request.endpoint, **page_args, after=encode_cursor(*cursor_of(rows[-1])))
+    if rows and has_prev:
+        prev_url = url_for(request.endpoint, **page_args, before=encode_cursor(*cursor_of(rows[0])))
+    return rows, prev_url, next_url
+
+
+def build_search_query(search):
+    """
+    Преобразует пользовательский ввод в выражение MATCH для FTS5.
+    Каждое слово становится префиксным термом ("лег"* найдёт «LEGO»),
+    термы объединяются через AND. Кавычки исключают синтаксис FTS5
+    из пользовательского ввода. Возвращает None, если слов нет.
+    """
+    terms = re.findall(r'\w+', search.lower())
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+# Битовый индекс фасетов каталога (счётчики товаров по значениям фильтров)
+facet_index = FacetIndex(refresh_interval=float(os.environ.get('FACET_REFRESH_INTERVAL', 1)))
+
+
+def selected_facets():
+    """
+    Выбранные значения фасетов из request.args ({фасет: [значения]}).
+    Фасет может повторяться в URL: ?manufacturer=LEGO&manufacturer=Hasbro.
+    Старый параметр category_id считается выбором категории.
+    """
+    selected = {name: [value for value in request.args.getlist(name) if value] for name, _ in FACETS}
+    if request.args.get('category_id'):
+        selected['category'].append(request.args['category_id'])
+    return {name: values for name, values in selected.items() if values}
 
-    category_id = request.args.get('category_id')
+
+def catalog_facets(match=None):
+    """
+    Фасеты для боковой панели каталога: список (фасет, подпись, значения),
+    где значения — (значение, подпись, число товаров, выбрано ли).
+    Числа учитывают выбор в других фасетах и поисковый запрос match;
+    значения без товаров показываются, только если выбраны.
+    """
+    facet_index.refresh(get_read_db())
+    selected = selected_facets()
+    restrict = None
+    if match:
+        restrict = catalog_cache.get_or_set(('listing', 'search_ids', match), lambda: bitmap_of(
+            row[0] for row in get_read_db().execute(
+                "SELECT rowid FROM products_fts WHERE products_fts MATCH ?", (match,))))
+    counts = facet_index.counts(selected, restrict)
+
+    labels = {
+        'category': {str(row['id']): row['name'] for row in get_categories()},
+        'age': {value: label for value, label, _, _ in AGE_BANDS},
+        'price': {value: label for value, label, _, _ in PRICE_BUCKETS},
+        'batteries': dict(BATTERIES),
+    }
+    result = []
+    for name, title in FACETS:
+        chosen = selected.get(name, [])
+        if name in ('age', 'price', 'batteries'):
+            order = list(labels[name])
+        else:
+            names = labels.get(name, {})
+            order = sorted(set(counts[name]) | set(chosen), key=lambda value: names.get(value, value))
+        values = [(value, labels.get(name, {}).get(value, value), counts[name].get(value, 0), value in chosen)
+                  for value in order]
+        values = [value for value in values if value[2] or value[3]]
+        if values:
+            result.append((name, title, values))
+    return result
+
+
+def catalog_listing_query(columns):
+    """
+    Строит запрос страницы каталога по аргументам request.args:
+    фильтры (фасеты, возраст, поиск), сортировка, размер страницы и курсор.
+    columns — список выборки SQL; к нему добавляется sort_key (ключ курсора).
+    Возвращает (query, params, backward, per_page, sort, searching).
+    """
     min_age = request.args.get('min_age')
     search = request.args.get('search')
 
-    query = "SELECT * FROM products WHERE stock_quantity > 0"
-    params = []
+    match = build_search_query(search) if search else None
+
+    sort = request.args.get('sort') or ('relevance' if match else 'newest')
+    if sort not in CATALOG_SORTS or (sort == 'relevance' and not match):
+        sort = 'newest'
+    key_expr, direction = CATALOG_SORTS[sort]
+
+    per_page = request.args.get('per_page', type=int) or app.config['CATALOG_PAGE_SIZE']
+    per_page = max(1, min(per_page, app.config['CATALOG_MAX_PAGE_SIZE']))
+
+    if match:
+        # Поиск через FTS5-индекс с ранжированием bm25
+        # (веса колонок: name, description, manufacturer, material)
+        query = f"""
+            SELECT {columns}, {key_expr} AS sort_key FROM products_fts
+            JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ? AND p.stock_quantity > 0
+        """
+        params = [match]
+    else:
+        query = f"SELECT {columns}, {key_expr} AS sort_key FROM products p WHERE p.stock_quantity > 0"
+        params = []
 
-    if category_id:
-        query += " AND category_id = ?"
-        params.append(category_id)
+    for name, values in selected_facets().items():
+        condition, condition_params = facet_sql(name, values)
+        if condition:
+            query += f" AND {condition}"
+            params += condition_params
     if min_age:
-        query += " AND age_min <= ?"
+        query += " AND p.age_min <= ?"
         params.append(min_age)
-    if search:
-        query += " AND name LIKE ?"
-        params.append(f'%{search}%')
 
-    cursor.execute(query, params)
-    products = cursor.fetchall()
+    query, params, backward = keyset_query(query, params, key_expr, 'p.id', direction, per_page)
+    return query, params, backward, per_page, sort, bool(match)
+
+
+@app.route('/')
+@replica_route()
+@http_cached
+def index():
+    """
+    Главная страница. Отображает каталог товаров с возможностью фильтрации
+    по категории, возрасту и поисковому запросу.
+    Список разбит на страницы курсором (keyset) по паре (ключ сортировки, id):
+    каждая страница — это диапазонное чтение индекса без OFFSET.
+    """
+    query, params, backward, per_page, sort, searching = catalog_listing_query('p.*')
 
-    cursor.execute("SELECT * FROM categories")
-    categories = cursor.fetchall()
+    # Ключ кэша — сам запрос с параметрами: он уже построен
+    # из нормализованных аргументов (сортировка, размер страницы, курсор)
+    products = catalog_cache.get_or_set(
+        ('listing', query, tuple(params)),
+        lambda: get_read_db().execute(query, params).fetchall())
+    products, prev_url, next_url = keyset_page(
+        products, per_page, backward, lambda row: (row['sort_key'], row['id']))
 
-    conn.close()
-    return render_template('index.html', products=products, categories=categories)
+    match = build_search_query(request.args['search']) if searching else None
+    return render_template('index.html', products=products, facets=catalog_facets(match),
+                           sort=sort, searching=searching,
+                           next_url=next_url, prev_url=prev_url)
 
 
 @app.route('/product/<int:product_id>')
+@replica_route()
+@http_cached(holds=True)
 def product(product_id):
     """
     Страница с информацией о товаре.
     """
-    conn = get_db()
-    cursor = conn.cursor()
-
-    cursor.execute("""
+    product = catalog_cache.get_or_set(('product', product_id), lambda: get_read_db().execute("""
         SELECT p.*, c.name AS category_name 
         FROM products p
         JOIN categories c ON p.category_id = c.id
         WHERE p.id = ?
-    """, (product_id,))
-    product = cursor.fetchone()
+    """, (product_id,)).fetchone())
 
     if not product:
         flash('Товар не найден', 'danger')
         return redirect(url_for('index'))
-
-    conn.close()
-    return render_template('product.html', product=product)
+    related = related_products(get_read_db(), product_id, session.get('user_id') if session.get('loggedin') else None,
+                               limit=app.config['RECOMMENDATIONS_SHOWN'])
+    # Остаток за вычетом чужих резервов — из той же базы, что и счётчик резервов в ETag
+    held = held_by_others(get_read_db(), cart_owner() or '', [product_id]).get(product_id, 0)
+    available = max(0, product['stock_quantity'] - held)
+    return render_template('product.html', product=product, related=related, available=available)
 
 
 @app.route('/register', methods=['GET', 'POST'])
@@ -125,7 +762,11 @@ def register():
         full_name = request.form['full_name']
         address = request.form['address']
         phone = request.form.get('phone', '')
-        image = request.form.get('image_filename')
+        upload = request.files.get('image')
+
+        retry_after = auth_retry_after(email)
+        if retry_after:
+            return auth_rejected('register.html', 'Слишком много попыток, попробуйте позже', 429, retry_after)
 
         conn = get_db()
         cursor = conn.cursor()
@@ -140,18 +781,48 @@ def register():
         elif not password or not full_name or not address:
             flash('Заполните все обязательные поля', 'danger')
         else:
-            password_hash = generate_password_hash(password)
+            # Сначала хэш: при перегрузке пула на диске не должно остаться
+            # загруженного файла без пользователя и задачи на производные
+            try:
+                password_hash = password_hasher.hash(password)
+            except HasherBusy:
+                return auth_rejected('register.html', 'Сервер перегружен, попробуйте через минуту', 503, 1)
+            image = None
+            if upload and upload.filename:
+                # Имя файла — хэш содержимого, путь от клиента не используется
+                try:
+                    image = f"{UPLOAD_SUBDIR}/" + save_upload(
+                        upload.stream, os.path.join(image_pipeline.source_dir, UPLOAD_SUBDIR))
+                except ImageError as e:
+                    flash(str(e), 'danger')
+                    return render_template('register.html')
             cursor.execute("""
-                INSERT INTO users (email, password_hash, full_name, address, phone,'image_filename')
+                INSERT INTO users (email, password_hash, full_name, address, phone, image_filename)
                 VALUES (?, ?, ?, ?, ?, ?)
-            """, (email, password_hash, full_name, address, phone,image))
+            """, (email, password_hash, full_name, address, phone, image))
+            if image:
+                jobs.enqueue(conn, 'image_derivatives', {'filename': image}, key=f"images:{image}")
             conn.commit()
             flash('Регистрация прошла успешно! Теперь вы можете войти', 'success')
             return redirect(url_for('login'))
 
-        conn.close()
-
     return render_template('register.html')
+
+
+def upgrade_password_hash(conn, user_id, password):
+    """
+    Перехэширует пароль с текущими параметрами KDF после успешного входа.
+    При перегрузке пула обновление откладывается до следующего входа.
+    """
+    try:
+        password_hash = password_hasher.hash(password)
+    except HasherBusy:
+        return
+    conn.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+    conn.commit()
+    logger.info(f"Хэш пароля пользователя {user_id} обновлён до {password_hasher.method}")
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """
@@ -162,23 +833,37 @@ def login():
         email = request.form['email']
         password = request.form['password']
 
+        retry_after = auth_retry_after(email)
+        if retry_after:
+            return auth_rejected('login.html', 'Слишком много попыток входа, попробуйте позже', 429, retry_after)
+
         conn = get_db()
         cursor = conn.cursor()
 
         cursor.execute('SELECT * FROM users WHERE email = ?', (email,))
         account = cursor.fetchone()
 
-        if account and check_password_hash(account['password_hash'], password):
+        try:
+            valid = account is not None and password_hasher.verify(account['password_hash'], password)
+        except HasherBusy:
+            return auth_rejected('login.html', 'Сервер перегружен, попробуйте через минуту', 503, 1)
+
+        if valid:
+            if password_hasher.needs_rehash(account['password_hash']):
+                upgrade_password_hash(conn, account['id'], password)
             session['loggedin'] = True
             session['user_id'] = account['id']
             session['email'] = account['email']
             session['full_name'] = account['full_name']
+            # Корзина, собранная до входа, переносится в корзину пользователя
+            token = session.pop('cart_token', None)
+            if token:
+                cart_store.merge(f"anon:{token}", f"user:{account['id']}")
+                reservations.transfer(conn, f"anon:{token}", f"user:{account['id']}")
             return redirect(url_for('index'))
         else:
             flash('Неверный email или пароль', 'danger')
 
-        conn.close()
-
     return render_template('login.html')
 
 
@@ -191,45 +876,54 @@ def logout():
     session.pop('user_id', None)
     session.pop('email', None)
     session.pop('full_name', None)
-    session.pop('cart', None)
+    session.pop('cart_token', None)
     return redirect(url_for('index'))
 
 
+def read_cart_form():
+    """
+    Читает product_id и quantity из формы корзины.
+    Возвращает кортеж или None при некорректных данных.
+    """
+    try:
+        return int(request.form['product_id']), int(request.form.get('quantity', 1))
+    except (KeyError, ValueError):
+        return None
+
+
 @app.route('/cart', methods=['GET', 'POST'])
 def cart():
     """
     Управление корзиной:
-    - POST: добавляет товар в корзину
+    - POST: добавляет товар в корзину (quantity=0 удаляет позицию)
     - GET: отображает корзину
+    Добавленное количество резервируется на RESERVATION_TTL секунд.
     """
-    if 'loggedin' not in session:
-        return redirect(url_for('login'))
-
     if request.method == 'POST':
-        try:
-            product_id = int(request.form['product_id'])
-            quantity = int(request.form['quantity'])
-        except ValueError:
+        form = read_cart_form()
+        if not form or form[1] < 0:
             flash("Некорректные данные", "danger")
             return redirect(url_for('index'))
+        product_id, quantity = form
+        owner = cart_owner(create=True)
 
-        conn = get_db()
-        cursor = conn.cursor()
+        if quantity == 0:
+            cart_store.remove(owner, product_id)
+            reservations.release(get_db(), owner, [product_id])
+            return redirect(url_for('cart'))
 
-        cursor.execute("SELECT * FROM products WHERE id = ? AND stock_quantity >= ?", (product_id, quantity))
-        product = cursor.fetchone()
-
-        if not product:
-            flash('Недостаточно товара на складе', 'danger')
+        in_cart = cart_store.items(owner).get(product_id, 0)
+        held, available = reservations.hold(get_db(), owner, product_id, in_cart + quantity)
+        if not held:
+            flash(out_of_stock_message(available, in_cart), 'danger')
             return redirect(url_for('product', product_id=product_id))
-
-        cart = session.get('cart', {})
-        cart[str(product_id)] = cart.get(str(product_id), 0) + quantity
-        session['cart'] = cart
+        cart_store.add(owner, product_id, quantity)
         flash('Товар добавлен в корзину', 'success')
         return redirect(url_for('product', product_id=product_id))
 
-    cart_items = session.get('cart', {})
+    owner = cart_owner()
+    cart_items = cart_store.items(owner) if owner else {}
+    holds = reservations.active(get_db(), owner) if cart_items else {}
     products = []
     total = 0
 
@@ -244,122 +938,321 @@ def cart():
 
         for row in rows:
             product = dict(row)
-            product_id = str(row['id'])
-            product_quantity = cart_items[product_id]
+            product_quantity = cart_items[row['id']]
             product['quantity'] = product_quantity
             product['subtotal'] = row['price'] * product_quantity
+            hold = holds.get(row['id'])
+            product['reserved_until'] = hold[1] if hold and hold[0] >= product_quantity else None
             products.append(product)
             total += product['subtotal']
 
-        conn.close()
-
     return render_template('cart.html', products=products, total=total)
 
 
+@app.route('/cart/update', methods=['POST'])
+def cart_update():
+    """
+    Устанавливает количество товара в корзине (0 удаляет позицию).
+    """
+    form = read_cart_form()
+    if not form or form[1] < 0:
+        flash("Некорректные данные", "danger")
+        return redirect(url_for('cart'))
+    product_id, quantity = form
+    owner = cart_owner(create=True)
+    held, available = reservations.hold(get_db(), owner, product_id, quantity)
+    if held:
+        cart_store.set(owner, product_id, quantity)
+    else:
+        flash(out_of_stock_message(available), 'danger')
+    return redirect(url_for('cart'))
+
+
+@app.route('/cart/remove/<int:product_id>', methods=['POST'])
+def cart_remove(product_id):
+    """
+    Удаляет товар из корзины.
+    """
+    owner = cart_owner()
+    if owner:
+        cart_store.remove(owner, product_id)
+        reservations.release(get_db(), owner, [product_id])
+    return redirect(url_for('cart'))
+
+
+def out_of_stock_message(available, in_cart=0):
+    """
+    Сообщение об отказе в резерве: сколько ещё можно положить в корзину.
+    """
+    if not available or available <= in_cart:
+        return 'Товар закончился: всё оставшееся количество уже в корзинах покупателей'
+    return f'Недостаточно товара: можно добавить не больше {available - in_cart} шт.'
+
+
+class OutOfStockError(Exception):
+    """
+    Оформление заказа невозможно: товара не хватает на складе
+    или он отсутствует в каталоге.
+    """
+
+    def __init__(self, product_ids):
+        super().__init__(f"Недостаточно товара на складе: {sorted(product_ids)}")
+        self.product_ids = product_ids
+
+
+def place_order(conn, user_id, items, owner=None):
+    """
+    Создаёт заказ и списывает остатки одной транзакцией.
+
+    items — словарь {product_id: quantity}. BEGIN IMMEDIATE сразу берёт
+    блокировку записи, поэтому параллельные покупатели выстраиваются в
+    очередь на busy_timeout, а не получают ошибку посреди заказа.
+    Товара должно хватать с учётом чужих активных резервов (owner —
+    владелец корзины, по умолчанию корзина пользователя); резервы
+    покупателя уменьшаются на заказанное количество.
+    Остатки списываются условным UPDATE: если хотя бы одна позиция не
+    прошла проверку stock_quantity >= ?, весь заказ откатывается
+    и выбрасывается OutOfStockError. Остальная работа по заказу
+    (доставка) ставится в очередь задач. Возвращает id созданного заказа.
+    """
+    owner = owner or f"user:{user_id}"
+    items = {int(product_id): int(quantity) for product_id, quantity in items.items()}
+    product_ids = sorted(items)
+    placeholders = ','.join(['?'] * len(product_ids))
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            f"SELECT id, price, stock_quantity FROM products WHERE id IN ({placeholders})",
+            product_ids).fetchall()
+        prices = {row['id']: row['price'] for row in rows}
+        held = held_by_others(conn, owner, product_ids)
+        short = {row['id'] for row in rows if row['stock_quantity'] - held.get(row['id'], 0) < items[row['id']]}
+        short |= set(product_ids) - set(prices)
+        if short:
+            raise OutOfStockError(short)
+
+        cursor = conn.executemany("""
+            UPDATE products 
+            SET stock_quantity = stock_quantity - ? 
+            WHERE id = ? AND stock_quantity >= ?
+        """, [(items[pid], pid, items[pid]) for pid in product_ids])
+        if cursor.rowcount != len(product_ids):
+            raise OutOfStockError(set(product_ids))
+
+        cursor = conn.execute("INSERT INTO orders (user_id, status) VALUES (?, 'Создан')", (user_id,))
+        order_id = cursor.lastrowid
+        conn.executemany("""
+            INSERT INTO order_items (order_id, product_id, quantity, price)
+            VALUES (?, ?, ?, ?)
+        """, [(order_id, pid, items[pid], prices[pid]) for pid in product_ids])
+        # Добавленное в корзину (в другой вкладке) после её чтения не заказано
+        # и остаётся зарезервированным
+        conn.executemany("DELETE FROM stock_reservations WHERE owner = ? AND product_id = ? AND quantity <= ?",
+                         [(owner, pid, items[pid]) for pid in product_ids])
+        conn.executemany("UPDATE stock_reservations SET quantity = quantity - ? WHERE owner = ? AND product_id = ?",
+                         [(items[pid], owner, pid) for pid in product_ids])
+        # Доставка оформляется фоновой задачей, поставленной в той же транзакции
+        jobs.enqueue(conn, 'create_delivery', {'order_id': order_id}, key=f"delivery:{order_id}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return order_id
+
+
+@jobs.handler('create_delivery')
+def create_delivery(conn, payload):
+    """
+    Задача: запись о доставке заказа по адресу покупателя.
+    Повторное выполнение ничего не меняет (delivery.order_id уникален).
+    """
+    cursor = conn.execute("""
+        INSERT INTO delivery (order_id, address)
+        SELECT o.id, u.address FROM orders o JOIN users u ON u.id = o.user_id
+        WHERE o.id = ?
+        ON CONFLICT(order_id) DO NOTHING
+    """, (payload['order_id'],))
+    if cursor.rowcount == 0 and not conn.execute(
+            "SELECT 1 FROM delivery WHERE order_id = ?", (payload['order_id'],)).fetchone():
+        raise LookupError(f"Заказ {payload['order_id']} не найден")
+
+
+# Обработчики фоновых задач: отдельный процесс в serve.py,
+# потоки в python app.py или flask jobs work
+job_worker = jobs.JobWorker(
+    db_pool,
+    threads=int(os.environ.get('JOB_THREADS', 2)),
+    poll_interval=float(os.environ.get('JOB_POLL_INTERVAL', 1.0)),
+    retry_base=float(os.environ.get('JOB_RETRY_BASE', 5.0)),
+)
+# Очистка истёкших резервов работает там же, где обработчики задач
+reservation_sweeper = ExpirySweeper(db_pool, interval=float(os.environ.get('RESERVATION_SWEEP_INTERVAL', 60)))
+
+# Сводки продаж для отчётов — отдельная база; обновляются по журналу
+# order_changes там же, где обработчики задач
+ANALYTICS_DATABASE = os.environ.get('ANALYTICS_DATABASE', os.path.join(BASE_DIR, 'analytics.db'))
+analytics_pool = ConnectionPool(ANALYTICS_DATABASE, max_idle=2)
+analytics_refresher = analytics.AnalyticsRefresher(
+    db_pool, ANALYTICS_DATABASE, interval=float(os.environ.get('ANALYTICS_REFRESH_INTERVAL', 30)))
+
+# Рекомендации «с этим товаром покупают»: матрица совместных покупок
+# в отдельной базе, готовые списки соседей — в product_recommendations
+RECOMMENDATIONS_DATABASE = os.environ.get('RECOMMENDATIONS_DATABASE', os.path.join(BASE_DIR, 'recommendations.db'))
+recommender = Recommender(
+    DATABASE,
+    RECOMMENDATIONS_DATABASE,
+    top_k=int(os.environ.get('RECOMMENDATIONS_TOP_K', 10)),
+    min_support=int(os.environ.get('RECOMMENDATIONS_MIN_SUPPORT', 2)),
+)
+recommendation_refresher = RecommendationRefresher(
+    recommender,
+    interval=float(os.environ.get('RECOMMENDATIONS_REFRESH_INTERVAL', 300)),
+    rebuild_interval=float(os.environ.get('RECOMMENDATIONS_REBUILD_INTERVAL', 86400)),
+)
+app.config.setdefault('RECOMMENDATIONS_SHOWN', int(os.environ.get('RECOMMENDATIONS_SHOWN', 4)))
+
+
 @app.route('/checkout', methods=['POST'])
 def checkout():
     """
-    Оформление заказа. Создает запись в таблице заказов и очищает корзину.
+    Оформление заказа. Создает запись в таблице заказов и убирает
+    заказанное из корзины.
     """
     if 'loggedin' not in session:
         return redirect(url_for('login'))
 
-    cart = session.get('cart')
+    owner = cart_owner()
+    cart = cart_store.items(owner)
     if not cart:
         flash('Ваша корзина пуста', 'danger')
         return redirect(url_for('cart'))
 
     user_id = session['user_id']
     conn = get_db()
-    cursor = conn.cursor()
-    
     if not conn:
         flash('Ошибка подключения к БД', 'danger')
         return redirect(url_for('cart'))
+
     try:
-            cursor.execute("INSERT INTO orders (user_id, status) VALUES (?, 'Создан')", (user_id,))
-            order_id = cursor.lastrowid
-
-            for product_id, quantity in cart.items():
-                cursor.execute("SELECT price FROM products WHERE id = ?", (product_id,))
-                price = cursor.fetchone()[0]
-                cursor.execute("""
-                    INSERT INTO order_items (order_id, product_id, quantity, price)
-                    VALUES (?, ?, ?, ?)
-                """, (order_id, product_id, quantity, price))
-
-                cursor.execute("""
-                    UPDATE products 
-                    SET stock_quantity = stock_quantity - ? 
-                    WHERE id = ?
-                """, (quantity, product_id))
-
-            session.pop('cart', None)
-            conn.commit()
-            flash('Заказ успешно оформлен!', 'success')
-            return redirect(url_for('orders'))
+        place_order(conn, user_id, cart, owner)
+    except OutOfStockError:
+        flash('Недостаточно товара на складе для оформления заказа', 'danger')
+        return redirect(url_for('cart'))
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при оформлении заказа: {e}")
+        flash('Ошибка при оформлении заказа', 'danger')
+        return redirect(url_for('cart'))
 
-    finally:
-        conn.close()
+    cart_store.subtract(owner, cart)
+    invalidate_products(cart.keys())
+    remember_write()
+    flash('Заказ успешно оформлен!', 'success')
+    return redirect(url_for('orders'))
+
+
+# Статусы заказа, доступные в фильтре истории заказов
+ORDER_STATUSES = ['Создан', 'Оплачен', 'В обработке', 'Отправлен', 'Доставлен', 'Отменен']
+
+app.config.setdefault('ORDERS_PAGE_SIZE', 20)
+
+
+@app.template_filter('datetime')
+def format_datetime(value, fmt='%d.%m.%Y %H:%M'):
+    """
+    Jinja-фильтр: форматирует дату из SQLite ('YYYY-MM-DD HH:MM:SS')
+    или метку времени Unix (сроки резервов).
+    Нераспознанные значения выводятся как есть, пустые — пустой строкой.
+    """
+    if not value:
+        return ''
+    if isinstance(value, (int, float)):
+        value = datetime.fromtimestamp(value)
+    elif isinstance(value, str):
+        try:
+            value = datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            return value
+    return value.strftime(fmt)
+
+
+def parse_date(value):
+    """
+    Проверяет дату фильтра в формате YYYY-MM-DD. Возвращает её или None.
+    """
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def orders_listing_query(user_id, columns, per_page):
+    """
+    Строит запрос страницы истории заказов пользователя по request.args:
+    статус, период (date_from, date_to) и курсор (order_date, id).
+    Возвращает (query, params, backward).
+    """
+    status = request.args.get('status')
+    date_from = parse_date(request.args.get('date_from'))
+    date_to = parse_date(request.args.get('date_to'))
+
+    query = f"SELECT {columns} FROM orders o WHERE o.user_id = ?"
+    params = [user_id]
+    if status in ORDER_STATUSES:
+        query += " AND o.status = ?"
+        params.append(status)
+    if date_from:
+        query += " AND o.order_date >= ?"
+        params.append(date_from)
+    if date_to:
+        query += " AND o.order_date < date(?, '+1 day')"
+        params.append(date_to)
+
+    return keyset_query(query, params, 'o.order_date', 'o.id', 'DESC', per_page)
 
 
 @app.route('/orders')
+@replica_route(read_your_writes=True)
 def orders():
-    """Список заказов пользователя"""
+    """
+    Список заказов пользователя, от новых к старым.
+    Постранично по курсору (order_date, id) — каждая страница читается
+    диапазоном индекса idx_orders_user_date. Фильтры: статус и период.
+    """
     if 'loggedin' not in session:
         return redirect(url_for('login'))
     
     user_id = session['user_id']
-    conn = get_db()
+    conn = get_read_db()
     if not conn:
         flash('Ошибка подключения к БД', 'danger')
         return render_template('error.html')
-    
+
+    per_page = app.config['ORDERS_PAGE_SIZE']
+    query, params, backward = orders_listing_query(
+        user_id, 'o.id, o.order_date, o.status, o.total_amount AS total', per_page)
+
     try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT 
-                o.id, 
-                o.order_date, 
-                o.status, 
-                SUM(oi.quantity * oi.price) AS total
-            FROM orders o
-            JOIN order_items oi ON o.id = oi.order_id
-            WHERE o.user_id = ?
-            GROUP BY o.id
-            ORDER BY o.order_date DESC
-        """, (user_id,))
-        
-        # Convert sqlite3.Row objects to dictionaries
-        orders = [dict(row) for row in cursor.fetchall()]
-        
-        # Format dates if they exist
-        for order in orders:
-            if order['order_date'] and isinstance(order['order_date'], str):
-                try:
-                    # If date is stored as string in DB, parse it
-                    dt = datetime.strptime(order['order_date'], '%Y-%m-%d %H:%M:%S')
-                    order['order_date'] = dt.strftime('%d.%m.%Y %H:%M')
-                except ValueError:
-                    pass
-        
-        return render_template('orders.html', orders=orders)
-    
+        rows = conn.execute(query, params).fetchall()
     except sqlite3.Error as e:
         logger.error(f"Ошибка БД: {e}")
         flash('Ошибка загрузки заказов', 'danger')
         return render_template('error.html')
-    finally:
-        conn.close()
+
+    orders, prev_url, next_url = keyset_page(
+        rows, per_page, backward, lambda row: (row['order_date'], row['id']))
+    return render_template('orders.html', orders=orders, statuses=ORDER_STATUSES,
+                           prev_url=prev_url, next_url=next_url)
 
 @app.route('/order/<int:order_id>')
+@replica_route(read_your_writes=True)
 def order_details(order_id):
     """Детальная информация о заказе"""
     if 'loggedin' not in session:
         return redirect(url_for('login'))
     
     user_id = session['user_id']
-    conn = get_db()
+    conn = get_read_db()
     if not conn:
         flash('Ошибка подключения к БД', 'danger')
         return redirect(url_for('orders'))
@@ -370,34 +1263,20 @@ def order_details(order_id):
         # Основная информация о заказе
         cursor.execute("""
             SELECT o.id, o.order_date, o.status, 
-                   SUM(oi.quantity * oi.price) AS total,
+                   o.total_amount AS total,
                    d.status AS delivery_status,
                    p.status AS payment_status
             FROM orders o
             LEFT JOIN delivery d ON o.id = d.order_id
             LEFT JOIN payments p ON o.id = p.order_id
-            LEFT JOIN order_items oi ON o.id = oi.order_id
             WHERE o.id = ? AND o.user_id = ?
-            GROUP BY o.id
         """, (order_id, user_id))
-        order = dict(cursor.fetchone())  # Convert to dict
+        order = cursor.fetchone()
         
         if not order:
             flash('Заказ не найден', 'danger')
             return redirect(url_for('orders'))
         
-        # Format the date if it exists
-        if order['order_date'] and isinstance(order['order_date'], str):
-            try:
-                # Parse the string date into datetime object
-                dt = datetime.strptime(order['order_date'], '%Y-%m-%d %H:%M:%S')
-                # Convert back to string in desired format
-                order['formatted_date'] = dt.strftime('%d.%m.%Y %H:%M')
-            except ValueError:
-                order['formatted_date'] = order['order_date']
-        else:
-            order['formatted_date'] = 'Не указана'
-        
         # Товары в заказе
         cursor.execute("""
             SELECT oi.*, p.name, p.image_filename
@@ -415,12 +1294,55 @@ def order_details(order_id):
         logger.error(f"Ошибка БД: {e}")
         flash('Ошибка загрузки заказа', 'danger')
         return redirect(url_for('orders'))
+
+# Платёжный шлюз: 'stub' (заглушка с настраиваемой задержкой и отказами)
+# или путь к классу шлюза, например 'mybank:Gateway'
+payment_gateway = payments.load_gateway(
+    os.environ.get('PAYMENT_GATEWAY', 'stub'),
+    latency=float(os.environ.get('STUB_GATEWAY_LATENCY', 0.2)),
+    failure_rate=float(os.environ.get('STUB_GATEWAY_FAILURE_RATE', 0)),
+    timeout_rate=float(os.environ.get('STUB_GATEWAY_TIMEOUT_RATE', 0)),
+)
+app.config.setdefault('PAYMENT_GATEWAY_TIMEOUT', float(os.environ.get('PAYMENT_GATEWAY_TIMEOUT', 10)))
+# Через сколько секунд незавершённую попытку оплаты можно продолжить заново
+app.config.setdefault('PAYMENT_STALE_SECONDS', 3 * app.config['PAYMENT_GATEWAY_TIMEOUT'])
+
+
+@contextlib.contextmanager
+def pooled_connection():
+    """
+    Соединение из пула на время блока (вне соединения запроса g.db).
+    """
+    conn = db_pool.acquire()
+    try:
+        yield conn
     finally:
-        conn.close()
+        db_pool.release(conn)
+
+
+@jobs.handler('resume_payment')
+def resume_payment(conn, payload):
+    """
+    Задача: доводит платёж, по которому шлюз не ответил вовремя,
+    повторным вызовом с тем же ключом идемпотентности.
+    """
+    row = conn.execute("SELECT * FROM payments WHERE id = ?", (payload['payment_id'],)).fetchone()
+    if row is None or row['state'] not in (payments.PENDING, payments.AUTHORIZED):
+        return
+    payments.complete_payment(payment_gateway, dict(row), lambda: contextlib.nullcontext(conn),
+                              app.config['PAYMENT_GATEWAY_TIMEOUT'])
+
 
 @app.route('/order/<int:order_id>/pay', methods=['GET', 'POST'])
 def pay_order(order_id):
-    """Оплата заказа"""
+    """
+    Оплата заказа.
+
+    Попытка оплаты открывается короткой транзакцией с ключом идемпотентности
+    из формы (повторная отправка той же формы не платит второй раз), затем
+    соединение возвращается в пул, и запрос ждёт шлюз, не удерживая базу.
+    Если шлюз не ответил вовремя, оплата доводится фоновой задачей.
+    """
     if 'loggedin' not in session:
         return redirect(url_for('login'))
     
@@ -435,11 +1357,9 @@ def pay_order(order_id):
         
         # Проверяем принадлежность заказа
         cursor.execute("""
-            SELECT o.*, SUM(oi.quantity * oi.price) AS total
+            SELECT o.*, o.total_amount AS total
             FROM orders o
-            JOIN order_items oi ON o.id = oi.order_id
-            WHERE o.id = ? AND o.user_id = ?
-            GROUP BY o.id
+            WHERE o.id = ? AND o.user_id = ? AND o.item_count > 0
         """, (order_id, user_id))
         order = cursor.fetchone()
         
@@ -451,50 +1371,847 @@ def pay_order(order_id):
         cursor.execute("SELECT * FROM payments WHERE order_id = ?", (order_id,))
         payment = cursor.fetchone()
         
-        if request.method == 'POST':
-            method = request.form.get('method')
-            
-            if not method:
-                flash('Выберите способ оплаты', 'danger')
-                return render_template('pay_order.html', order=order, payment=payment)
-            
-            try:
-                if payment:
-                    # Обновляем существующую запись
-                    cursor.execute("""
-                        UPDATE payments 
-                        SET method = ?, status = 'Успешно', payment_date = ?
-                        WHERE order_id = ?
-                    """, (method, datetime.now(), order_id))
-                else:
-                    # Создаем новую запись
-                    cursor.execute("""
-                        INSERT INTO payments (order_id, method, amount, status, payment_date)
-                        VALUES (?, ?, ?, 'Успешно', ?)
-                    """, (order_id, method, order['total'], datetime.now()))
-                
-                # Обновляем статус заказа
-                cursor.execute("UPDATE orders SET status = 'Оплачен' WHERE id = ?", (order_id,))
-                
-                conn.commit()
-                flash('Оплата прошла успешно!', 'success')
-                return redirect(url_for('order_details', order_id=order_id))
-            
-            except sqlite3.Error as e:
-                conn.rollback()
-                logger.error(f"Ошибка БД при оплате: {e}")
-                flash('Ошибка при обработке платежа', 'danger')
-        
-        return render_template('pay_order.html', order=order, payment=payment)
-    
+        if request.method == 'GET':
+            return render_template('pay_order.html', order=order, payment=payment,
+                                   idempotency_key=secrets.token_urlsafe(16))
+
+        method = request.form.get('method')
+        key = request.form.get('idempotency_key') or secrets.token_urlsafe(16)
+        if not method:
+            flash('Выберите способ оплаты', 'danger')
+            return render_template('pay_order.html', order=order, payment=payment, idempotency_key=key)
+
+        payment = payments.start_payment(conn, order_id, order['total'], method, key,
+                                         app.config['PAYMENT_STALE_SECONDS'])
+    except payments.AlreadyPaid:
+        flash('Заказ уже оплачен', 'info')
+        return redirect(url_for('order_details', order_id=order_id))
+    except payments.PaymentInProgress:
+        flash('Оплата заказа уже обрабатывается', 'info')
+        return redirect(url_for('order_details', order_id=order_id))
     except sqlite3.Error as e:
-        logger.error(f"Ошибка БД: {e}")
-        flash('Ошибка загрузки заказа', 'danger')
+        logger.error(f"Ошибка БД при оплате: {e}")
+        flash('Ошибка при обработке платежа', 'danger')
         return redirect(url_for('orders'))
+
+    # Дальше — ожидание шлюза: соединение запроса больше не нужно
+    release_db()
+    try:
+        if payment['state'] != payments.FAILED:
+            payment = payments.complete_payment(payment_gateway, payment, pooled_connection,
+                                                app.config['PAYMENT_GATEWAY_TIMEOUT'])
+    except payments.GatewayTimeout:
+        with pooled_connection() as conn, conn:
+            jobs.enqueue(conn, 'resume_payment', {'payment_id': payment['id']},
+                         key=f"resume_payment:{payment['idempotency_key']}")
+        flash('Банк отвечает дольше обычного, статус оплаты обновится автоматически', 'warning')
+        return redirect(url_for('order_details', order_id=order_id))
+    except payments.PaymentError as e:
+        logger.warning(f"Оплата заказа {order_id}: {e}")
+        flash('Оплата заказа уже обрабатывается', 'info')
+        return redirect(url_for('order_details', order_id=order_id))
+    except sqlite3.Error as e:
+        logger.error(f"Ошибка БД при оплате: {e}")
+        flash('Ошибка при обработке платежа', 'danger')
+        return redirect(url_for('order_details', order_id=order_id))
+
+    if payment['state'] == payments.FAILED:
+        flash(f"Оплата не прошла: {payment['error']}", 'danger')
+        return redirect(url_for('pay_order', order_id=order_id))
+    remember_write()
+    flash('Оплата прошла успешно!', 'success')
+    return redirect(url_for('order_details', order_id=order_id))
+
+
+# === Отчёты о продажах ===
+
+# Почты пользователей с доступом к /admin (через запятую)
+ADMIN_EMAILS = {email.strip().lower() for email in os.environ.get('ADMIN_EMAILS', '').split(',') if email.strip()}
+
+# Самый мелкий разрез для периода: почасовой ряд — не длиннее REPORT_MAX_POINTS точек
+REPORT_MAX_POINTS = 400
+
+
+def is_admin():
+    return 'loggedin' in session and session.get('email', '').lower() in ADMIN_EMAILS
+
+
+def admin_required(view):
+    """
+    Декоратор: страница только для пользователей из ADMIN_EMAILS.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if 'loggedin' not in session:
+            return redirect(url_for('login'))
+        if not is_admin():
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextlib.contextmanager
+def analytics_connection():
+    """
+    Соединение с базой сводок на время блока. Основная база отчётами не читается.
+    """
+    conn = analytics_pool.acquire()
+    try:
+        yield conn
+    finally:
+        analytics_pool.release(conn)
+
+
+def report_grain(start, end, grain=None):
+    """
+    Разрез ряда отчёта: запрошенный, если точек не слишком много, иначе более крупный.
+    """
+    days = (end - start).days + 1
+    points = {'hour': days * 24, 'day': days, 'month': days / 30}
+    if grain in points and points[grain] <= REPORT_MAX_POINTS:
+        return grain
+    return next(grain for grain in analytics.GRAINS if points[grain] <= REPORT_MAX_POINTS or grain == 'month')
+
+
+@app.route('/admin/reports')
+@admin_required
+def admin_reports():
+    """
+    Отчёт о продажах за период: итоги, динамика, товары, категории и статусы.
+    Строится только по сводкам (analytics.py).
+    """
+    try:
+        start, end = analytics.parse_period(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        flash('Некорректная дата периода', 'danger')
+        start, end = analytics.parse_period(None, None)
+    grain = report_grain(start, end, request.args.get('grain'))
+    selected = [status for status in request.args.getlist('status') if status in ORDER_STATUSES]
+    order_by = 'units' if request.args.get('order_by') == 'units' else 'revenue'
+
+    started = time.perf_counter()
+    with analytics_connection() as conn:
+        report = {
+            'totals': analytics.totals(conn, start, end, selected),
+            'series': analytics.series(conn, grain, start, end, selected),
+            'products': analytics.top_products(conn, start, end, selected, order_by=order_by),
+            'categories': analytics.by_category(conn, start, end, selected),
+            'statuses': analytics.by_status(conn, start, end),
+            'refreshed_at': analytics.get_meta(conn, 'refreshed_at'),
+        }
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    peak = max((point['revenue'] for point in report['series']), default=0) or 1
+    return render_template('admin_reports.html', report=report, start=start, end=end, grain=grain,
+                           grains=analytics.GRAINS, statuses=ORDER_STATUSES, selected=selected,
+                           order_by=order_by, peak=peak, elapsed_ms=elapsed_ms)
+
+
+# === JSON API /api/v1 ===
+# Те же данные, что и HTML-страницы, для мобильного клиента. Авторизация —
+# та же cookie-сессия (вход через /login). Строки сериализуются прямо из
+# кортежей sqlite3 (курсор без row_factory), а ?fields= ограничивает
+# и выдачу, и сам SELECT.
+api_v1 = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+# Поля, доступные через ?fields=, и их выражения в SQL
+PRODUCT_FIELDS = {
+    'id': 'p.id',
+    'name': 'p.name',
+    'description': 'p.description',
+    'price': 'p.price',
+    'stock_quantity': 'p.stock_quantity',
+    'category_id': 'p.category_id',
+    'manufacturer': 'p.manufacturer',
+    'material': 'p.material',
+    'age_min': 'p.age_min',
+    'batteries_included': 'p.batteries_included',
+    'image_filename': 'p.image_filename',
+}
+ORDER_FIELDS = {
+    'id': 'o.id',
+    'order_date': 'o.order_date',
+    'status': 'o.status',
+    'total': 'o.total_amount',
+    'item_count': 'o.item_count',
+}
+ORDER_ITEM_FIELDS = {
+    'product_id': 'oi.product_id',
+    'name': 'p.name',
+    'quantity': 'oi.quantity',
+    'price': 'oi.price',
+    'image_filename': 'p.image_filename',
+}
+CART_PRODUCT_FIELDS = ['id', 'name', 'price', 'image_filename']
+
+
+class ApiError(Exception):
+    """
+    Ошибка запроса к API: отдаётся клиенту как {"error": message} с кодом status.
+    """
+
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.extra = extra
+
+
+@api_v1.errorhandler(ApiError)
+def api_error(error):
+    return jsonify(error=error.message, **error.extra), error.status
+
+
+@api_v1.errorhandler(sqlite3.Error)
+def api_db_error(error):
+    logger.error(f"Ошибка БД в API: {error}")
+    return jsonify(error='Ошибка базы данных'), 500
+
+
+def api_fields(allowed, default=None, arg='fields'):
+    """
+    Разбирает ?fields=a,b,c (или другой аргумент arg). Возвращает список
+    имён полей (по умолчанию — default или все поля allowed).
+    """
+    raw = request.args.get(arg)
+    if not raw:
+        return list(default or allowed)
+    names = list(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    unknown = [name for name in names if name not in allowed]
+    if unknown or not names:
+        raise ApiError(f"Неизвестные поля: {', '.join(unknown)}" if unknown else 'Пустой список полей')
+    return names
+
+
+def select_list(allowed, names):
+    return ', '.join(f"{allowed[name]} AS {name}" for name in names)
+
+
+def tuple_cursor():
+    """
+    Курсор соединения для чтения (см. get_read_db), возвращающий
+    обычные кортежи вместо sqlite3.Row.
+    """
+    cursor = get_read_db().cursor()
+    cursor.row_factory = None
+    return cursor
+
+
+def serialize(names, rows):
+    """
+    Превращает кортежи в словари для JSON. Лишние значения в конце
+    кортежа (ключи курсора) отбрасываются.
+    """
+    return [dict(zip(names, row)) for row in rows]
+
+
+def api_user_id():
+    if 'loggedin' not in session:
+        raise ApiError('Требуется вход', 401)
+    return session['user_id']
+
+
+def api_json_int(data, name, default=None):
+    value = data.get(name, default)
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ApiError(f"Поле {name} должно быть целым числом")
+    return value
+
+
+@api_v1.route('/categories')
+@replica_route()
+def api_categories():
+    """Список категорий"""
+    return jsonify(items=serialize(['id', 'name', 'description'],
+                                   (tuple(row) for row in get_categories())))
+
+
+@api_v1.route('/products')
+@replica_route()
+def api_products():
+    """
+    Каталог: те же фильтры, сортировки и курсоры, что и на главной странице.
+    С ?ids=1,2,3 — пакетная выборка товаров по id одним запросом.
+    """
+    names = api_fields(PRODUCT_FIELDS)
+    if 'ids' in request.args:
+        return api_products_batch(names)
+
+    query, params, backward, per_page, sort, searching = catalog_listing_query(
+        select_list(PRODUCT_FIELDS, names) + ', p.id AS cursor_id')
+    rows = catalog_cache.get_or_set(
+        ('listing', query, tuple(params)),
+        lambda: tuple_cursor().execute(query, params).fetchall())
+    rows, prev_url, next_url = keyset_page(list(rows), per_page, backward, lambda row: (row[-1], row[-2]))
+    return jsonify(items=serialize(names, rows), sort=sort, next=next_url, prev=prev_url)
+
+
+def api_products_batch(names):
+    try:
+        ids = list(dict.fromkeys(int(part) for part in request.args['ids'].split(',') if part.strip()))
+    except ValueError:
+        raise ApiError('ids должен быть списком целых чисел через запятую')
+    if not ids:
+        raise ApiError('Пустой список ids')
+    if len(ids) > app.config['CATALOG_MAX_PAGE_SIZE']:
+        raise ApiError(f"Не больше {app.config['CATALOG_MAX_PAGE_SIZE']} товаров за запрос")
+
+    placeholders = ','.join(['?'] * len(ids))
+    rows = tuple_cursor().execute(
+        f"SELECT {select_list(PRODUCT_FIELDS, names)}, p.id FROM products p WHERE p.id IN ({placeholders})",
+        ids).fetchall()
+    by_id = {row[-1]: row for row in rows}
+    return jsonify(items=serialize(names, (by_id[product_id] for product_id in ids if product_id in by_id)),
+                   missing=[product_id for product_id in ids if product_id not in by_id])
+
+
+@api_v1.route('/facets')
+@replica_route()
+def api_facets():
+    """
+    Фасеты каталога с числом товаров: те же фильтры и поиск, что у /products.
+    """
+    search = request.args.get('search')
+    match = build_search_query(search) if search else None
+    return jsonify({name: {'title': title,
+                           'values': [{'value': value, 'label': label, 'count': count, 'selected': chosen}
+                                      for value, label, count, chosen in values]}
+                    for name, title, values in catalog_facets(match)})
+
+
+@api_v1.route('/products/<int:product_id>')
+@replica_route()
+def api_product(product_id):
+    """Один товар"""
+    names = api_fields(PRODUCT_FIELDS)
+    row = tuple_cursor().execute(
+        f"SELECT {select_list(PRODUCT_FIELDS, names)} FROM products p WHERE p.id = ?",
+        (product_id,)).fetchone()
+    if row is None:
+        raise ApiError('Товар не найден', 404)
+    return jsonify(serialize(names, [row])[0])
+
+
+def api_cart_response(owner):
+    """
+    Содержимое корзины: поля товаров (?fields=), количество и сумма по позиции.
+    """
+    names = api_fields(PRODUCT_FIELDS, CART_PRODUCT_FIELDS)
+    quantities = cart_store.items(owner) if owner else {}
+    items = []
+    total = 0
+    if quantities:
+        placeholders = ','.join(['?'] * len(quantities))
+        rows = tuple_cursor().execute(
+            f"SELECT {select_list(PRODUCT_FIELDS, names)}, p.id, p.price "
+            f"FROM products p WHERE p.id IN ({placeholders})", list(quantities)).fetchall()
+        for item, row in zip(serialize(names, rows), rows):
+            quantity = quantities[row[-2]]
+            item['product_id'] = row[-2]
+            item['quantity'] = quantity
+            item['subtotal'] = row[-1] * quantity
+            total += item['subtotal']
+            items.append(item)
+    return jsonify(items=items, total=total)
+
+
+@api_v1.route('/cart', methods=['GET'])
+def api_cart():
+    """Корзина текущего посетителя"""
+    return api_cart_response(cart_owner())
+
+
+@api_v1.route('/cart', methods=['POST'])
+def api_cart_add():
+    """Добавляет товар: {"product_id": 1, "quantity": 2}"""
+    data = request.get_json(silent=True) or {}
+    product_id = api_json_int(data, 'product_id')
+    quantity = api_json_int(data, 'quantity', 1)
+    if quantity <= 0:
+        raise ApiError('quantity должно быть больше нуля')
+    owner = cart_owner(create=True)
+    in_cart = cart_store.items(owner).get(product_id, 0)
+    held, available = reservations.hold(get_db(), owner, product_id, in_cart + quantity)
+    if not held:
+        raise ApiError(out_of_stock_message(available, in_cart), 409, available=max(0, (available or 0) - in_cart))
+    cart_store.add(owner, product_id, quantity)
+    return api_cart_response(owner)
+
+
+@api_v1.route('/cart/<int:product_id>', methods=['PUT'])
+def api_cart_set(product_id):
+    """Устанавливает количество: {"quantity": 3} (0 удаляет позицию)"""
+    data = request.get_json(silent=True) or {}
+    quantity = api_json_int(data, 'quantity')
+    if quantity < 0:
+        raise ApiError('quantity не может быть отрицательным')
+    owner = cart_owner(create=True)
+    held, available = reservations.hold(get_db(), owner, product_id, quantity)
+    if not held:
+        raise ApiError(out_of_stock_message(available), 409, available=available or 0)
+    cart_store.set(owner, product_id, quantity)
+    return api_cart_response(owner)
+
+
+@api_v1.route('/cart/<int:product_id>', methods=['DELETE'])
+def api_cart_remove(product_id):
+    """Удаляет товар из корзины"""
+    owner = cart_owner()
+    if owner:
+        cart_store.remove(owner, product_id)
+        reservations.release(get_db(), owner, [product_id])
+    return api_cart_response(owner)
+
+
+@api_v1.route('/orders', methods=['GET'])
+@replica_route(read_your_writes=True)
+def api_orders():
+    """
+    История заказов: фильтры status, date_from, date_to и курсор,
+    как на странице /orders; размер страницы — per_page.
+    """
+    user_id = api_user_id()
+    names = api_fields(ORDER_FIELDS)
+    per_page = request.args.get('per_page', type=int) or app.config['ORDERS_PAGE_SIZE']
+    per_page = max(1, min(per_page, app.config['CATALOG_MAX_PAGE_SIZE']))
+    query, params, backward = orders_listing_query(
+        user_id, select_list(ORDER_FIELDS, names) + ', o.order_date, o.id', per_page)
+    rows = tuple_cursor().execute(query, params).fetchall()
+    rows, prev_url, next_url = keyset_page(rows, per_page, backward, lambda row: (row[-2], row[-1]))
+    return jsonify(items=serialize(names, rows), next=next_url, prev=prev_url)
+
+
+@api_v1.route('/orders', methods=['POST'])
+def api_checkout():
+    """Оформляет заказ из корзины. Возвращает 201 и id заказа."""
+    user_id = api_user_id()
+    owner = cart_owner()
+    cart = cart_store.items(owner)
+    if not cart:
+        raise ApiError('Корзина пуста', 409)
+    try:
+        order_id = place_order(get_db(), user_id, cart, owner)
+    except OutOfStockError as e:
+        raise ApiError('Недостаточно товара на складе', 409, product_ids=sorted(e.product_ids))
+    cart_store.subtract(owner, cart)
+    invalidate_products(cart.keys())
+    remember_write()
+    return jsonify(id=order_id), 201
+
+
+@api_v1.route('/orders/<int:order_id>')
+@replica_route(read_your_writes=True)
+def api_order(order_id):
+    """Заказ с позициями (?fields= — поля заказа, ?item_fields= — поля позиций)"""
+    user_id = api_user_id()
+    names = api_fields(ORDER_FIELDS)
+    cursor = tuple_cursor()
+    row = cursor.execute(f"""
+        SELECT {select_list(ORDER_FIELDS, names)}, d.status, pay.status
+        FROM orders o
+        LEFT JOIN delivery d ON o.id = d.order_id
+        LEFT JOIN payments pay ON o.id = pay.order_id
+        WHERE o.id = ? AND o.user_id = ?
+    """, (order_id, user_id)).fetchone()
+    if row is None:
+        raise ApiError('Заказ не найден', 404)
+
+    order = serialize(names, [row])[0]
+    order['delivery_status'], order['payment_status'] = row[-2:]
+
+    item_names = api_fields(ORDER_ITEM_FIELDS, arg='item_fields')
+    items = cursor.execute(f"""
+        SELECT {select_list(ORDER_ITEM_FIELDS, item_names)}
+        FROM order_items oi
+        JOIN products p ON oi.product_id = p.id
+        WHERE oi.order_id = ?
+    """, (order_id,)).fetchall()
+    order['items'] = serialize(item_names, items)
+    return jsonify(order)
+
+
+app.register_blueprint(api_v1)
+
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Счётчики кэшей каталога и фрагментов (попадания, промахи, вытеснения) и фасетного индекса"""
+    return jsonify(catalog=catalog_cache.stats(), fragments=fragment_cache.stats(), facets=facet_index.stats(),
+                   images=image_pipeline.stats(), reservations=reservations.stats())
+
+
+@app.route('/metrics')
+def metrics():
+    """Метрики SQL и кэшей в текстовом формате Prometheus"""
+    body = prometheus_metrics(query_profiler, {'catalog': catalog_cache, 'fragments': fragment_cache})
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
+@app.cli.command('check-order-totals')
+@click.option('--fix', is_flag=True, help='Пересчитать расходящиеся итоги по order_items.')
+def check_order_totals_command(fix):
+    """Сверяет orders.total_amount/item_count с позициями заказов."""
+    from init_db import find_order_total_mismatches, fix_order_totals
+    conn = sqlite3.connect(DATABASE)
+    try:
+        mismatches = find_order_total_mismatches(conn)
+        for order_id, total, count, actual_total, actual_count in mismatches:
+            click.echo(f"Заказ #{order_id}: сумма {total} (по позициям {actual_total}), "
+                       f"товаров {count} (по позициям {actual_count})")
+        if not mismatches:
+            click.echo("Расхождений нет")
+        elif fix:
+            fix_order_totals(conn, [row[0] for row in mismatches])
+            click.echo(f"Исправлено заказов: {len(mismatches)}")
+        else:
+            raise SystemExit(1)
     finally:
         conn.close()
 
 
+@app.cli.command('migrate')
+@click.option('--target', type=int, help='Остановиться на этой версии схемы.')
+@click.option('--check', is_flag=True, help='Только показать версию, ожидающие миграции и планы запросов.')
+def migrate_command(target, check):
+    """
+    Применяет миграции схемы (PRAGMA user_version) и проверяет,
+    что основные запросы используют индексы.
+    """
+    from migrations import LATEST_VERSION, MigrationError, check_plans, get_version, migrate, pending
+    conn = sqlite3.connect(DATABASE, timeout=30)
+    try:
+        click.echo(f"Версия схемы: {get_version(conn)} (последняя {LATEST_VERSION})")
+        if check:
+            for migration in pending(conn):
+                click.echo(f"  ожидает: {migration.version} — {migration.description}")
+        else:
+            try:
+                applied = migrate(conn, target)
+            except MigrationError as e:
+                raise click.ClickException(str(e))
+            for migration in applied:
+                click.echo(f"  применена: {migration.version} — {migration.description}")
+            if not applied:
+                click.echo("Схема актуальна")
+        failures = check_plans(conn)
+        for description, plan in failures:
+            click.echo(f"План «{description}» без ожидаемого индекса: {plan}", err=True)
+    finally:
+        conn.close()
+    if failures:
+        raise SystemExit(1)
+
+
+@app.cli.group('replica')
+def replica_command():
+    """Снимки основной базы для чтения каталога."""
+
+
+@replica_command.command('refresh')
+@click.argument('paths', nargs=-1)
+@click.option('--interval', type=float, help='Обновлять снимки каждые N секунд, пока не остановят.')
+def replica_refresh_command(paths, interval):
+    """
+    Обновляет снимки PATHS (по умолчанию — REPLICA_DATABASES,
+    кроме самой основной базы) через online backup API.
+    """
+    paths = paths or [path for path in os.environ.get('REPLICA_DATABASES', '').split(',')
+                      if path.strip() and os.path.abspath(path.strip()) != os.path.abspath(DATABASE)]
+    if not paths:
+        raise click.ClickException('Не заданы файлы реплик (аргументы или REPLICA_DATABASES)')
+    while True:
+        for path in paths:
+            elapsed = refresh_snapshot(DATABASE, path.strip())
+            click.echo(f"Снимок {path.strip()} обновлён за {elapsed:.2f} с")
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@app.cli.group('jobs')
+def jobs_command():
+    """Очередь фоновых задач."""
+
+
+@jobs_command.command('stats')
+def jobs_stats_command():
+    """Глубина очереди, задержка и число задач по статусам."""
+    conn = db_pool.acquire()
+    try:
+        stats = jobs.queue_stats(conn)
+    finally:
+        db_pool.release(conn)
+    click.echo(f"Готовы к выполнению: {stats['depth']}, отложены: {stats['delayed']}, "
+               f"задержка: {stats['lag_seconds']:.1f} с")
+    for kind, counts in sorted(stats['counts'].items()):
+        click.echo(f"  {kind}: " + ', '.join(f"{status} {count}" for status, count in sorted(counts.items())))
+
+
+@jobs_command.command('dead')
+@click.option('--limit', type=int, default=20, show_default=True)
+def jobs_dead_command(limit):
+    """Задачи, исчерпавшие попытки, с последней ошибкой."""
+    conn = db_pool.acquire()
+    try:
+        rows = conn.execute("SELECT id, kind, payload, attempts, last_error FROM jobs WHERE status = 'dead' "
+                            "ORDER BY finished_at DESC LIMIT ?", (limit,)).fetchall()
+    finally:
+        db_pool.release(conn)
+    for row in rows:
+        click.echo(f"#{row['id']} {row['kind']} {row['payload']} (попыток: {row['attempts']}): {row['last_error']}")
+    if not rows:
+        click.echo("Нет задач в dead")
+
+
+@jobs_command.command('retry')
+@click.argument('job_ids', nargs=-1, type=int)
+def jobs_retry_command(job_ids):
+    """Возвращает задачи из dead в очередь (все или JOB_IDS)."""
+    conn = db_pool.acquire()
+    try:
+        count = jobs.requeue_dead(conn, job_ids)
+    finally:
+        db_pool.release(conn)
+    click.echo(f"Возвращено в очередь: {count}")
+
+
+@jobs_command.command('purge')
+@click.option('--days', type=float, default=7, show_default=True, help='Удалить выполненные задачи старше N дней.')
+def jobs_purge_command(days):
+    """Удаляет старые выполненные задачи."""
+    conn = db_pool.acquire()
+    try:
+        count = jobs.purge_done(conn, days * 86400)
+    finally:
+        db_pool.release(conn)
+    click.echo(f"Удалено задач: {count}")
+
+
+@jobs_command.command('work')
+@click.option('--threads', type=int, help='Потоков-обработчиков (по умолчанию JOB_THREADS).')
+def jobs_work_command(threads):
+    """Выполняет задачи из очереди до Ctrl+C / SIGTERM."""
+    import signal
+    if threads:
+        job_worker.threads = threads
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    job_worker.start()
+    reservation_sweeper.start()
+    analytics_refresher.start()
+    recommendation_refresher.start()
+    click.echo(f"Обработчиков задач: {job_worker.threads}", err=True)
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    recommendation_refresher.stop()
+    analytics_refresher.stop()
+    reservation_sweeper.stop()
+    job_worker.stop()
+
+
+@app.cli.group('images')
+def images_command():
+    """Производные изображения товаров."""
+
+
+@images_command.command('build')
+@click.argument('filenames', nargs=-1)
+@click.option('--prune', is_flag=True, help='Удалить из кэша файлы, не соответствующие текущим исходникам.')
+def images_build_command(filenames, prune):
+    """Строит все варианты изображений (всех в static/images или FILENAMES)."""
+    if not image_pipeline.enabled:
+        raise click.ClickException('Не установлен Pillow')
+    started = time.perf_counter()
+    sources = list(filenames or image_pipeline.sources())
+    generated = sum(image_pipeline.build(filename) for filename in sources)
+    click.echo(f"Исходников: {len(sources)}, построено файлов: {generated} "
+               f"за {time.perf_counter() - started:.1f} с")
+    if prune:
+        click.echo(f"Удалено устаревших: {image_pipeline.prune()}")
+
+
+@app.cli.group('analytics')
+def analytics_command():
+    """Сводки продаж для отчётов (база ANALYTICS_DATABASE)."""
+
+
+@analytics_command.command('refresh')
+@click.option('--rebuild', is_flag=True, help='Построить сводки заново по всем заказам.')
+def analytics_refresh_command(rebuild):
+    """Применяет изменения заказов с прошлого обновления."""
+    started = time.perf_counter()
+    target = analytics.connect(ANALYTICS_DATABASE)
+    conn = db_pool.acquire()
+    try:
+        count = analytics.rebuild(conn, target) if rebuild else analytics.refresh(conn, target)
+    finally:
+        db_pool.release(conn)
+        target.close()
+    click.echo(f"Обработано заказов: {count} за {time.perf_counter() - started:.1f} с")
+
+
+@analytics_command.command('report')
+@click.option('--start', help='Начало периода YYYY-MM-DD (по умолчанию — 30 дней до конца).')
+@click.option('--end', help='Конец периода YYYY-MM-DD (по умолчанию — сегодня).')
+@click.option('--status', 'statuses', multiple=True, help='Учитывать только заказы в этих статусах.')
+@click.option('--grain', type=click.Choice(analytics.GRAINS), help='Разрез динамики выручки.')
+@click.option('--top', type=int, default=10, show_default=True, help='Сколько товаров показать.')
+def analytics_report_command(start, end, statuses, grain, top):
+    """Печатает отчёт о продажах за период по сводкам."""
+    try:
+        start, end = analytics.parse_period(start, end)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    started = time.perf_counter()
+    conn = analytics.connect(ANALYTICS_DATABASE)
+    try:
+        totals = analytics.totals(conn, start, end, statuses)
+        series = analytics.series(conn, grain, start, end, statuses) if grain else []
+        products = analytics.top_products(conn, start, end, statuses, limit=top)
+        categories = analytics.by_category(conn, start, end, statuses)
+    finally:
+        conn.close()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    click.echo(f"Период {start} — {end}: выручка {totals['revenue']:.2f} ₽, "
+               f"заказов {totals['orders']}, штук {totals['units']}")
+    for point in series:
+        click.echo(f"  {point['bucket']:<14} {point['revenue']:>14.2f} ₽ {point['orders']:>8} заказов")
+    click.echo("Товары:")
+    for row in products:
+        click.echo(f"  {row['name'][:40]:<40} {row['revenue']:>14.2f} ₽ {row['units']:>8} шт")
+    click.echo("Категории:")
+    for row in categories:
+        click.echo(f"  {row['name'][:40]:<40} {row['revenue']:>14.2f} ₽ {row['units']:>8} шт")
+    click.echo(f"Отчёт построен за {elapsed_ms:.1f} мс", err=True)
+
+
+@analytics_command.command('export')
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'npz']), help='По умолчанию — по расширению.')
+def analytics_export_command(path, fmt):
+    """Выгружает позиции учтённых заказов по столбцам (npz для numpy) или в CSV ('-' — stdout)."""
+    fmt = fmt or ('npz' if path.endswith('.npz') else 'csv')
+    if fmt == 'npz' and analytics.numpy is None:
+        raise click.ClickException('Для формата npz нужен numpy, используйте --format csv')
+    started = time.perf_counter()
+    conn = analytics.connect(ANALYTICS_DATABASE)
+    try:
+        if fmt == 'npz':
+            count = analytics.export_npz(conn, path)
+        elif path == '-':
+            count = analytics.export_csv(conn, click.get_text_stream('stdout'))
+        else:
+            with open(path, 'w', newline='', encoding='utf-8') as stream:
+                count = analytics.export_csv(conn, stream)
+    finally:
+        conn.close()
+    click.echo(f"Выгружено строк: {count} за {time.perf_counter() - started:.1f} с", err=True)
+
+
+@app.cli.group('recommendations')
+def recommendations_command():
+    """Рекомендации «с этим товаром покупают»."""
+
+
+@recommendations_command.command('build')
+@click.option('--batch-size', type=int, default=20000, show_default=True, help='Заказов в одной порции.')
+def recommendations_build_command(batch_size):
+    """Строит матрицу совместных покупок и списки соседей заново."""
+    stats = recommender.build(batch_size)
+    click.echo(f"Заказов: {stats['orders']}, товаров: {stats['products']}, пар: {stats['pairs']}, "
+               f"соседей: {stats['neighbors']}, база {stats['bytes'] / 1048576:.1f} МБ за {stats['seconds']} с")
+
+
+@recommendations_command.command('refresh')
+def recommendations_refresh_command():
+    """Добавляет новые заказы и пересчитывает соседей затронутых товаров."""
+    started = time.perf_counter()
+    added = recommender.refresh()
+    click.echo(f"Новых заказов: {added} за {time.perf_counter() - started:.1f} с")
+
+
+@recommendations_command.command('show')
+@click.argument('product_id', type=int)
+def recommendations_show_command(product_id):
+    """Печатает соседей товара."""
+    conn = db_pool.acquire()
+    try:
+        rows = conn.execute("""
+            SELECT r.rank, r.neighbor_id, p.name, r.score
+            FROM product_recommendations r LEFT JOIN products p ON p.id = r.neighbor_id
+            WHERE r.product_id = ? ORDER BY r.rank
+        """, (product_id,)).fetchall()
+    finally:
+        db_pool.release(conn)
+    for rank, neighbor_id, name, score in rows:
+        click.echo(f"{rank:>3}. #{neighbor_id:<8} {score:.3f}  {name or ''}")
+
+
+@app.cli.group('catalog')
+def catalog_command():
+    """Потоковый импорт и экспорт каталога (CSV / JSONL)."""
+
+
+@catalog_command.command('import')
+@click.argument('path')
+@click.option('--table', type=click.Choice(['products', 'categories']), default='products')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='По умолчанию — по расширению.')
+@click.option('--chunk-size', type=int, default=5000, show_default=True, help='Строк в одной транзакции.')
+@click.option('--bulk', is_flag=True,
+              help='Отложить индексы и FTS до конца загрузки (для больших партий новых товаров).')
+def catalog_import_command(path, table, fmt, chunk_size, bulk):
+    """Загружает строки из файла (или '-' — stdin) в products/categories."""
+    from catalog_io import ImportFormatError, detect_format, import_rows, open_stream, read_rows
+    fmt = fmt or ('csv' if path == '-' else detect_format(path))
+    reported = [0.0]
+
+    def progress(stats):
+        if stats['seconds'] - reported[0] >= 1:
+            reported[0] = stats['seconds']
+            click.echo(f"  {stats['rows']} строк, {stats['rows'] / stats['seconds']:.0f} строк/с", err=True)
+
+    conn = db_pool.acquire()
+    try:
+        with open_stream(path) as stream:
+            stats = import_rows(conn, table, read_rows(stream, fmt), chunk_size, bulk, progress)
+    except ImportFormatError as e:
+        raise click.ClickException(str(e))
+    finally:
+        db_pool.release(conn)
+
+    rate = stats['rows'] / stats['seconds'] if stats['seconds'] else 0
+    click.echo(f"Строк: {stats['rows']}, записано: {stats['written']}, не найдено: {stats['not_found']}, "
+               f"отклонено: {stats['rejected']} за {stats['seconds']:.1f} с ({rate:.0f} строк/с)")
+    if stats['rejected']:
+        raise SystemExit(1)
+
+
+@catalog_command.command('export')
+@click.argument('path')
+@click.option('--table', type=click.Choice(['products', 'categories']), default='products')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='По умолчанию — по расширению.')
+def catalog_export_command(path, table, fmt):
+    """Выгружает products/categories в файл (или '-' — stdout)."""
+    from catalog_io import ImportFormatError, detect_format, export_rows, open_stream
+    try:
+        fmt = fmt or ('csv' if path == '-' else detect_format(path))
+    except ImportFormatError as e:
+        raise click.ClickException(str(e))
+
+    started = time.perf_counter()
+    conn = db_pool.acquire()
+    try:
+        with open_stream(path, 'w') as stream:
+            count = export_rows(conn, table, stream, fmt)
+    finally:
+        db_pool.release(conn)
+    elapsed = time.perf_counter() - started
+    click.echo(f"Выгружено строк: {count} за {elapsed:.1f} с", err=True)
+
+
 if __name__ == '__main__':
     # Проверка прав доступа к файлу БД
     if os.path.exists(DATABASE):
@@ -505,4 +2222,12 @@ if __name__ == '__main__':
         logger.info(f"Права доступа к БД: {access}")
         init_db()
 
-    app.run(debug=True, port=5000, use_reloader=False)
\ No newline at end of file
+    if job_worker.threads > 0:
+        job_worker.start()
+        reservation_sweeper.start()
+        analytics_refresher.start()
+        recommendation_refresher.start()
+
+    # Сервер разработки. Для боевого режима — serve.py (несколько воркеров)
+    app.run(debug=os.environ.get('FLASK_DEBUG', '1') == '1', port=int(os.environ.get('PORT', 5000)),
+            threaded=True, use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,135 @@
+"""
+Отчёты о продажах: сводки против запросов к основной базе.
+
+Строит сводки (analytics.py) по базе с заказами за год и --queries раз
+строит годовой отчёт (итоги, выручка по месяцам, топ товаров, категории,
+статусы) двумя способами: по сводкам и запросами GROUP BY к orders
+и order_items. Итоги обоих способов сверяются. Затем меняет статус
+--changes заказов (как при оплате) и замеряет инкрементное обновление
+сводок по журналу order_changes.
+
+Запуск:
+    python bench/analytics_reports.py --orders 200000 --order-items 1000000
+"""
+
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+import analytics
+from run import summarize
+
+
+def rollup_report(conn, start, end):
+    return {
+        'totals': analytics.totals(conn, start, end),
+        'series': analytics.series(conn, 'month', start, end),
+        'products': analytics.top_products(conn, start, end, limit=10),
+        'categories': analytics.by_category(conn, start, end),
+        'statuses': analytics.by_status(conn, start, end),
+    }
+
+
+def sql_report(conn, start, end):
+    """
+    Тот же отчёт запросами к основной базе.
+    """
+    period = "o.order_date >= ? AND o.order_date < ?"
+    params = (start.isoformat(), (end + timedelta(days=1)).isoformat())
+    lines = f"FROM orders o JOIN order_items oi ON oi.order_id = o.id WHERE {period}"
+    measures = "ROUND(SUM(oi.quantity * oi.price), 2), SUM(oi.quantity), COUNT(DISTINCT o.id)"
+    return {
+        'totals': conn.execute(f"SELECT {measures} {lines}", params).fetchone(),
+        'series': conn.execute(f"SELECT substr(o.order_date, 1, 7), {measures} {lines} GROUP BY 1", params).fetchall(),
+        'products': conn.execute(f"SELECT oi.product_id, {measures} {lines} GROUP BY 1 ORDER BY 2 DESC LIMIT 10",
+                                 params).fetchall(),
+        'categories': conn.execute(f"""
+            SELECT p.category_id, {measures}
+            FROM orders o JOIN order_items oi ON oi.order_id = o.id JOIN products p ON p.id = oi.product_id
+            WHERE {period} GROUP BY 1
+        """, params).fetchall(),
+        'statuses': conn.execute(f"SELECT o.status, {measures} {lines} GROUP BY 1", params).fetchall(),
+    }
+
+
+def same_statuses(report, expected):
+    """
+    Совпадают ли выручка и штуки по статусам (с точностью до копеек округления).
+    """
+    got = {row['status']: (row['revenue'], row['units']) for row in report['statuses']}
+    want = {status: (revenue, units) for status, revenue, units, _ in expected['statuses']}
+    return got.keys() == want.keys() and all(
+        abs(got[status][0] - want[status][0]) < 0.05 and got[status][1] == want[status][1] for status in got)
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--orders', type=int, default=100000, help='заказов во временной базе')
+    parser.add_argument('--order-items', type=int, default=500000, help='позиций заказов во временной базе')
+    parser.add_argument('--queries', type=int, default=20, help='сколько раз строить отчёт')
+    parser.add_argument('--changes', type=int, default=1000, help='заказов со сменой статуса')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='toy_store_bench_')
+    database = args.db
+    if not database:
+        import seed
+        database = os.path.join(directory, 'toy_store.db')
+        print(f"Генерация базы {database}")
+        seed.seed(database, products=5000, users=1000, orders=args.orders, order_items=args.order_items)
+
+    logging.disable(logging.CRITICAL)
+    rnd = random.Random(args.seed)
+    conn = sqlite3.connect(database)
+    target = analytics.connect(os.path.join(directory, 'analytics.db'))
+    count, elapsed = timed(analytics.rebuild, conn, target)
+    print(f"Построение сводок: {count} заказов за {elapsed:.1f} с")
+
+    end = date.today()
+    start = end - timedelta(days=364)
+    rollup_times, sql_times = [], []
+    for _ in range(args.queries):
+        report, elapsed = timed(rollup_report, target, start, end)
+        rollup_times.append(elapsed)
+        expected, elapsed = timed(sql_report, conn, start, end)
+        sql_times.append(elapsed)
+    if not same_statuses(report, expected):
+        sys.exit("Расхождение сводок и запросов к основной базе")
+
+    print(f"\nГодовой отчёт {start} — {end}")
+    print(f"{'':<12}{'запросов':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for name, times in (('сводки', rollup_times), ('GROUP BY', sql_times)):
+        r = summarize(times, sum(times), 0)
+        print(f"{name:<12}{r['requests']:>10}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+
+    ids = [row[0] for row in conn.execute("SELECT id FROM orders WHERE status = 'Создан'")]
+    changed = rnd.sample(ids, min(args.changes, len(ids)))
+    with conn:
+        conn.executemany("UPDATE orders SET status = 'Оплачен' WHERE id = ?", [(order_id,) for order_id in changed])
+    count, elapsed = timed(analytics.refresh, conn, target)
+    if not same_statuses(rollup_report(target, start, end), sql_report(conn, start, end)):
+        sys.exit("Расхождение сводок после обновления")
+    print(f"\nОбновление по журналу ({count} заказов): {elapsed * 1000:.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
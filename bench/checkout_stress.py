@@ -0,0 +1,108 @@
+"""
+Нагрузочная проверка оформления заказа.
+
+Создаёт временную базу через init_db.init_db(), выставляет заданный остаток
+одного товара и из множества потоков одновременно оформляет заказы на него.
+В конце проверяет, что товар не продан сверх остатка (нет oversell), и
+выводит пропускную способность checkout.
+
+Запуск:
+    python bench/checkout_stress.py --threads 16 --orders 50 --stock 100
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def prepare_database(path, product_id, stock):
+    import init_db
+    init_db.init_db(path)
+    import sqlite3
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE products SET stock_quantity = ? WHERE id = ?", (stock, product_id))
+    conn.commit()
+    last_order_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+    conn.close()
+    return last_order_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16, help='число параллельных покупателей')
+    parser.add_argument('--orders', type=int, default=50, help='попыток оформления на поток')
+    parser.add_argument('--stock', type=int, default=100, help='начальный остаток товара')
+    parser.add_argument('--quantity', type=int, default=1, help='штук товара в одном заказе')
+    parser.add_argument('--product', type=int, default=4, help='id товара')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='toy_store_bench_')
+    database = os.path.join(workdir, 'toy_store.db')
+    last_order_id = prepare_database(database, args.product, args.stock)
+
+    os.environ['DATABASE'] = database
+    import app as store
+    logging.disable(logging.CRITICAL)
+
+    results = {'ok': 0, 'rejected': 0, 'errors': 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads)
+
+    def buyer(user_id):
+        client = store.app.test_client()
+        with client.session_transaction() as sess:
+            sess['loggedin'] = True
+            sess['user_id'] = user_id
+        barrier.wait()
+        for _ in range(args.orders):
+            client.post('/cart/update', data={'product_id': args.product, 'quantity': args.quantity})
+            response = client.post('/checkout')
+            location = response.headers.get('Location', '')
+            with lock:
+                if response.status_code == 302 and location.endswith('/orders'):
+                    results['ok'] += 1
+                elif response.status_code == 302:
+                    results['rejected'] += 1
+                else:
+                    results['errors'] += 1
+
+    threads = [threading.Thread(target=buyer, args=(i % 10 + 1,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    import sqlite3
+    conn = sqlite3.connect(database)
+    final_stock = conn.execute(
+        "SELECT stock_quantity FROM products WHERE id = ?", (args.product,)).fetchone()[0]
+    sold = conn.execute("""
+        SELECT COALESCE(SUM(quantity), 0) FROM order_items
+        WHERE product_id = ? AND order_id > ?
+    """, (args.product, last_order_id)).fetchone()[0]
+    conn.close()
+
+    attempts = args.threads * args.orders
+    print(f"Попыток оформления: {attempts} за {elapsed:.2f} с "
+          f"({attempts / elapsed:.0f} запросов/с)")
+    print(f"Успешно: {results['ok']}, отказано: {results['rejected']}, ошибок: {results['errors']}")
+    print(f"Остаток: {args.stock} -> {final_stock}, продано: {sold}")
+
+    assert final_stock >= 0, "остаток ушёл в минус"
+    assert sold == args.stock - final_stock, "списание не совпадает с позициями заказов"
+    assert sold == results['ok'] * args.quantity, "число заказов не совпадает со списанием"
+    assert sold <= args.stock, "продано больше, чем было на складе"
+    print("OK: перепродажи нет")
+
+
+if __name__ == '__main__':
+    main()
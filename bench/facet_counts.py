@@ -0,0 +1,144 @@
+"""
+Счётчики фасетов каталога: битовый индекс против GROUP BY.
+
+Строит FacetIndex по базе и для --queries случайных наборов фильтров
+считает число товаров по всем значениям всех фасетов двумя способами:
+counts() по битовым картам и запросами GROUP BY (по одному на фасет,
+с фильтрами остальных фасетов — так же, как считает индекс). Затем
+меняет остатки --changes товаров и замеряет инкрементное обновление
+индекса по журналу product_changes.
+
+Запуск:
+    python bench/facet_counts.py --products 100000 --queries 50
+"""
+
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from facets import AGE_BANDS, FACETS, PRICE_BUCKETS, FacetIndex, facet_sql
+from run import summarize
+
+
+def band_case(column, bands, inclusive):
+    """
+    CASE, переводящий значение столбца в группу (возраст, цена) на стороне SQL.
+    """
+    branches = []
+    for value, _, low, high in bands:
+        if high is None:
+            branches.append(f"WHEN {column} >= {low} THEN '{value}'")
+        else:
+            upper = f"{column} <= {high}" if inclusive else f"{column} < {high}"
+            branches.append(f"WHEN {column} >= {low} AND {upper} THEN '{value}'")
+    return f"CASE {' '.join(branches)} ELSE '{bands[0][0]}' END"
+
+
+# Выражение значения фасета для GROUP BY
+FACET_EXPRESSIONS = {
+    'category': "CAST(p.category_id AS TEXT)",
+    'manufacturer': "p.manufacturer",
+    'material': "p.material",
+    'age': band_case('p.age_min', AGE_BANDS, inclusive=True),
+    'price': band_case('p.price', PRICE_BUCKETS, inclusive=False),
+    'batteries': "CASE WHEN p.batteries_included THEN '1' ELSE '0' END",
+}
+
+
+def random_selection(rnd, index):
+    """
+    Случайный выбор: 0–3 фасета, в каждом 1–2 значения.
+    """
+    counts = index.counts({})
+    selected = {}
+    for name, _ in rnd.sample(FACETS, rnd.randint(0, 3)):
+        values = list(counts[name])
+        selected[name] = rnd.sample(values, min(len(values), rnd.randint(1, 2)))
+    return selected
+
+
+def sql_counts(conn, selected):
+    """
+    Те же счётчики, что FacetIndex.counts(), запросами к базе.
+    """
+    result = {}
+    for name, _ in FACETS:
+        query = f"SELECT {FACET_EXPRESSIONS[name]}, COUNT(*) FROM products p WHERE p.stock_quantity > 0"
+        params = []
+        for other, values in selected.items():
+            condition, condition_params = facet_sql(other, values)
+            if other != name and condition:
+                query += f" AND {condition}"
+                params += condition_params
+        result[name] = dict(conn.execute(f"{query} GROUP BY 1", params).fetchall())
+    return result
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--products', type=int, default=100000, help='товаров во временной базе')
+    parser.add_argument('--queries', type=int, default=50, help='наборов фильтров')
+    parser.add_argument('--changes', type=int, default=1000, help='товаров с изменённым остатком')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    database = args.db
+    if not database:
+        import seed
+        database = os.path.join(tempfile.mkdtemp(prefix='toy_store_bench_'), 'toy_store.db')
+        print(f"Генерация базы {database}")
+        seed.seed(database, products=args.products, users=100, orders=100, order_items=100)
+
+    logging.disable(logging.CRITICAL)
+    rnd = random.Random(args.seed)
+    conn = sqlite3.connect(database)
+    index = FacetIndex(refresh_interval=0)
+    _, build = timed(index.rebuild, conn)
+    print(f"Построение индекса: {build * 1000:.0f} мс, товаров в наличии: {index.stats()['products']}")
+
+    bitmap_times, sql_times = [], []
+    for _ in range(args.queries):
+        selected = random_selection(rnd, index)
+        expected, elapsed = timed(sql_counts, conn, selected)
+        sql_times.append(elapsed)
+        result, elapsed = timed(index.counts, selected)
+        bitmap_times.append(elapsed)
+        if result != expected:
+            sys.exit(f"Расхождение счётчиков для {selected}")
+
+    print(f"\n{'':<12}{'запросов':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for name, times in (('индекс', bitmap_times), ('GROUP BY', sql_times)):
+        r = summarize(times, sum(times), 0)
+        print(f"{name:<12}{r['requests']:>10}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+
+    ids = [row[0] for row in conn.execute("SELECT id FROM products")]
+    changed = rnd.sample(ids, min(args.changes, len(ids)))
+    with conn:
+        conn.executemany("UPDATE products SET stock_quantity = CASE WHEN stock_quantity > 0 THEN 0 ELSE 10 END "
+                         "WHERE id = ?", [(product_id,) for product_id in changed])
+    _, elapsed = timed(index.refresh, conn, True)
+    if index.counts({}) != sql_counts(conn, {}):
+        sys.exit("Расхождение счётчиков после обновления")
+    print(f"\nОбновление по журналу ({len(changed)} товаров): {elapsed * 1000:.1f} мс, "
+          f"перестроений: {index.stats()['rebuilds'] - 1}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Распродажа одного товара с малым остатком.
+
+Поднимает многопоточный WSGI-сервер werkzeug с app.py. --buyers
+покупателей одновременно кладут в корзину один и тот же товар
+(по умолчанию «Дрон DJI Mavic», остаток --stock) и повторяют попытку
+--attempts раз, как при обновлении страницы; затем все оформляют заказ.
+Резерв получают ровно stock покупателей, и все их заказы проходят —
+остальные узнают об отсутствии товара ещё при добавлении в корзину.
+
+Замер повторяется дважды: без кэша остатков в памяти (RESERVATION_RECHECK=0,
+каждая попытка — транзакция записи) и с ним (отказы по исчерпанному
+товару не доходят до базы).
+
+Запуск:
+    python bench/flash_sale.py --buyers 100 --attempts 5 --stock 3
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from run import BENCH_PASSWORD, HttpClient, sample_users, summarize
+
+PRODUCT_NAME = 'Дрон DJI Mavic'
+
+
+def reset(database, product_id, stock):
+    """
+    Возвращает остаток товара и удаляет резервы, корзины и заказы прошлого замера.
+    """
+    conn = sqlite3.connect(database)
+    with conn:
+        conn.execute("UPDATE products SET stock_quantity = ? WHERE id = ?", (stock, product_id))
+        conn.execute("DELETE FROM stock_reservations")
+        conn.execute("DELETE FROM cart_items")
+    last_order = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+    conn.close()
+    return last_order
+
+
+def run_phase(base_url, clients, product_id, attempts):
+    """
+    Все клиенты одновременно добавляют товар attempts раз, затем оформляют заказ.
+    Возвращает (задержки добавления, {исход оформления: количество}).
+    """
+    latencies, outcomes = [], {}
+    lock = threading.Lock()
+    ready = threading.Barrier(len(clients))
+
+    def buyer(client):
+        local = []
+        ready.wait()
+        for _ in range(attempts):
+            started = time.perf_counter()
+            client.open('/cart/update', 'POST', {'product_id': product_id, 'quantity': 1})
+            local.append(time.perf_counter() - started)
+        ready.wait()
+        status = client.open('/checkout', 'POST', {})
+        with lock:
+            latencies.extend(local)
+            outcomes[status] = outcomes.get(status, 0) + 1
+
+    threads = [threading.Thread(target=buyer, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--buyers', type=int, default=100, help='одновременных покупателей')
+    parser.add_argument('--attempts', type=int, default=5, help='попыток добавления на покупателя')
+    parser.add_argument('--stock', type=int, default=3, help='остаток товара')
+    args = parser.parse_args()
+
+    database = args.db
+    if not database:
+        import seed
+        database = os.path.join(tempfile.mkdtemp(prefix='toy_store_bench_'), 'toy_store.db')
+        print(f"Генерация базы {database}")
+        seed.seed(database, products=1000, users=max(200, args.buyers * 2), orders=args.buyers * 4,
+                  order_items=args.buyers * 8)
+
+    os.environ['DATABASE'] = database
+    os.environ['AUTH_RATE_LIMIT'] = '0'
+    import app as store
+    from werkzeug.serving import make_server
+    logging.disable(logging.CRITICAL)
+    store.init_db()
+
+    conn = sqlite3.connect(database)
+    product_id = conn.execute("SELECT id FROM products WHERE name = ?", (PRODUCT_NAME,)).fetchone()[0]
+    conn.close()
+    users = sample_users(database, args.buyers)
+    if len(users) < args.buyers:
+        sys.exit(f"В базе только {len(users)} пользователей с заказами")
+
+    server = make_server('127.0.0.1', 0, store.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    rows = []
+    try:
+        clients = []
+        for user in users:
+            client = HttpClient(base_url)
+            client.open('/login', 'POST', {'email': user['email'], 'password': BENCH_PASSWORD})
+            clients.append(client)
+
+        for name, recheck in (('без кэша', 0.0), ('с кэшем', 1.0)):
+            last_order = reset(database, product_id, args.stock)
+            store.reservations.gate.recheck = recheck
+            store.reservations.gate.forget([product_id])
+            before = store.reservations.stats()
+            started = time.perf_counter()
+            latencies, outcomes = run_phase(base_url, clients, product_id, args.attempts)
+            elapsed = time.perf_counter() - started
+            after = store.reservations.stats()
+
+            conn = sqlite3.connect(database)
+            stock = conn.execute("SELECT stock_quantity FROM products WHERE id = ?", (product_id,)).fetchone()[0]
+            sold = conn.execute("SELECT COALESCE(SUM(quantity), 0) FROM order_items "
+                                "WHERE product_id = ? AND order_id > ?", (product_id, last_order)).fetchone()[0]
+            orders = conn.execute("SELECT COUNT(*) FROM orders WHERE id > ?", (last_order,)).fetchone()[0]
+            conn.close()
+            if stock < 0 or sold != args.stock - stock or sold > args.stock:
+                sys.exit(f"Перепродажа: остаток {stock}, продано {sold}")
+            if orders != args.stock:
+                sys.exit(f"Заказов {orders}, ожидалось {args.stock}: резерв не довёл покупателя до заказа")
+            rows.append((name, summarize(latencies, elapsed, 0), {
+                key: after[key] - before[key] for key in ('granted', 'rejected', 'absorbed')}, orders))
+    finally:
+        server.shutdown()
+        store.password_hasher.shutdown()
+
+    print(f"\nПокупателей: {args.buyers}, попыток добавления: {args.buyers * args.attempts}, остаток: {args.stock}")
+    print(f"{'':<10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'резервов':>10}{'отказов БД':>12}"
+          f"{'в памяти':>10}{'заказов':>9}")
+    for name, r, counts, orders in rows:
+        print(f"{name:<10}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{counts['granted']:>10}{counts['rejected']:>12}{counts['absorbed']:>10}{orders:>9}")
+    print("OK: перепродажи нет, каждый резерв стал заказом")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Вес изображений на странице каталога: исходники против производных.
+
+Создаёт --images синтетических фотографий --width пикселей в отдельном
+каталоге, строит для них производные ImagePipeline и сравнивает суммарный
+объём, который браузер загрузит для страницы из --per-page карточек:
+исходники целиком, вариант card в JPEG и в WebP. Также замеряет
+время отдачи одного изображения через Flask test client: исходник
+статическим обработчиком и готовая производная маршрутом /img.
+
+Запуск:
+    python bench/image_weight.py --images 24 --width 2400
+"""
+
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from run import summarize
+
+
+def make_photos(directory, count, width, rnd):
+    """
+    Синтетические «фотографии»: градиент с шумом (сжимается как снимок, а не как заливка).
+    """
+    from PIL import Image, ImageFilter
+    height = width * 3 // 4
+    names = []
+    for n in range(count):
+        small = Image.new('RGB', (64, 48))
+        small.putdata([(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for _ in range(64 * 48)])
+        image = small.resize((width, height), Image.BICUBIC).filter(ImageFilter.GaussianBlur(2))
+        noise = Image.effect_noise((width, height), 24).convert('RGB')
+        image = Image.blend(image, noise, 0.15)
+        name = f"photo_{n}.jpg"
+        image.save(os.path.join(directory, name), 'JPEG', quality=92)
+        names.append(name)
+    return names
+
+
+def timed_get(client, url, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        response = client.get(url)
+        response.get_data()
+        times.append(time.perf_counter() - started)
+        response.close()
+    return summarize(times, sum(times), 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=24, help='изображений (карточек на странице)')
+    parser.add_argument('--width', type=int, default=2400, help='ширина исходника, px')
+    parser.add_argument('--repeat', type=int, default=200, help='запросов на замер времени отдачи')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='toy_store_images_')
+    source_dir = os.path.join(workdir, 'images')
+    os.makedirs(source_dir)
+    os.environ['IMAGE_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    # Маленькая отдельная база: приложению нужна схема, но не данные
+    import seed
+    os.environ['DATABASE'] = os.path.join(workdir, 'toy_store.db')
+    seed.seed(os.environ['DATABASE'], products=10, users=10, orders=10, order_items=10, verbose=False)
+    logging.disable(logging.CRITICAL)
+    try:
+        import app as store
+        store.init_db()
+        pipeline = store.image_pipeline
+        if not pipeline.enabled:
+            sys.exit("Нужен Pillow")
+        pipeline.source_dir = source_dir
+        names = make_photos(source_dir, args.images, args.width, random.Random(args.seed))
+
+        started = time.perf_counter()
+        for name in names:
+            pipeline.build(name)
+        print(f"Производные для {len(names)} изображений построены за {time.perf_counter() - started:.1f} с")
+
+        def total(paths):
+            return sum(os.path.getsize(path) for path in paths) / 1024
+
+        original = total(os.path.join(source_dir, name) for name in names)
+        card_jpg = total(pipeline.render(name, 'card', 'jpg') for name in names)
+        card_webp = total(pipeline.render(name, 'card', 'webp') for name in names)
+        print(f"\nСтраница из {len(names)} карточек, КБ:")
+        print(f"  исходники {args.width}px: {original:>10.0f}")
+        print(f"  card JPEG:          {card_jpg:>10.0f}  ({card_jpg / original:.1%})")
+        print(f"  card WebP:          {card_webp:>10.0f}  ({card_webp / original:.1%})")
+
+        # Отдача через приложение: исходник кладётся в static/images на время замера
+        static_name = f"bench_{os.getpid()}.jpg"
+        static_path = os.path.join(store.BASE_DIR, 'static', 'images', static_name)
+        shutil.copy(os.path.join(source_dir, names[0]), static_path)
+        pipeline.source_dir = os.path.join(store.BASE_DIR, 'static', 'images')
+        try:
+            client = store.app.test_client()
+            with store.app.test_request_context():
+                derived = store.image_url(static_name, 'card', 'webp')
+            client.get(derived).close()
+            rows = (('исходник /static', timed_get(client, f'/static/images/{static_name}', args.repeat)),
+                    ('card WebP /img', timed_get(client, derived, args.repeat)))
+        finally:
+            os.unlink(static_path)
+        print(f"\n{'':<18}{'запросов':>10}{'p50 мс':>10}{'p95 мс':>10}")
+        for name, r in rows:
+            print(f"{name:<18}{r['requests']:>10}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Задержка каталога во время «шторма» попыток входа.
+
+Поднимает многопоточный WSGI-сервер werkzeug с app.py и дважды измеряет
+задержку главной страницы и карточки товара: сначала без фоновой нагрузки,
+затем пока --stormers потоков непрерывно отправляют POST /login
+с неверным паролем. Хэширование идёт в пуле процессов PasswordHasher,
+поэтому p95 каталога во втором замере не должен сильно вырасти.
+
+Ограничение частоты по умолчанию выключено, чтобы шторм доходил до
+хэширования; с --rate-limit лишние попытки отсекаются кодом 429.
+
+Запуск:
+    python bench/login_storm.py --clients 8 --stormers 16 --duration 5
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from run import HttpClient, sample_users, summarize
+
+CATALOG_PAGES = ['/', '/product/{product_id}']
+
+
+def run_phase(base_url, pages, clients, duration, stormers, emails):
+    """
+    Нагружает каталог clients потоками в течение duration секунд,
+    параллельно отправляя попытки входа из stormers потоков.
+    Возвращает (сводку по каталогу, {код ответа /login: количество}).
+    """
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def reader(n):
+        client = HttpClient(base_url)
+        local = []
+        while not stop.is_set():
+            started = time.perf_counter()
+            client.open(pages[n % len(pages)])
+            local.append(time.perf_counter() - started)
+            n += 1
+        with lock:
+            latencies.extend(local)
+
+    def stormer(n):
+        client = HttpClient(base_url)
+        while not stop.is_set():
+            status = client.open('/login', 'POST', {'email': emails[n % len(emails)], 'password': 'wrong'})
+            n += 1
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(clients)]
+    threads += [threading.Thread(target=stormer, args=(n,)) for n in range(stormers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies, time.perf_counter() - started, 0)
+    del result['queries_per_request']
+    return result, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--clients', type=int, default=8, help='потоков, читающих каталог')
+    parser.add_argument('--stormers', type=int, default=16, help='потоков, отправляющих попытки входа')
+    parser.add_argument('--duration', type=float, default=5.0, help='секунд на каждый замер')
+    parser.add_argument('--rate-limit', action='store_true', help='не отключать ограничение частоты входа')
+    args = parser.parse_args()
+
+    database = args.db
+    if not database:
+        import seed
+        database = os.path.join(tempfile.mkdtemp(prefix='toy_store_bench_'), 'toy_store.db')
+        print(f"Генерация базы {database}")
+        seed.seed(database, products=2000, users=200, orders=2000, order_items=10000)
+
+    os.environ['DATABASE'] = database
+    os.environ['AUTH_RATE_LIMIT'] = '1' if args.rate_limit else '0'
+    import app as store
+    from werkzeug.serving import make_server
+    logging.disable(logging.CRITICAL)
+    store.init_db()
+
+    users = sample_users(database, 50)
+    pages = [page.format(**users[0]) for page in CATALOG_PAGES]
+    emails = [user['email'] for user in users]
+
+    server = make_server('127.0.0.1', 0, store.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        quiet, _ = run_phase(base_url, pages, args.clients, args.duration, 0, emails)
+        storm, statuses = run_phase(base_url, pages, args.clients, args.duration, args.stormers, emails)
+    finally:
+        server.shutdown()
+        store.password_hasher.shutdown()
+
+    print(f"\n{'каталог':<12}{'запросов':>10}{'rps':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for name, r in (('без шторма', quiet), ('шторм', storm)):
+        print(f"{name:<12}{r['requests']:>10}{r['rps']:>10.1f}{r['p50_ms']:>10.2f}"
+              f"{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+    print("\nОтветы /login во время шторма: "
+          + ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+
+
+if __name__ == '__main__':
+    main()
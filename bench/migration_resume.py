@@ -0,0 +1,80 @@
+"""
+Проверка повтора прерванной миграции.
+
+Генерирует базу, возвращает её к версии 1 с обнулёнными итогами заказов
+(как до миграции 2) и применяет миграции, прерывая backfill итогов
+(KeyboardInterrupt) после первой порции. Повторный запуск migrate()
+должен дозаполнить итоги: проверяется find_order_total_mismatches().
+Заодно замеряет время полного повтора миграций 2..последней.
+
+Запуск:
+    python bench/migration_resume.py --orders 20000 --order-items 100000
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+import migrations
+from init_db import find_order_total_mismatches
+
+
+def interrupt_after_first_batch(conn):
+    """
+    Заполняет итоги первой порции заказов и прерывает миграцию.
+    """
+    with conn:
+        conn.execute(migrations.BACKFILL_ORDER_TOTALS + " WHERE id BETWEEN 1 AND ?", (migrations.BACKFILL_BATCH,))
+    raise KeyboardInterrupt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--orders', type=int, default=20000, help='заказов во временной базе')
+    parser.add_argument('--order-items', type=int, default=100000, help='позиций заказов во временной базе')
+    args = parser.parse_args()
+
+    import seed
+    database = os.path.join(tempfile.mkdtemp(prefix='toy_store_bench_'), 'toy_store.db')
+    seed.seed(database, products=1000, users=100, orders=args.orders, order_items=args.order_items, verbose=False)
+    logging.disable(logging.CRITICAL)
+
+    conn = sqlite3.connect(database)
+    with conn:
+        conn.execute("UPDATE orders SET total_amount = 0, item_count = 0")
+    migrations.set_version(conn, 1)
+    conn.commit()
+
+    totals = next(m for m in migrations.MIGRATIONS if m.version == 2)
+    backfill, totals.backfill = totals.backfill, interrupt_after_first_batch
+    try:
+        migrations.migrate(conn)
+        sys.exit("FAIL: backfill итогов не запущен — колонки уже есть, но версия 1")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        totals.backfill = backfill
+    print(f"Прервано на версии {migrations.get_version(conn)}, "
+          f"расхождений итогов: {len(find_order_total_mismatches(conn))}")
+
+    started = time.perf_counter()
+    migrations.migrate(conn)
+    elapsed = time.perf_counter() - started
+    mismatches = find_order_total_mismatches(conn)
+    print(f"Повтор: версия {migrations.get_version(conn)} за {elapsed:.1f} с, расхождений итогов: {len(mismatches)}")
+    if mismatches or migrations.get_version(conn) != migrations.LATEST_VERSION:
+        sys.exit("FAIL: прерванный backfill не дозаполнен")
+    print("OK: итоги заказов дозаполнены")
+
+
+if __name__ == '__main__':
+    main()
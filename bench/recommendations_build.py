@@ -0,0 +1,140 @@
+"""
+Рекомендации «с этим товаром покупают»: построение матрицы и выдача.
+
+Строит матрицу совместных покупок (recommendations.py) по базе
+с --order-items позициями заказов и печатает время построения, прирост
+пиковой памяти процесса (ru_maxrss) и размер базы матрицы. Затем
+добавляет --new-orders заказов и замеряет инкрементное обновление,
+сверяя пары с полным пересчётом, и --queries раз выбирает рекомендации
+для страницы товара.
+
+База генерируется в отдельном процессе, чтобы память генерации
+не попала в замер построения.
+
+Запуск:
+    python bench/recommendations_build.py --orders 200000 --order-items 1000000
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+import recommendations
+from run import summarize
+
+
+def generate(path, products, orders, order_items):
+    import seed
+    seed.seed(path, products=products, users=1000, orders=orders, order_items=order_items)
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def add_orders(conn, rnd, count, products):
+    """
+    Заказы покупателей с парой «любимых» товаров и случайным довеском.
+    """
+    users = [row[0] for row in conn.execute("SELECT id FROM users LIMIT 100")]
+    with conn:
+        for _ in range(count):
+            order_id = conn.execute("INSERT INTO orders (user_id, status) VALUES (?, 'Создан')",
+                                    (rnd.choice(users),)).lastrowid
+            basket = {rnd.randint(1, 50), rnd.randint(1, 50)} | set(rnd.sample(products, rnd.randint(0, 3)))
+            conn.executemany("INSERT INTO order_items (order_id, product_id, quantity, price) VALUES (?, ?, 1, 100)",
+                             [(order_id, product_id) for product_id in basket])
+
+
+def expected_pairs(conn, recommender, low):
+    """
+    Пары заказов с id от low прямым запросом к основной базе.
+    """
+    return dict(((a, b), n) for a, b, n in conn.execute("""
+        SELECT x.product_id, y.product_id, COUNT(*)
+        FROM order_items x JOIN order_items y ON y.order_id = x.order_id AND y.product_id != x.product_id
+        WHERE x.order_id IN (SELECT o.id FROM orders o WHERE o.id >= ? AND o.status != ?
+                             AND (SELECT COUNT(*) FROM order_items WHERE order_id = o.id) <= ?)
+        GROUP BY 1, 2
+    """, (low, recommendations.CANCELLED, recommender.max_lines)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--products', type=int, default=5000, help='товаров во временной базе')
+    parser.add_argument('--orders', type=int, default=200000, help='заказов во временной базе')
+    parser.add_argument('--order-items', type=int, default=1000000, help='позиций заказов во временной базе')
+    parser.add_argument('--batch-size', type=int, default=20000, help='заказов в порции построения')
+    parser.add_argument('--new-orders', type=int, default=1000, help='заказов для инкрементного обновления')
+    parser.add_argument('--queries', type=int, default=2000, help='выборок рекомендаций')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='toy_store_bench_')
+    database = args.db
+    if not database:
+        database = os.path.join(directory, 'toy_store.db')
+        print(f"Генерация базы {database}")
+        process = multiprocessing.get_context('spawn').Process(
+            target=generate, args=(database, args.products, args.orders, args.order_items))
+        process.start()
+        process.join()
+        if process.exitcode:
+            sys.exit("Не удалось сгенерировать базу")
+
+    logging.disable(logging.CRITICAL)
+    recommender = recommendations.Recommender(database, os.path.join(directory, 'recommendations.db'))
+    rss_before = peak_rss_mb()
+    stats = recommender.build(args.batch_size)
+    conn = sqlite3.connect(database)
+    lines = conn.execute("SELECT COUNT(*) FROM order_items").fetchone()[0]
+    print(f"\nПостроение по {stats['orders']} заказам ({lines} позиций): {stats['seconds']:.1f} с")
+    print(f"Пиковая память процесса: +{peak_rss_mb() - rss_before:.0f} МБ")
+    print(f"Матрица: {stats['products']} товаров, {stats['pairs']} пар, {stats['bytes'] / 1048576:.1f} МБ; "
+          f"соседей {stats['neighbors']}")
+
+    rnd = random.Random(args.seed)
+    products = [row[0] for row in conn.execute("SELECT id FROM products")]
+    low = conn.execute("SELECT MAX(id) FROM orders").fetchone()[0] + 1
+    before = expected_pairs(conn, recommender, 0)
+    add_orders(conn, rnd, args.new_orders, products)
+    started = time.perf_counter()
+    added = recommender.refresh()
+    elapsed = time.perf_counter() - started
+    matrix = recommender.connect()
+    got = dict(((a, b), n) for a, b, n in matrix.execute("SELECT product_id, other_id, orders FROM product_pairs"))
+    matrix.close()
+    for pair, count in expected_pairs(conn, recommender, low).items():
+        before[pair] = before.get(pair, 0) + count
+    if got != before:
+        sys.exit("Матрица после обновления расходится с пересчётом")
+    print(f"\nОбновление ({added} новых заказов): {elapsed * 1000:.1f} мс")
+
+    conn.row_factory = sqlite3.Row
+    users = [row[0] for row in conn.execute("SELECT id FROM users LIMIT 100")] + [None]
+    times, shown = [], 0
+    for _ in range(args.queries):
+        started = time.perf_counter()
+        shown += len(recommendations.related_products(conn, rnd.choice(products), rnd.choice(users)))
+        times.append(time.perf_counter() - started)
+    r = summarize(times, sum(times), 0)
+    print(f"\nРекомендации для страницы товара: {r['requests']} выборок, в среднем {shown / args.queries:.1f} товара")
+    print(f"p50 {r['p50_ms']:.3f} мс, p95 {r['p95_ms']:.3f} мс, p99 {r['p99_ms']:.3f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+"""
+Бенчмарк маршрутов app.py.
+
+Прогоняет каждый маршрут (index, product, cart, checkout, orders,
+order_details, pay_order) двумя способами:
+- test — последовательно через Flask test client (чистая стоимость обработчика);
+- wsgi — через настоящий многопоточный WSGI-сервер werkzeug и HTTP-клиентов
+  в нескольких потоках (конкурентная нагрузка).
+
+Для каждого маршрута выводит p50/p95/p99 задержки, пропускную способность
+и среднее число SQL-запросов на HTTP-запрос. Результаты можно сохранить
+как базовые (--save-baseline) и сравнивать с ними (--compare): рост p95
+больше допуска считается регрессией, и скрипт завершается с кодом 1.
+
+Запуск:
+    python bench/run.py --products 100000 --order-items 1000000
+    python bench/run.py --db /tmp/bench.db --mode wsgi --threads 8
+    python bench/run.py --compare bench/baseline.json
+"""
+
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+BENCH_PASSWORD = '123456'
+
+
+class QueryCounter:
+    """
+    Считает SQL-операторы, выполненные соединениями пула
+    (через sqlite3 trace callback), отдельно по endpoint запроса Flask —
+    так подготовительные запросы (например, добавление в корзину перед
+    checkout) не попадают в счёт измеряемого маршрута.
+    Операторы внутри триггеров приходят с префиксом '--' и не учитываются.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, statement):
+        from flask import has_request_context, request
+        if statement.startswith('--') or not has_request_context():
+            return
+        with self._lock:
+            self.counts[request.endpoint] = self.counts.get(request.endpoint, 0) + 1
+
+    def install(self, pool):
+        connect = pool._connect
+
+        def traced_connect():
+            conn = connect()
+            conn.set_trace_callback(self)
+            return conn
+
+        pool._connect = traced_connect
+        pool.close_all()
+
+    def take(self, endpoint):
+        """
+        Возвращает число операторов для endpoint и обнуляет все счётчики.
+        """
+        with self._lock:
+            count = self.counts.get(endpoint, 0)
+            self.counts = {}
+            return count
+
+
+def percentile(samples, p):
+    """
+    Процентиль методом ближайшего ранга (samples должны быть отсортированы).
+    """
+    if not samples:
+        return 0.0
+    index = max(0, min(len(samples) - 1, int(round(p / 100 * len(samples) + 0.5)) - 1))
+    return samples[index]
+
+
+def summarize(latencies, elapsed, queries):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    return {
+        'requests': n,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'rps': round(n / elapsed, 1) if elapsed else 0.0,
+        'queries_per_request': round(queries / n, 2) if n else 0.0,
+    }
+
+
+def sample_users(database, count):
+    """
+    Подбирает count пользователей, у которых есть непустые заказы,
+    и реальные id для маршрутов с параметрами: товар с большим остатком,
+    последний заказ пользователя, категория.
+    Возвращает список словарей (по одному на пользователя).
+    """
+    import sqlite3
+    conn = sqlite3.connect(database)
+    try:
+        product_id = conn.execute(
+            "SELECT id FROM products WHERE stock_quantity > 1000 ORDER BY id LIMIT 1").fetchone()[0]
+        category_id = conn.execute("SELECT id FROM categories LIMIT 1").fetchone()[0]
+        rows = conn.execute("""
+            SELECT u.id, u.email, MAX(o.id) FROM users u
+            JOIN orders o ON o.user_id = u.id AND o.item_count > 0
+            GROUP BY u.id ORDER BY u.id LIMIT ?
+        """, (count,)).fetchall()
+        return [{'user_id': user_id, 'email': email, 'order_id': order_id,
+                 'product_id': product_id, 'category_id': category_id}
+                for user_id, email, order_id in rows]
+    finally:
+        conn.close()
+
+
+# Маршруты: имя, endpoint Flask, метод, шаблон пути, данные формы и
+# (необязательно) подготовительный запрос, который выполняется перед
+# каждым замером и сам не измеряется. Шаблоны заполняются из sample_users().
+ADD_TO_CART = ('POST', '/cart/update', {'product_id': '{product_id}', 'quantity': 1})
+ROUTES = [
+    ('index', 'index', 'GET', '/', None, None),
+    ('index_filtered', 'index', 'GET', '/?category_id={category_id}&min_age=10&sort=price', None, None),
+    ('index_search', 'index', 'GET', '/?search=конструктор', None, None),
+    ('product', 'product', 'GET', '/product/{product_id}', None, None),
+    ('cart', 'cart', 'GET', '/cart', None, ADD_TO_CART),
+    ('checkout', 'checkout', 'POST', '/checkout', {}, ADD_TO_CART),
+    ('orders', 'orders', 'GET', '/orders', None, None),
+    ('order_details', 'order_details', 'GET', '/order/{order_id}', None, None),
+    ('pay_order', 'pay_order', 'GET', '/order/{order_id}/pay', None, None),
+]
+
+
+def fill(template, targets):
+    """
+    Подставляет id пользователя в шаблон пути или в данные формы.
+    """
+    if isinstance(template, dict):
+        return {key: fill(value, targets) for key, value in template.items()}
+    if isinstance(template, str):
+        return template.format(**targets)
+    return template
+
+
+def run_test_client(store, routes, targets, requests_per_route, counter):
+    """
+    Последовательный прогон через Flask test client.
+    """
+    client = store.app.test_client()
+    with client.session_transaction() as sess:
+        sess['loggedin'] = True
+        sess['user_id'] = targets['user_id']
+        sess['full_name'] = 'Bench'
+
+    results = {}
+    for name, endpoint, method, path, data, setup in routes:
+        path, data = fill(path, targets), fill(data, targets)
+        latencies = []
+        queries = 0
+        for _ in range(requests_per_route):
+            if setup:
+                client.open(fill(setup[1], targets), method=setup[0], data=fill(setup[2], targets))
+            counter.take(endpoint)
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            latencies.append(time.perf_counter() - started)
+            queries += counter.take(endpoint)
+            if response.status_code >= 400:
+                raise RuntimeError(f"{name}: HTTP {response.status_code}")
+        results[name] = summarize(latencies, sum(latencies), queries)
+    return results
+
+
+class HttpClient:
+    """
+    Минимальный HTTP-клиент с cookie и без следования редиректам.
+    """
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect())
+
+    def open(self, path, method='GET', data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        url = self.base_url + urllib.parse.quote(path, safe='/?&=')
+        request = urllib.request.Request(url, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+def run_wsgi(store, routes, users, requests_per_route, threads, counter):
+    """
+    Конкурентный прогон через многопоточный WSGI-сервер werkzeug.
+    Каждый поток входит под своим пользователем, чтобы корзины не пересекались.
+    """
+    from werkzeug.serving import make_server
+
+    server = make_server('127.0.0.1', 0, store.app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    clients = []
+    for n in range(threads):
+        targets = users[n % len(users)]
+        client = HttpClient(base_url)
+        client.open('/login', 'POST', {'email': targets['email'], 'password': BENCH_PASSWORD})
+        clients.append((client, targets))
+
+    results = {}
+    try:
+        for name, endpoint, method, path, data, setup in routes:
+            per_thread = max(1, requests_per_route // threads)
+            latencies = []
+            lock = threading.Lock()
+            errors = []
+
+            def worker(client, targets):
+                own_path, own_data = fill(path, targets), fill(data, targets)
+                local = []
+                for _ in range(per_thread):
+                    if setup:
+                        client.open(fill(setup[1], targets), setup[0], fill(setup[2], targets))
+                    started = time.perf_counter()
+                    status = client.open(own_path, method, own_data)
+                    local.append(time.perf_counter() - started)
+                    if status >= 400:
+                        errors.append(status)
+                with lock:
+                    latencies.extend(local)
+
+            counter.take(endpoint)
+            workers = [threading.Thread(target=worker, args=client) for client in clients]
+            started = time.perf_counter()
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            if errors:
+                raise RuntimeError(f"{name}: HTTP {errors[0]}")
+            results[name] = summarize(latencies, elapsed, counter.take(endpoint))
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_results(mode, results, baseline=None):
+    print(f"\n== {mode} ==")
+    print(f"{'маршрут':<16}{'запр.':>7}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}"
+          f"{'req/s':>10}{'SQL/req':>9}{'p95 vs база':>14}")
+    for name, r in results.items():
+        delta = ''
+        base = (baseline or {}).get(mode, {}).get(name)
+        if base and base['p95_ms']:
+            delta = f"{(r['p95_ms'] / base['p95_ms'] - 1) * 100:+.0f}%"
+        print(f"{name:<16}{r['requests']:>7}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['rps']:>10.1f}{r['queries_per_request']:>9.2f}{delta:>14}")
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Возвращает список (режим, маршрут, было, стало) для маршрутов,
+    у которых p95 вырос больше чем на tolerance (доля) относительно базы.
+    """
+    regressions = []
+    for mode, routes in results.items():
+        for name, r in routes.items():
+            base = baseline.get(mode, {}).get(name)
+            if base and base['requests'] and r['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+                regressions.append((mode, name, base['p95_ms'], r['p95_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--order-items', type=int, default=100000)
+    parser.add_argument('--mode', choices=['test', 'wsgi', 'both'], default='both')
+    parser.add_argument('--requests', type=int, default=200, help='запросов на маршрут')
+    parser.add_argument('--threads', type=int, default=8, help='потоков-клиентов в режиме wsgi')
+    parser.add_argument('--routes', help='через запятую: ограничить набор маршрутов')
+    parser.add_argument('--no-cache', action='store_true', help='отключить кэш каталога')
+    parser.add_argument('--save-baseline', metavar='PATH', help='сохранить результаты как базовые')
+    parser.add_argument('--compare', metavar='PATH', help='сравнить с базовыми результатами')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='допустимый рост p95 при сравнении (доля, по умолчанию 0.2)')
+    args = parser.parse_args()
+
+    database = args.db
+    if not database:
+        import seed
+        database = os.path.join(tempfile.mkdtemp(prefix='toy_store_bench_'), 'toy_store.db')
+        print(f"Генерация базы {database}")
+        seed.seed(database, args.products, args.users, args.orders, args.order_items)
+
+    os.environ['DATABASE'] = database
+    os.environ['AUTH_RATE_LIMIT'] = '0'
+    import app as store
+    logging.disable(logging.CRITICAL)
+    store.init_db()
+
+    if args.no_cache:
+        store.catalog_cache.max_size = 0
+
+    counter = QueryCounter()
+    counter.install(store.db_pool)
+
+    users = sample_users(database, args.threads)
+    routes = ROUTES
+    if args.routes:
+        selected = set(args.routes.split(','))
+        routes = [route for route in routes if route[0] in selected]
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    if args.mode in ('test', 'both'):
+        results['test'] = run_test_client(store, routes, users[0], args.requests, counter)
+        print_results('test', results['test'], baseline)
+    if args.mode in ('wsgi', 'both'):
+        results['wsgi'] = run_wsgi(store, routes, users, args.requests, args.threads, counter)
+        print_results('wsgi', results['wsgi'], baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nБазовые результаты сохранены в {args.save_baseline}")
+
+    if baseline:
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for mode, name, before, after in regressions:
+            print(f"РЕГРЕССИЯ [{mode}] {name}: p95 {before:.2f} -> {after:.2f} мс")
+        if regressions:
+            sys.exit(1)
+        print("\nРегрессий нет")
+
+
+if __name__ == '__main__':
+    main()
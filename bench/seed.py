@@ -0,0 +1,153 @@
+"""
+Генерация синтетической базы для бенчмарков.
+
+Схема создаётся тем же init_db.init_db(), что и рабочая база, после чего
+добавляются случайные (но воспроизводимые по --seed) товары, пользователи,
+заказы и позиции заказов в заданном количестве.
+
+Запуск:
+    python bench/seed.py --out /tmp/bench.db --products 100000 --order-items 1000000
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHUNK = 10000
+
+ADJECTIVES = ['Большой', 'Малый', 'Весёлый', 'Умный', 'Быстрый', 'Мягкий', 'Деревянный',
+              'Магнитный', 'Музыкальный', 'Светящийся', 'Классический', 'Делюкс']
+NOUNS = ['конструктор', 'робот', 'пазл', 'набор', 'поезд', 'замок', 'самолёт', 'кубик',
+         'динозавр', 'медведь', 'вертолёт', 'катер', 'танк', 'кукольный дом', 'квест']
+BRANDS = ['LEGO', 'Hasbro', 'Mattel', 'DJI', 'Gigo', 'Syma', 'Tegu', 'Asmodee', 'Disney',
+          'WLtoys', 'JJRC', 'Heng Long', 'MGA Entertainment', 'Giochi Preziosi', 'Magnetic']
+MATERIALS = ['Пластик', 'Дерево', 'Металл', 'Картон', 'Текстиль', 'Пластик/магнит', 'Дерево/магнит']
+STATUSES = ['Создан', 'Оплачен', 'В обработке', 'Отправлен', 'Доставлен', 'Отменен']
+
+
+def chunks(rows, size=CHUNK):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def seed(path, products=10000, users=1000, orders=20000, order_items=100000,
+         heavy_share=0.05, seed_value=42, verbose=True):
+    """
+    Создаёт базу по пути path и наполняет её синтетическими данными.
+    heavy_share — доля заказов, принадлежащих пользователю №1
+    («тяжёлый» покупатель для проверки постраничной истории заказов).
+    """
+    import init_db
+
+    rnd = random.Random(seed_value)
+    started = time.perf_counter()
+
+    init_db.init_db(path)
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+
+    category_ids = [row[0] for row in conn.execute("SELECT id FROM categories")]
+    base_product = conn.execute("SELECT MAX(id) FROM products").fetchone()[0]
+    base_user = conn.execute("SELECT MAX(id) FROM users").fetchone()[0]
+    base_order = conn.execute("SELECT MAX(id) FROM orders").fetchone()[0]
+    password_hash = conn.execute("SELECT password_hash FROM users WHERE id = 1").fetchone()[0]
+
+    def product_rows():
+        for n in range(products):
+            name = f"{rnd.choice(ADJECTIVES)} {rnd.choice(NOUNS)} {n}"
+            yield (name, f"{name} от {rnd.choice(BRANDS)} для детей и взрослых",
+                   round(rnd.uniform(199, 49999), 2), rnd.randint(1000, 100000),
+                   rnd.choice(category_ids), rnd.choice(BRANDS), rnd.choice(MATERIALS),
+                   rnd.randint(1, 16), rnd.random() < 0.2)
+
+    def user_rows():
+        for n in range(users):
+            yield (f"user{n}@bench.local", password_hash, f"Покупатель {n}",
+                   f"Город {n % 100}, ул. Тестовая, д.{n % 300}", None)
+
+    user_count = base_user + users
+    product_count = base_product + products
+
+    def order_rows():
+        for _ in range(orders):
+            user_id = 1 if rnd.random() < heavy_share else rnd.randint(1, user_count)
+            minutes = rnd.randint(0, 365 * 24 * 60)
+            yield (user_id, rnd.choice(STATUSES), f"-{minutes} minutes")
+
+    def item_rows():
+        # Позиции распределяются по заказам равномерно; товары внутри
+        # заказа не повторяются (UNIQUE (order_id, product_id))
+        per_order, extra = divmod(order_items, max(orders, 1))
+        for n in range(orders):
+            count = min(per_order + (1 if n < extra else 0), product_count)
+            for product_id in rnd.sample(range(1, product_count + 1), count):
+                yield (base_order + 1 + n, product_id, rnd.randint(1, 3),
+                       round(rnd.uniform(199, 49999), 2))
+
+    steps = [
+        ("товары", products, """
+            INSERT INTO products (name, description, price, stock_quantity, category_id,
+                                  manufacturer, material, age_min, batteries_included)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, product_rows()),
+        ("пользователи", users, """
+            INSERT INTO users (email, password_hash, full_name, address, phone)
+            VALUES (?, ?, ?, ?, ?)
+        """, user_rows()),
+        ("заказы", orders, """
+            INSERT INTO orders (user_id, status, order_date)
+            VALUES (?, ?, datetime('now', ?))
+        """, order_rows()),
+        ("позиции заказов", order_items, """
+            INSERT INTO order_items (order_id, product_id, quantity, price)
+            VALUES (?, ?, ?, ?)
+        """, item_rows()),
+    ]
+    for title, total, sql, rows in steps:
+        step_started = time.perf_counter()
+        for batch in chunks(rows):
+            with conn:
+                conn.executemany(sql, batch)
+        if verbose:
+            elapsed = time.perf_counter() - step_started
+            print(f"  {title}: {total} за {elapsed:.1f} с")
+
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    if verbose:
+        print(f"База {path} готова за {time.perf_counter() - started:.1f} с")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', required=True, help='путь к создаваемой базе')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--orders', type=int, default=20000)
+    parser.add_argument('--order-items', type=int, default=100000)
+    parser.add_argument('--heavy-share', type=float, default=0.05,
+                        help='доля заказов пользователя №1')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    seed(args.out, args.products, args.users, args.orders, args.order_items,
+         args.heavy_share, args.seed)
+
+
+if __name__ == '__main__':
+    main()
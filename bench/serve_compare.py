@@ -0,0 +1,162 @@
+"""
+Сравнение сервера разработки и боевого режима под конкурентной нагрузкой.
+
+Поочерёдно запускает в отдельных процессах:
+- dev — `python app.py` (встроенный сервер Flask с отладчиком);
+- serve — `python serve.py --workers N` (несколько воркеров с пулом потоков)
+и в течение --duration секунд нагружает каждый --clients клиентами,
+которые по кругу запрашивают страницы каталога, товара и заказов.
+Выводит пропускную способность, p50/p95/p99 и число ошибок.
+
+Запуск:
+    python bench/serve_compare.py --db /tmp/bench.db --clients 32 --workers 4
+"""
+
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from run import BENCH_PASSWORD, HttpClient, fill, sample_users, summarize
+
+# Страницы только на чтение: сравнивается именно обслуживание запросов,
+# а не конкуренция писателей за базу (для неё есть checkout_stress.py)
+PAGES = [
+    '/',
+    '/?category_id={category_id}&min_age=10&sort=price',
+    '/?search=конструктор',
+    '/product/{product_id}',
+    '/orders',
+    '/order/{order_id}',
+]
+
+
+def start_server(name, database, port, workers):
+    env = dict(os.environ, DATABASE=database, PORT=str(port), LOG_LEVEL='WARNING',
+               AUTH_RATE_LIMIT='0')
+    if name == 'dev':
+        command = [sys.executable, 'app.py']
+        env['FLASK_DEBUG'] = '1'
+    else:
+        command = [sys.executable, 'serve.py', '--workers', str(workers), '--port', str(port)]
+    process = subprocess.Popen(command, cwd=ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{name}: сервер завершился с кодом {process.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/login", timeout=1).read()
+            return process
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f"{name}: сервер не ответил за 30 с")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=35)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run_load(port, users, clients, duration):
+    """
+    Нагружает сервер clients потоками в течение duration секунд.
+    Каждый поток входит под своим пользователем.
+    """
+    base_url = f"http://127.0.0.1:{port}"
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    # Вход (хэширование пароля) не должен попадать в замер:
+    # отсчёт начинается, когда все клиенты вошли
+    ready = threading.Barrier(clients + 1)
+    stop_at = None
+
+    def worker(n):
+        targets = users[n % len(users)]
+        client = HttpClient(base_url)
+        client.open('/login', 'POST', {'email': targets['email'], 'password': BENCH_PASSWORD})
+        paths = itertools.cycle(fill(page, targets) for page in PAGES[n % len(PAGES):] + PAGES[:n % len(PAGES)])
+        ready.wait()
+        ready.wait()
+        local, failed = [], 0
+        while time.perf_counter() < stop_at:
+            started = time.perf_counter()
+            try:
+                status = client.open(next(paths))
+            except OSError:
+                status = 599
+            local.append(time.perf_counter() - started)
+            failed += status >= 400
+        with lock:
+            latencies.extend(local)
+            errors.append(failed)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    stop_at = started + duration
+    ready.wait()
+    for thread in threads:
+        thread.join()
+    result = summarize(latencies, time.perf_counter() - started, 0)
+    del result['queries_per_request']
+    result['errors'] = sum(errors)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--clients', type=int, default=32, help='одновременных клиентов')
+    parser.add_argument('--duration', type=float, default=10.0, help='секунд нагрузки на каждый сервер')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='воркеров serve.py')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--servers', default='dev,serve', help='через запятую: dev, serve')
+    args = parser.parse_args()
+
+    database = args.db
+    if not database:
+        import seed
+        database = os.path.join(tempfile.mkdtemp(prefix='toy_store_bench_'), 'toy_store.db')
+        print(f"Генерация базы {database}")
+        seed.seed(database)
+
+    users = sample_users(database, args.clients)
+    results = {}
+    for name in args.servers.split(','):
+        process = start_server(name, database, args.port, args.workers)
+        try:
+            results[name] = run_load(args.port, users, args.clients, args.duration)
+        finally:
+            stop_server(process)
+
+    print(f"\nКлиентов: {args.clients}, длительность: {args.duration:.0f} с, воркеров serve.py: {args.workers}")
+    print(f"{'сервер':<8}{'запросов':>10}{'rps':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'ошибок':>9}")
+    for name, r in results.items():
+        print(f"{name:<8}{r['requests']:>10}{r['rps']:>10.1f}{r['p50_ms']:>10.2f}"
+              f"{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}{r['errors']:>9}")
+    if 'dev' in results and 'serve' in results and results['dev']['rps']:
+        print(f"\nserve.py / dev: x{results['serve']['rps'] / results['dev']['rps']:.2f} по пропускной способности")
+
+
+if __name__ == '__main__':
+    main()
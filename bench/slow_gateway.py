@@ -0,0 +1,162 @@
+"""
+Оплата заказов при медленном платёжном шлюзе.
+
+Поднимает многопоточный WSGI-сервер werkzeug с app.py и шлюзом-заглушкой
+с задержкой --latency секунд на вызов (авторизация и списание — два вызова).
+--payers потоков оплачивают каждый по --orders своих заказов, а --clients
+потоков тем временем читают каталог. Шлюз вызывается вне транзакции
+и без соединения с базой, поэтому оплаты идут параллельно: «параллельность»
+(сумма времени оплат / длительность замера) близка к числу плательщиков,
+а задержка каталога не растёт вслед за шлюзом.
+
+Запуск:
+    python bench/slow_gateway.py --latency 0.5 --payers 16 --orders 5
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BENCH_DIR)
+
+from run import BENCH_PASSWORD, HttpClient, sample_users, summarize
+
+CATALOG_PAGES = ['/', '/product/{product_id}']
+
+
+def create_orders(store, users, count):
+    """
+    Создаёт по count неоплаченных заказов каждому пользователю.
+    Возвращает {user_id: [order_id, ...]}.
+    """
+    conn = store.db_pool.acquire()
+    try:
+        return {user['user_id']: [store.place_order(conn, user['user_id'], {user['product_id']: 1})
+                                  for _ in range(count)]
+                for user in users}
+    finally:
+        store.db_pool.release(conn)
+
+
+def run_phase(base_url, pages, clients, payers, orders):
+    """
+    Читает каталог clients потоками, пока payers потоков оплачивают
+    заказы orders ({email: [order_id, ...]}); без плательщиков —
+    фиксированные 3 секунды. Возвращает (сводку по каталогу,
+    сводку по оплатам, {код ответа оплаты: количество}).
+    """
+    catalog, paid, statuses = [], [], {}
+    lock = threading.Lock()
+    stop = threading.Event()
+    ready = threading.Barrier(payers + clients + 1)
+
+    def reader(n):
+        client = HttpClient(base_url)
+        local = []
+        ready.wait()
+        while not stop.is_set():
+            started = time.perf_counter()
+            client.open(pages[n % len(pages)])
+            local.append(time.perf_counter() - started)
+            n += 1
+        with lock:
+            catalog.extend(local)
+
+    def payer(email, order_ids):
+        client = HttpClient(base_url)
+        # Вход (хэширование пароля) в замер не входит
+        client.open('/login', 'POST', {'email': email, 'password': BENCH_PASSWORD})
+        ready.wait()
+        local = []
+        for order_id in order_ids:
+            started = time.perf_counter()
+            status = client.open(f'/order/{order_id}/pay', 'POST', {'method': 'Карта'})
+            local.append(time.perf_counter() - started)
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+        with lock:
+            paid.extend(local)
+
+    threads = [threading.Thread(target=reader, args=(n,)) for n in range(clients)]
+    paying = [threading.Thread(target=payer, args=item) for item in list(orders.items())[:payers]]
+    for thread in threads + paying:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    if paying:
+        for thread in paying:
+            thread.join()
+    else:
+        time.sleep(3)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    catalog_result = summarize(catalog, elapsed, 0)
+    payment_result = summarize(paid, elapsed, 0)
+    payment_result['concurrency'] = round(sum(paid) / elapsed, 2) if elapsed else 0.0
+    return catalog_result, payment_result, statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', help='готовая база (из bench/seed.py); иначе создаётся временная')
+    parser.add_argument('--latency', type=float, default=0.5, help='задержка шлюза на вызов, с')
+    parser.add_argument('--payers', type=int, default=16, help='одновременных плательщиков')
+    parser.add_argument('--orders', type=int, default=5, help='заказов на плательщика')
+    parser.add_argument('--clients', type=int, default=4, help='потоков, читающих каталог')
+    args = parser.parse_args()
+
+    database = args.db
+    if not database:
+        import seed
+        database = os.path.join(tempfile.mkdtemp(prefix='toy_store_bench_'), 'toy_store.db')
+        print(f"Генерация базы {database}")
+        seed.seed(database, products=2000, users=200, orders=2000, order_items=10000)
+
+    os.environ['DATABASE'] = database
+    os.environ['AUTH_RATE_LIMIT'] = '0'
+    os.environ['STUB_GATEWAY_LATENCY'] = str(args.latency)
+    os.environ['PAYMENT_GATEWAY_TIMEOUT'] = str(max(10.0, args.latency * 4))
+    import app as store
+    from werkzeug.serving import make_server
+    logging.disable(logging.CRITICAL)
+    store.init_db()
+
+    users = sample_users(database, args.payers)
+    pages = [page.format(**users[0]) for page in CATALOG_PAGES]
+    orders = create_orders(store, users, args.orders)
+    orders = {user['email']: orders[user['user_id']] for user in users}
+
+    server = make_server('127.0.0.1', 0, store.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        quiet, _, _ = run_phase(base_url, pages, args.clients, 0, {})
+        busy, payments, statuses = run_phase(base_url, pages, args.clients, args.payers, orders)
+    finally:
+        server.shutdown()
+        store.password_hasher.shutdown()
+
+    total = payments['requests']
+    print(f"\nШлюз: {args.latency:.2f} с на вызов, плательщиков: {args.payers}, оплат: {total}")
+    print(f"{'':<18}{'запросов':>10}{'rps':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}")
+    for name, r in (('каталог без оплат', quiet), ('каталог с оплатами', busy), ('оплата', payments)):
+        print(f"{name:<18}{r['requests']:>10}{r['rps']:>10.1f}{r['p50_ms']:>10.2f}"
+              f"{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}")
+    serial = total * 2 * args.latency
+    print(f"\nПараллельность оплат: {payments['concurrency']:.1f} "
+          f"(последовательно заняло бы не меньше {serial:.1f} с)")
+    print("Ответы на оплату: " + ', '.join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Простой потокобезопасный кэш в памяти процесса с вытеснением LRU и TTL.
+
+Используется для данных каталога, которые меняются редко (категории,
+карточки товаров, результаты выборок), чтобы не читать их из SQLite
+на каждый запрос.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Кэш ограниченного размера: при переполнении вытесняется запись,
+    к которой дольше всего не обращались. Записи старше ttl секунд
+    считаются промахом и удаляются при обращении.
+    Ведёт счётчики попаданий, промахов, вытеснений и инвалидаций.
+    """
+
+    def __init__(self, max_size=1024, ttl=60.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """
+        Возвращает значение по ключу или default при промахе/истечении TTL.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > self._clock():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """
+        Сохраняет значение, при необходимости вытесняя самые старые записи.
+        """
+        with self._lock:
+            self._data[key] = (self._clock() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_set(self, key, factory):
+        """
+        Возвращает значение из кэша, а при промахе вычисляет его через
+        factory() и сохраняет. Значения None не кэшируются.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is missing:
+            value = factory()
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def delete_where(self, predicate):
+        """
+        Удаляет все записи, ключ которых удовлетворяет predicate(key).
+        """
+        with self._lock:
+            stale = [key for key in self._data if predicate(key)]
+            for key in stale:
+                del self._data[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        """
+        Возвращает словарь со счётчиками кэша.
+        """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
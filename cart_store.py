@@ -0,0 +1,168 @@
+"""
+Серверное хранилище корзин.
+
+Корзина хранится на сервере под ключом владельца: "user:<id>" для
+авторизованного пользователя или "anon:<token>" для гостя. В сессионной
+cookie остаётся только токен гостя, поэтому изменение корзины не
+переподписывает и не раздувает cookie.
+
+Реализации:
+- SQLiteCartStore — таблица cart_items в основной базе;
+- MemoryCartStore — словарь в памяти процесса (для тестов и отладки).
+"""
+
+import threading
+
+
+class CartStore:
+    """
+    Интерфейс хранилища корзин. Все операции над позицией — O(1).
+    """
+
+    def items(self, owner):
+        """Возвращает корзину владельца как словарь {product_id: quantity}."""
+        raise NotImplementedError
+
+    def add(self, owner, product_id, quantity):
+        """Увеличивает количество товара в корзине на quantity."""
+        raise NotImplementedError
+
+    def set(self, owner, product_id, quantity):
+        """Устанавливает количество товара; 0 и меньше удаляет позицию."""
+        raise NotImplementedError
+
+    def remove(self, owner, product_id):
+        raise NotImplementedError
+
+    def clear(self, owner):
+        raise NotImplementedError
+
+    def subtract(self, owner, items):
+        """
+        Уменьшает количества на items {product_id: quantity} (заказанное),
+        удаляя позиции, где ничего не осталось. Добавленное в корзину
+        после её чтения при оформлении заказа остаётся.
+        """
+        raise NotImplementedError
+
+    def merge(self, source, target):
+        """
+        Переносит корзину source в корзину target, складывая количества
+        совпадающих товаров. Корзина source очищается.
+        """
+        raise NotImplementedError
+
+
+class MemoryCartStore(CartStore):
+    """
+    Корзины в памяти процесса. Не переживают перезапуск и не разделяются
+    между процессами — предназначено для тестов.
+    """
+
+    def __init__(self):
+        self._carts = {}
+        self._lock = threading.Lock()
+
+    def items(self, owner):
+        with self._lock:
+            return dict(self._carts.get(owner, {}))
+
+    def add(self, owner, product_id, quantity):
+        with self._lock:
+            cart = self._carts.setdefault(owner, {})
+            cart[product_id] = cart.get(product_id, 0) + quantity
+
+    def set(self, owner, product_id, quantity):
+        with self._lock:
+            cart = self._carts.setdefault(owner, {})
+            if quantity > 0:
+                cart[product_id] = quantity
+            else:
+                cart.pop(product_id, None)
+
+    def remove(self, owner, product_id):
+        with self._lock:
+            self._carts.get(owner, {}).pop(product_id, None)
+
+    def clear(self, owner):
+        with self._lock:
+            self._carts.pop(owner, None)
+
+    def subtract(self, owner, items):
+        with self._lock:
+            cart = self._carts.get(owner, {})
+            for product_id, quantity in items.items():
+                left = cart.get(product_id, 0) - quantity
+                if left > 0:
+                    cart[product_id] = left
+                else:
+                    cart.pop(product_id, None)
+
+    def merge(self, source, target):
+        with self._lock:
+            incoming = self._carts.pop(source, {})
+            cart = self._carts.setdefault(target, {})
+            for product_id, quantity in incoming.items():
+                cart[product_id] = cart.get(product_id, 0) + quantity
+
+
+class SQLiteCartStore(CartStore):
+    """
+    Корзины в таблице cart_items (первичный ключ (owner, product_id)).
+    get_conn — функция, возвращающая соединение текущего запроса.
+    Каждая операция — одна точечная запись по первичному ключу.
+    """
+
+    def __init__(self, get_conn):
+        self._get_conn = get_conn
+
+    def _write(self, sql, params):
+        conn = self._get_conn()
+        with conn:
+            conn.execute(sql, params)
+
+    def items(self, owner):
+        rows = self._get_conn().execute(
+            "SELECT product_id, quantity FROM cart_items WHERE owner = ?", (owner,))
+        return {product_id: quantity for product_id, quantity in rows}
+
+    def add(self, owner, product_id, quantity):
+        self._write("""
+            INSERT INTO cart_items (owner, product_id, quantity) VALUES (?, ?, ?)
+            ON CONFLICT (owner, product_id) DO UPDATE
+            SET quantity = quantity + excluded.quantity
+        """, (owner, product_id, quantity))
+
+    def set(self, owner, product_id, quantity):
+        if quantity <= 0:
+            self.remove(owner, product_id)
+            return
+        self._write("""
+            INSERT INTO cart_items (owner, product_id, quantity) VALUES (?, ?, ?)
+            ON CONFLICT (owner, product_id) DO UPDATE SET quantity = excluded.quantity
+        """, (owner, product_id, quantity))
+
+    def remove(self, owner, product_id):
+        self._write("DELETE FROM cart_items WHERE owner = ? AND product_id = ?", (owner, product_id))
+
+    def clear(self, owner):
+        self._write("DELETE FROM cart_items WHERE owner = ?", (owner,))
+
+    def subtract(self, owner, items):
+        conn = self._get_conn()
+        with conn:
+            conn.executemany("DELETE FROM cart_items WHERE owner = ? AND product_id = ? AND quantity <= ?",
+                             [(owner, product_id, quantity) for product_id, quantity in items.items()])
+            conn.executemany("UPDATE cart_items SET quantity = quantity - ? WHERE owner = ? AND product_id = ?",
+                             [(quantity, owner, product_id) for product_id, quantity in items.items()])
+
+    def merge(self, source, target):
+        conn = self._get_conn()
+        with conn:
+            conn.execute("""
+                INSERT INTO cart_items (owner, product_id, quantity)
+                SELECT ?, product_id, quantity FROM cart_items WHERE owner = ?
+                ON CONFLICT (owner, product_id) DO UPDATE
+                SET quantity = quantity + excluded.quantity
+            """, (target, source))
+            conn.execute("DELETE FROM cart_items WHERE owner = ?", (source,))
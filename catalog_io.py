@@ -0,0 +1,273 @@
+"""
+Потоковый импорт и экспорт каталога (CSV / JSONL).
+
+Файлы читаются построчно и загружаются порциями по chunk_size строк:
+каждая порция — отдельная короткая транзакция с executemany, поэтому
+магазин продолжает работать во время загрузки (WAL: читатели не ждут,
+покупатели ждут блокировку записи не дольше одной порции).
+
+Режимы записи выбираются по набору колонок файла:
+- есть все обязательные колонки — вставка, а при совпадении id —
+  обновление (INSERT ... ON CONFLICT(id) DO UPDATE);
+- есть id и только часть колонок (например, id и stock_quantity
+  для ночного пополнения остатков) — UPDATE по id.
+Набор колонок задаёт заголовок CSV или первая запись JSONL; запись
+с другими ключами останавливает загрузку с ошибкой.
+
+Экспорт читает курсор по мере записи, не загружая таблицу в память.
+"""
+
+import contextlib
+import csv
+import json
+import logging
+import sqlite3
+import sys
+import time
+
+from init_db import CATALOG_INDEXES, SEARCH_SCHEMA
+
+logger = logging.getLogger(__name__)
+
+# Колонки таблиц каталога и обязательные для вставки новой строки
+TABLES = {
+    'products': {
+        'columns': ['id', 'name', 'description', 'price', 'stock_quantity', 'category_id',
+                    'manufacturer', 'material', 'age_min', 'batteries_included', 'image_filename'],
+        'required': {'name', 'price', 'stock_quantity', 'category_id', 'manufacturer',
+                     'material', 'age_min'},
+    },
+    'categories': {
+        'columns': ['id', 'name', 'description'],
+        'required': {'name'},
+    },
+}
+
+# Сколько отклонённых строк выводить в лог подробно
+REJECTED_LOG_LIMIT = 10
+
+# csv.DictReader кладёт значения сверх заголовка под ключ None
+EXTRA_VALUES = 'значения без заголовка'
+
+
+class ImportFormatError(Exception):
+    """
+    Файл нельзя загрузить: неизвестные или недостаточные колонки, битая строка.
+    """
+
+
+def detect_format(path, fmt=None):
+    """
+    Формат файла: явно заданный или по расширению (.csv, .jsonl/.ndjson).
+    """
+    if fmt:
+        return fmt
+    if path.endswith('.csv'):
+        return 'csv'
+    if path.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    raise ImportFormatError(f"Не удалось определить формат файла {path}, укажите --format")
+
+
+def open_stream(path, mode='r'):
+    """
+    Открывает файл для чтения или записи; '-' — stdin/stdout.
+    newline='' нужен модулю csv для корректных переводов строк в значениях.
+    """
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    return open(path, mode, encoding='utf-8', newline='')
+
+
+def read_rows(stream, fmt):
+    """
+    Построчно читает CSV (с заголовком) или JSONL и выдаёт словари.
+    Пустые значения CSV превращаются в NULL.
+    """
+    if fmt == 'csv':
+        for row in csv.DictReader(stream):
+            yield {key: (value if value != '' else None) for key, value in row.items()}
+    else:
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                raise ImportFormatError(f"Строка {number}: некорректный JSON ({e})")
+            if not isinstance(row, dict):
+                raise ImportFormatError(f"Строка {number}: ожидается объект JSON")
+            yield row
+
+
+def build_statement(table, columns):
+    """
+    SQL для загрузки строк с данным набором колонок (см. описание модуля).
+    Возвращает (sql, порядок колонок в параметрах, режим 'upsert' или 'update').
+    """
+    spec = TABLES[table]
+    if None in columns:
+        raise ImportFormatError(f"Запись 1: колонки отличаются от заголовка; лишние: {EXTRA_VALUES}")
+    unknown = [column for column in columns if column not in spec['columns']]
+    if unknown:
+        raise ImportFormatError(f"Неизвестные колонки {table}: {', '.join(unknown)}")
+
+    if spec['required'] <= set(columns):
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns if column != 'id')
+        sql = (f"INSERT INTO {table} ({', '.join(columns)}) "
+               f"VALUES ({', '.join(['?'] * len(columns))})")
+        if 'id' in columns:
+            sql += f" ON CONFLICT(id) DO UPDATE SET {updates}"
+        return sql, list(columns), 'upsert'
+
+    if 'id' not in columns or len(columns) < 2:
+        missing = sorted(spec['required'] - set(columns))
+        raise ImportFormatError(f"Для вставки не хватает колонок: {', '.join(missing)}; "
+                                f"для обновления нужна колонка id и хотя бы одна другая")
+    fields = [column for column in columns if column != 'id']
+    sql = f"UPDATE {table} SET {', '.join(f'{column} = ?' for column in fields)} WHERE id = ?"
+    return sql, fields + ['id'], 'update'
+
+
+@contextlib.contextmanager
+def relaxed_pragmas(conn, cache_kib=262144):
+    """
+    На время загрузки: synchronous=OFF (WAL остаётся согласованным,
+    при сбое питания теряются лишь последние порции) и больший
+    страничный кэш. Прежние значения восстанавливаются.
+    """
+    synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+    cache_size = conn.execute("PRAGMA cache_size").fetchone()[0]
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute(f"PRAGMA cache_size = -{cache_kib}")
+    try:
+        yield
+    finally:
+        conn.execute(f"PRAGMA synchronous = {synchronous}")
+        conn.execute(f"PRAGMA cache_size = {cache_size}")
+
+
+@contextlib.contextmanager
+def deferred_indexes(conn):
+    """
+    Для больших загрузок: снимает триггеры FTS и вторичные индексы
+    каталога, а после загрузки создаёт индексы заново и перестраивает
+    полнотекстовый индекс одним проходом вместо обновления на каждую строку.
+    """
+    fts_triggers = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'products_fts_%'")]
+    indexes = [statement.split(' IF NOT EXISTS ')[1].split(' ')[0] for statement in CATALOG_INDEXES]
+    with conn:
+        for name in fts_triggers:
+            conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+        for name in indexes:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+    try:
+        yield
+    finally:
+        started = time.perf_counter()
+        with conn:
+            for statement in CATALOG_INDEXES:
+                conn.execute(statement)
+            for statement in SEARCH_SCHEMA:
+                conn.execute(statement)
+            conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+        logger.info(f"Индексы каталога перестроены за {time.perf_counter() - started:.1f} с")
+
+
+def import_rows(conn, table, rows, chunk_size=5000, bulk=False, progress=None):
+    """
+    Загружает строки (словари) в таблицу table порциями по chunk_size.
+    bulk=True откладывает индексы и FTS до конца загрузки (только products).
+    progress(stats) вызывается после каждой порции.
+    Возвращает словарь: rows, written, not_found (для UPDATE), rejected, seconds.
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    stats = {'rows': 0, 'written': 0, 'not_found': 0, 'rejected': 0, 'seconds': 0.0}
+    if first is None:
+        return stats
+
+    sql, order, mode = build_statement(table, list(first))
+    columns = set(first)
+    started = time.perf_counter()
+
+    def chunks():
+        batch = [first]
+        for number, row in enumerate(rows, 2):
+            # Набор колонок задаёт первая запись: запись с другими ключами
+            # потеряла бы поля или записалась бы не в те колонки
+            if row.keys() != columns:
+                extra = sorted(EXTRA_VALUES if key is None else str(key) for key in row.keys() - columns)
+                missing = sorted(columns - row.keys())
+                raise ImportFormatError(
+                    f"Запись {number}: колонки отличаются от первой записи"
+                    + (f"; лишние: {', '.join(extra)}" if extra else '')
+                    + (f"; нет: {', '.join(missing)}" if missing else ''))
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def write(batch):
+        params = [tuple(row.get(column) for column in order) for row in batch]
+        try:
+            with conn:
+                cursor = conn.executemany(sql, params)
+            return cursor.rowcount, 0
+        except sqlite3.IntegrityError:
+            # В порции есть некорректные строки: повторяем её построчно,
+            # чтобы загрузить остальные и сообщить о плохих
+            written = rejected = 0
+            with conn:
+                for row, values in zip(batch, params):
+                    try:
+                        written += conn.execute(sql, values).rowcount
+                    except sqlite3.IntegrityError as e:
+                        rejected += 1
+                        if stats['rejected'] + rejected <= REJECTED_LOG_LIMIT:
+                            logger.warning(f"Строка отклонена ({e}): {row}")
+            return written, rejected
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(relaxed_pragmas(conn))
+        if bulk and table == 'products':
+            stack.enter_context(deferred_indexes(conn))
+        for batch in chunks():
+            written, rejected = write(batch)
+            stats['rows'] += len(batch)
+            stats['written'] += written
+            stats['rejected'] += rejected
+            if mode == 'update':
+                stats['not_found'] += len(batch) - written - rejected
+            stats['seconds'] = time.perf_counter() - started
+            if progress:
+                progress(stats)
+
+    stats['seconds'] = time.perf_counter() - started
+    return stats
+
+
+def export_rows(conn, table, stream, fmt):
+    """
+    Выгружает таблицу table в stream (CSV с заголовком или JSONL),
+    читая курсор построчно. Возвращает число строк.
+    """
+    columns = TABLES[table]['columns']
+    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY id")
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in cursor:
+            writer.writerow(['' if value is None else value for value in row])
+            count += 1
+    else:
+        for row in cursor:
+            stream.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+            stream.write('\n')
+            count += 1
+    return count
@@ -0,0 +1,148 @@
+"""
+Модуль доступа к базе данных SQLite.
+
+Содержит пул соединений, привязанный к потокам-обработчикам:
+соединения открываются один раз, настраиваются (WAL, pragma)
+и переиспользуются между запросами вместо sqlite3.connect() на каждый хит.
+
+Для чтения каталога можно подключить реплики (ReplicaSet): снимки
+основной базы, обновляемые через online backup API (refresh_snapshot),
+или саму основную базу, открытую только на чтение.
+"""
+
+import itertools
+import os
+import sqlite3
+import threading
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Pragma, применяемые к каждому новому соединению.
+# WAL позволяет читателям не блокировать писателей (и наоборот),
+# synchronous=NORMAL безопасен в режиме WAL и заметно дешевле FULL.
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,       # ~16 МБ страничного кэша на соединение
+    'mmap_size': 268435456,     # 256 МБ memory-mapped I/O
+    'busy_timeout': 5000,       # мс ожидания блокировки вместо мгновенной ошибки
+    'temp_store': 'MEMORY',
+}
+
+
+class ConnectionPool:
+    """
+    Ограниченный пул соединений SQLite для каждого потока.
+
+    Каждый поток хранит собственный список свободных соединений
+    (соединения sqlite3 нельзя передавать между потоками).
+    Вернувшиеся соединения сверх max_idle закрываются.
+    factory — класс соединения для sqlite3.connect() (например,
+    профилирующий InstrumentedConnection).
+    """
+
+    def __init__(self, database, max_idle=4, pragmas=None, factory=sqlite3.Connection):
+        self.database = database
+        self.max_idle = max_idle
+        self.factory = factory
+        self.pragmas = dict(PRAGMAS if pragmas is None else pragmas)
+        self._local = threading.local()
+
+    def _idle(self):
+        idle = getattr(self._local, 'idle', None)
+        if idle is None:
+            idle = self._local.idle = []
+        return idle
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def acquire(self):
+        """
+        Возвращает свободное соединение текущего потока или открывает новое.
+        """
+        idle = self._idle()
+        if idle:
+            return idle.pop()
+        return self._connect()
+
+    def release(self, conn):
+        """
+        Возвращает соединение в пул. Незавершённая транзакция откатывается,
+        чтобы следующий запрос получил соединение в чистом состоянии.
+        """
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error as e:
+            logger.warning(f"Соединение отброшено при возврате в пул: {e}")
+            conn.close()
+            return
+
+        idle = self._idle()
+        if len(idle) < self.max_idle:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    def close_all(self):
+        """
+        Закрывает все свободные соединения текущего потока.
+        """
+        idle = self._idle()
+        while idle:
+            idle.pop().close()
+
+
+class ReplicaSet:
+    """
+    Пулы соединений только для чтения (PRAGMA query_only) к репликам.
+    pick() по очереди выдаёт пул следующей реплики.
+    """
+
+    def __init__(self, databases, max_idle=4, factory=sqlite3.Connection):
+        pragmas = dict(PRAGMAS, query_only=1)
+        self.pools = [ConnectionPool(database, max_idle=max_idle, pragmas=pragmas, factory=factory)
+                      for database in databases]
+        self._next = itertools.cycle(range(len(self.pools)))
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.pools)
+
+    def pick(self):
+        with self._lock:
+            return self.pools[next(self._next)]
+
+    def close_all(self):
+        for pool in self.pools:
+            pool.close_all()
+
+
+def refresh_snapshot(source, target):
+    """
+    Копирует основную базу source в файл реплики target через online
+    backup API. Копия делается за один шаг, то есть из одного снимка
+    source: писатели основной базы (WAL) не ждут. Реплика переводится
+    в WAL, поэтому открытые соединения к ней дочитывают старую версию
+    и видят новую со следующей транзакции — файл не подменяется.
+    Возвращает время копирования в секундах.
+    """
+    started = time.perf_counter()
+    directory = os.path.dirname(os.path.abspath(target))
+    os.makedirs(directory, exist_ok=True)
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target, timeout=PRAGMAS['busy_timeout'] / 1000)
+    try:
+        src.backup(dst)
+        dst.execute("PRAGMA journal_mode = WAL")
+    finally:
+        dst.close()
+        src.close()
+    return time.perf_counter() - started
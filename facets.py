@@ -0,0 +1,279 @@
+"""
+Фасетная навигация по каталогу: битовые индексы товаров в наличии.
+
+Для каждого значения фасета (категория, производитель, материал,
+возрастная группа, ценовой диапазон, батарейки) хранится битовая карта —
+целое число, в котором бит i установлен, если товар с id = i есть
+в наличии и имеет это значение. Число товаров для значения с учётом
+выбранных фильтров — popcount пересечения карт: несколько тысяч
+операций над целыми вместо GROUP BY по каталогу на каждый показ страницы.
+Внутри фасета выбранные значения объединяются (ИЛИ), между фасетами —
+пересекаются (И); счётчики фасета считаются без учёта его собственного выбора.
+
+Индекс строится один раз, а дальше обновляется по журналу product_changes:
+триггеры записывают туда товары, у которых изменились поля фасетов
+или наличие (остаток перешёл через ноль). Обычная продажа, не обнулившая
+остаток, индекс не трогает.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Возрастные группы по age_min: (значение в URL, подпись, от, до включительно)
+AGE_BANDS = [
+    ('0-2', '0–2 года', 0, 2),
+    ('3-5', '3–5 лет', 3, 5),
+    ('6-8', '6–8 лет', 6, 8),
+    ('9-11', '9–11 лет', 9, 11),
+    ('12+', '12 лет и старше', 12, None),
+]
+
+# Ценовые диапазоны: (значение в URL, подпись, от, до не включительно)
+PRICE_BUCKETS = [
+    ('0-1000', 'до 1 000 ₽', 0, 1000),
+    ('1000-3000', '1 000 – 3 000 ₽', 1000, 3000),
+    ('3000-5000', '3 000 – 5 000 ₽', 3000, 5000),
+    ('5000-10000', '5 000 – 10 000 ₽', 5000, 10000),
+    ('10000+', 'от 10 000 ₽', 10000, None),
+]
+
+BATTERIES = [('1', 'С батарейками'), ('0', 'Без батареек')]
+
+# Фасеты в порядке показа: имя аргумента URL и подпись
+FACETS = [
+    ('category', 'Категория'),
+    ('manufacturer', 'Производитель'),
+    ('material', 'Материал'),
+    ('age', 'Возраст'),
+    ('price', 'Цена'),
+    ('batteries', 'Батарейки'),
+]
+
+# Изменений в журнале, после которых дешевле перестроить индекс целиком
+REBUILD_THRESHOLD = 5000
+
+
+def age_band(age_min):
+    for value, _, low, high in AGE_BANDS:
+        if age_min >= low and (high is None or age_min <= high):
+            return value
+    return AGE_BANDS[0][0]
+
+
+def price_bucket(price):
+    for value, _, low, high in PRICE_BUCKETS:
+        if price >= low and (high is None or price < high):
+            return value
+    return PRICE_BUCKETS[0][0]
+
+
+def facet_values(row):
+    """
+    Значения фасетов товара (строки, как в URL) в порядке FACETS.
+    row — (category_id, manufacturer, material, age_min, price, batteries_included).
+    """
+    category_id, manufacturer, material, age_min, price, batteries = row
+    return (str(category_id), manufacturer, material, age_band(age_min), price_bucket(price),
+            '1' if batteries else '0')
+
+
+def facet_sql(name, values):
+    """
+    Условие SQL (с параметрами) для выбранных значений фасета: значения
+    одного фасета объединяются через ИЛИ. Неизвестные значения пропускаются.
+    Возвращает (sql, params) или (None, []).
+    """
+    if name in ('category', 'manufacturer', 'material', 'batteries'):
+        column = {'category': 'p.category_id', 'manufacturer': 'p.manufacturer',
+                  'material': 'p.material', 'batteries': 'p.batteries_included'}[name]
+        if name == 'batteries':
+            values = [int(value) for value in values if value in ('0', '1')]
+        if not values:
+            return None, []
+        return f"{column} IN ({','.join(['?'] * len(values))})", list(values)
+
+    bands = AGE_BANDS if name == 'age' else PRICE_BUCKETS
+    column = 'p.age_min' if name == 'age' else 'p.price'
+    conditions, params = [], []
+    for value, _, low, high in bands:
+        if value not in values:
+            continue
+        if high is None:
+            conditions.append(f"{column} >= ?")
+            params.append(low)
+        elif name == 'age':
+            conditions.append(f"{column} BETWEEN ? AND ?")
+            params += [low, high]
+        else:
+            conditions.append(f"({column} >= ? AND {column} < ?)")
+            params += [low, high]
+    if not conditions:
+        return None, []
+    return '(' + ' OR '.join(conditions) + ')', params
+
+
+def bitmap_of(ids):
+    """
+    Битовая карта из последовательности id.
+    """
+    ids = list(ids)
+    if not ids:
+        return 0
+    bits = bytearray(max(ids) // 8 + 1)
+    for product_id in ids:
+        bits[product_id >> 3] |= 1 << (product_id & 7)
+    return int.from_bytes(bits, 'little')
+
+
+class FacetIndex:
+    """
+    Битовые карты значений фасетов для товаров в наличии.
+    refresh(conn) подтягивает изменения из журнала не чаще, чем раз
+    в refresh_interval секунд; counts() считает число товаров по значениям.
+    """
+
+    def __init__(self, refresh_interval=1.0):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._bitmaps = {name: {} for name, _ in FACETS}
+        self._products = {}
+        self._seq = None
+        self._checked_at = 0.0
+        self.rebuilds = 0
+        self.applied = 0
+
+    def _add(self, product_id, values):
+        bit = 1 << product_id
+        for (name, _), value in zip(FACETS, values):
+            bitmaps = self._bitmaps[name]
+            bitmaps[value] = bitmaps.get(value, 0) | bit
+        self._products[product_id] = values
+
+    def _remove(self, product_id):
+        values = self._products.pop(product_id, None)
+        if values is None:
+            return
+        mask = ~(1 << product_id)
+        for (name, _), value in zip(FACETS, values):
+            bitmaps = self._bitmaps[name]
+            bitmaps[value] &= mask
+            if not bitmaps[value]:
+                del bitmaps[value]
+
+    def rebuild(self, conn):
+        """
+        Строит индекс заново одним проходом по товарам в наличии.
+        """
+        started = time.perf_counter()
+        seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM product_changes").fetchone()[0]
+        ids = {name: {} for name, _ in FACETS}
+        products = {}
+        for row in conn.execute("""
+            SELECT id, category_id, manufacturer, material, age_min, price, batteries_included
+            FROM products WHERE stock_quantity > 0
+        """):
+            values = facet_values(tuple(row)[1:])
+            products[row[0]] = values
+            for (name, _), value in zip(FACETS, values):
+                ids[name].setdefault(value, []).append(row[0])
+        bitmaps = {name: {value: bitmap_of(members) for value, members in values.items()}
+                   for name, values in ids.items()}
+        with self._lock:
+            self._bitmaps = bitmaps
+            self._products = products
+            self._seq = seq
+            self.rebuilds += 1
+        logger.info(f"Фасетный индекс построен: {len(products)} товаров "
+                    f"за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+    def refresh(self, conn, force=False):
+        """
+        Применяет изменения товаров из журнала product_changes.
+        Если журнал ушёл вперёд дальше, чем хранится, или изменений
+        слишком много — перестраивает индекс.
+        """
+        now = time.monotonic()
+        if self._seq is not None and not force and now - self._checked_at < self.refresh_interval:
+            return
+        # Обновляет один поток, остальные пока считают по текущему индексу;
+        # первого построения ждут все
+        if not self._refreshing.acquire(blocking=self._seq is None):
+            return
+        try:
+            self._checked_at = now
+            if self._seq is None:
+                self.rebuild(conn)
+            else:
+                self._apply_changes(conn)
+        finally:
+            self._refreshing.release()
+
+    def _apply_changes(self, conn):
+        first, last = conn.execute("SELECT MIN(seq), MAX(seq) FROM product_changes").fetchone()
+        if last is None or last <= self._seq:
+            return
+        if first > self._seq + 1 or last - self._seq > REBUILD_THRESHOLD:
+            self.rebuild(conn)
+            return
+
+        changed = [row[0] for row in conn.execute(
+            "SELECT DISTINCT product_id FROM product_changes WHERE seq > ? AND seq <= ?", (self._seq, last))]
+        rows = {}
+        for start in range(0, len(changed), 500):
+            batch = changed[start:start + 500]
+            rows.update((row[0], facet_values(tuple(row)[1:])) for row in conn.execute(f"""
+                SELECT id, category_id, manufacturer, material, age_min, price, batteries_included
+                FROM products WHERE stock_quantity > 0 AND id IN ({','.join(['?'] * len(batch))})
+            """, batch))
+        with self._lock:
+            for product_id in changed:
+                self._remove(product_id)
+                if product_id in rows:
+                    self._add(product_id, rows[product_id])
+            self._seq = last
+            self.applied += len(changed)
+
+    def counts(self, selected, restrict=None):
+        """
+        Число товаров в наличии для каждого значения каждого фасета.
+        selected — {фасет: [выбранные значения]}; restrict — битовая карта,
+        ограничивающая выборку (например, результаты поиска), или None.
+        Возвращает {фасет: {значение: число}} без нулевых значений.
+        """
+        with self._lock:
+            bitmaps = self._bitmaps
+            # Объединение выбранных значений каждого фасета
+            unions = {}
+            for name, values in selected.items():
+                if values and name in bitmaps:
+                    union = 0
+                    for value in values:
+                        union |= bitmaps[name].get(value, 0)
+                    unions[name] = union
+
+            result = {}
+            for name, _ in FACETS:
+                base = restrict
+                for other, union in unions.items():
+                    if other != name:
+                        base = union if base is None else base & union
+                if base is None:
+                    counts = {value: bitmap.bit_count() for value, bitmap in bitmaps[name].items()}
+                else:
+                    counts = {value: (bitmap & base).bit_count() for value, bitmap in bitmaps[name].items()}
+                result[name] = {value: count for value, count in counts.items() if count}
+            return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'products': len(self._products),
+                'values': sum(len(values) for values in self._bitmaps.values()),
+                'seq': self._seq,
+                'rebuilds': self.rebuilds,
+                'applied': self.applied,
+            }
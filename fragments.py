@@ -0,0 +1,91 @@
+"""
+Кэш отрендеренных фрагментов страниц (HTML).
+
+Карточки товаров и варианты навигационной панели рендерятся один раз
+и дальше вставляются в страницы готовой строкой. Ключ фрагмента включает
+всё, от чего зависит его HTML (id товара и версию каталога, id и имя
+пользователя), поэтому явная инвалидация не нужна: устаревшие варианты
+просто перестают запрашиваться и вытесняются.
+
+Размер кэша ограничен объёмом памяти, а не числом записей: фрагменты
+сильно различаются по длине.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+
+class FragmentCache:
+    """
+    LRU-кэш HTML-фрагментов с ограничением по памяти (max_bytes).
+    Ведёт счётчики попаданий, промахов, вытеснений и инвалидаций
+    в том же формате, что и LRUCache (для /metrics).
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_or_render(self, key, render):
+        """
+        Возвращает фрагмент по ключу, а при промахе рендерит его
+        через render() и сохраняет. Результат — Markup (не экранируется
+        повторно при вставке в шаблон).
+        """
+        with self._lock:
+            html = self._data.get(key)
+            if html is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        # Рендер вне блокировки: параллельные промахи по одному ключу
+        # отрендерят фрагмент дважды, но не будут ждать друг друга
+        html = Markup(render())
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return html
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.bytes -= sys.getsizeof(previous)
+            self._data[key] = html
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= sys.getsizeof(evicted)
+                self.evictions += 1
+        return html
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Возвращает словарь со счётчиками кэша и долей попаданий.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
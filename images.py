@@ -0,0 +1,310 @@
+"""
+Производные изображения товаров: уменьшенные копии в WebP и JPEG.
+
+Исходники лежат в static/images. Для каждого исходника строятся варианты
+(VARIANTS: миниатюра, карточка, страница товара) и складываются в дисковый
+кэш — заранее командой flask images build или при первом запросе.
+
+Адрес производного изображения содержит хэш содержимого исходника
+и параметров варианта: /img/<исходник>/<вариант>-<хэш>.<формат>.
+Поэтому его можно отдавать с Cache-Control: immutable — изменённый
+исходник получит новый адрес. Запрос по устаревшему хэшу перенаправляется
+на текущий адрес.
+
+Без Pillow производные не строятся: все варианты отдаются исходником
+(с тем же хэшированным адресом и кэшированием).
+"""
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+
+from werkzeug.security import safe_join
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Варианты: имя → наибольшая ширина в пикселях (меньшие исходники не увеличиваются)
+VARIANTS = {
+    'thumb': 160,
+    'card': 400,
+    'detail': 900,
+}
+
+# Форматы производных: расширение → (формат Pillow, MIME-тип)
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+
+SOURCE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
+# Меняется при изменении алгоритма: старые производные получают новые адреса
+PIPELINE_VERSION = 1
+
+
+class ImageError(Exception):
+    """
+    Файл не является поддерживаемым изображением.
+    """
+
+
+class ImagePipeline:
+    """
+    Производные изображения исходников из source_dir с кэшем в cache_dir.
+    quality — качество сжатия WebP и JPEG, fallback — исходник для товаров
+    без изображения.
+    """
+
+    def __init__(self, source_dir, cache_dir, quality=80, fallback='splash.jpg'):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.quality = quality
+        self.fallback = fallback
+        self.enabled = Image is not None
+        self._digests = {}
+        self._widths = {}
+        self._lock = threading.Lock()
+        self._building = {}
+        self.generated = 0
+        if not self.enabled:
+            logger.warning("Pillow не установлен: изображения отдаются без уменьшения")
+
+    def source_path(self, filename):
+        """
+        Путь к исходнику внутри source_dir; None, если файла нет
+        или имя выходит за пределы каталога.
+        """
+        path = safe_join(self.source_dir, filename) if filename else None
+        if path is None or os.path.splitext(path)[1].lower() not in SOURCE_EXTENSIONS:
+            return None
+        return path if os.path.isfile(path) else None
+
+    def resolve(self, filename):
+        """
+        Имя существующего исходника: filename или fallback.
+        """
+        return filename if self.source_path(filename) else self.fallback
+
+    def source_digest(self, filename):
+        """
+        Хэш содержимого исходника. Запоминается по (mtime, размер),
+        так что файл перечитывается только после изменения.
+        """
+        path = self.source_path(filename)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._digests.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        self._digests[path] = (signature, digest)
+        return digest
+
+    def digest(self, filename, variant, ext):
+        """
+        Хэш производного изображения: содержимое исходника и параметры варианта.
+        """
+        source = self.source_digest(filename)
+        if source is None:
+            return None
+        params = f"{source}:{variant}:{VARIANTS.get(variant)}:{ext}:{self.quality}:{PIPELINE_VERSION}:{self.enabled}"
+        return hashlib.sha256(params.encode()).hexdigest()[:16]
+
+    def name(self, filename, variant, ext):
+        """
+        Имя производного файла (последняя часть адреса): <вариант>-<хэш>.<формат>.
+        Без Pillow формат — расширение исходника.
+        """
+        if not self.enabled:
+            ext = os.path.splitext(filename)[1].lstrip('.').lower()
+        return f"{variant}-{self.digest(filename, variant, ext)}.{ext}"
+
+    def parse(self, name):
+        """
+        Разбирает имя производного файла: (вариант, хэш, формат) или None.
+        """
+        stem, _, ext = name.rpartition('.')
+        variant, _, digest = stem.partition('-')
+        if variant not in VARIANTS or not digest:
+            return None
+        if self.enabled and ext not in FORMATS:
+            return None
+        return variant, digest, ext
+
+    def source_width(self, filename):
+        """
+        Ширина исходника в пикселях (None без Pillow или для битого файла).
+        """
+        if not self.enabled:
+            return None
+        path = self.source_path(filename)
+        key = (path, self.source_digest(filename))
+        if key not in self._widths:
+            try:
+                with Image.open(path) as image:
+                    self._widths[key] = ImageOps.exif_transpose(image).width
+            except OSError:
+                self._widths[key] = None
+        return self._widths[key]
+
+    def variants(self, filename):
+        """
+        Варианты, имеющие смысл для исходника: все, что не шире него,
+        и один наименьший из более широких (он будет копией исходника по размеру).
+        Возвращает [(вариант, ширина)] по возрастанию ширины.
+        """
+        width = self.source_width(filename)
+        result = []
+        for variant, limit in sorted(VARIANTS.items(), key=lambda item: item[1]):
+            if width is None:
+                result.append((variant, limit))
+            elif limit < width:
+                result.append((variant, limit))
+            else:
+                result.append((variant, width))
+                break
+        return result
+
+    def cache_path(self, filename, name):
+        return os.path.join(self.cache_dir, hashlib.sha256(filename.encode()).hexdigest()[:2], name)
+
+    def render(self, filename, variant, ext):
+        """
+        Путь к производному изображению в кэше; строит его при отсутствии.
+        Параллельные запросы одного файла строят его один раз.
+        """
+        name = self.name(filename, variant, ext)
+        path = self.cache_path(filename, name)
+        if not self.enabled:
+            return self.source_path(filename)
+        if os.path.exists(path):
+            return path
+
+        with self._lock:
+            lock = self._building.setdefault(path, threading.Lock())
+        with lock:
+            if not os.path.exists(path):
+                self._write(self.source_path(filename), path, VARIANTS[variant], ext)
+        with self._lock:
+            self._building.pop(path, None)
+        return path
+
+    def _write(self, source, path, width, ext):
+        with Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.width > width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))),
+                                     Image.LANCZOS)
+            pil_format, _ = FORMATS[ext]
+            has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+            if pil_format == 'JPEG' and has_alpha:
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                background.paste(image.convert('RGBA'), mask=image.convert('RGBA').getchannel('A'))
+                image = background
+            elif image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if has_alpha else 'RGB')
+
+            options = {'quality': self.quality}
+            if pil_format == 'JPEG':
+                options.update(optimize=True, progressive=True)
+            else:
+                options.update(method=4)
+
+            # Запись во временный файл и переименование: другой процесс
+            # не увидит недописанный файл
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, pil_format, **options)
+                os.replace(temp, path)
+            except BaseException:
+                os.unlink(temp)
+                raise
+        self.generated += 1
+
+    def build(self, filename):
+        """
+        Строит все варианты и форматы исходника. Возвращает число новых файлов.
+        """
+        before = self.generated
+        if self.enabled and self.source_path(filename):
+            for variant, _ in self.variants(filename):
+                for ext in FORMATS:
+                    self.render(filename, variant, ext)
+        return self.generated - before
+
+    def sources(self):
+        """
+        Имена всех исходников в source_dir (относительно него).
+        """
+        for root, _, files in os.walk(self.source_dir):
+            for file in sorted(files):
+                if os.path.splitext(file)[1].lower() in SOURCE_EXTENSIONS:
+                    yield os.path.relpath(os.path.join(root, file), self.source_dir).replace(os.sep, '/')
+
+    def prune(self):
+        """
+        Удаляет из кэша файлы, не соответствующие текущим исходникам
+        и параметрам. Возвращает число удалённых.
+        """
+        current = set()
+        for filename in self.sources():
+            for variant in VARIANTS:
+                for ext in FORMATS:
+                    current.add(self.cache_path(filename, self.name(filename, variant, ext)))
+        removed = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                path = os.path.join(root, file)
+                if path not in current:
+                    os.unlink(path)
+                    removed += 1
+        return removed
+
+    def stats(self):
+        return {'enabled': self.enabled, 'generated': self.generated, 'sources': len(self._digests)}
+
+
+def save_upload(stream, directory, max_pixels=40_000_000):
+    """
+    Проверяет загруженный файл и сохраняет его в directory под именем
+    по хэшу содержимого (повторная загрузка того же файла не создаёт копию).
+    Возвращает имя файла. Выбрасывает ImageError, если это не изображение
+    поддерживаемого формата.
+    """
+    data = stream.read()
+    if Image is None:
+        raise ImageError("Загрузка изображений недоступна: не установлен Pillow")
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.width * image.height > max_pixels:
+                raise ImageError("Слишком большое изображение")
+            image_format = image.format
+            image.verify()
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ImageError("Файл не является изображением") from e
+    ext = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}.get(image_format)
+    if ext is None:
+        raise ImageError(f"Формат {image_format} не поддерживается")
+
+    filename = hashlib.sha256(data).hexdigest()[:32] + ext
+    path = os.path.join(directory, filename)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+    return filename
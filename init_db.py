@@ -9,6 +9,9 @@
 - order_items
 - payments
 - delivery
+- cart_items
+
+А также полнотекстовый индекс products_fts (FTS5) по каталогу товаров.
 
 После запуска файл создаёт файл базы данных toy_store.db.
 """
@@ -19,17 +22,376 @@ from werkzeug.security import generate_password_hash
 
 DATABASE = 'toy_store.db'
 
-def init_db():
+# Полнотекстовый индекс каталога. External content: текст хранится только
+# в products, а FTS5 держит лишь инвертированный индекс. unicode61 корректно
+# приводит регистр кириллицы, remove_diacritics 2 сводит «ё» к «е».
+# prefix='2 3' строит дополнительные индексы для быстрых префиксных запросов.
+SEARCH_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description, manufacturer, material,
+        content='products',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    );
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, name, description, manufacturer, material)
+        VALUES (new.id, new.name, new.description, new.manufacturer, new.material);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name, description, manufacturer, material)
+        VALUES ('delete', old.id, old.name, old.description, old.manufacturer, old.material);
+    END;
+    """,
+    # Срабатывает только при изменении индексируемых колонок,
+    # поэтому списание остатков при оформлении заказа индекс не трогает
+    """
+    CREATE TRIGGER IF NOT EXISTS products_fts_au
+    AFTER UPDATE OF name, description, manufacturer, material ON products BEGIN
+        INSERT INTO products_fts (products_fts, rowid, name, description, manufacturer, material)
+        VALUES ('delete', old.id, old.name, old.description, old.manufacturer, old.material);
+        INSERT INTO products_fts (rowid, name, description, manufacturer, material)
+        VALUES (new.id, new.name, new.description, new.manufacturer, new.material);
+    END;
+    """,
+]
+
+# Покрывающие индексы для постраничного вывода каталога.
+# SQLite неявно дописывает rowid (id) в конец каждого индекса,
+# поэтому (price) и (name) уже упорядочены по паре (ключ, id).
+CATALOG_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_products_category_stock_price "
+    "ON products(category_id, stock_quantity, price, id)",
+    "CREATE INDEX IF NOT EXISTS idx_products_age_stock ON products(age_min, stock_quantity)",
+    "CREATE INDEX IF NOT EXISTS idx_products_price ON products(price)",
+    "CREATE INDEX IF NOT EXISTS idx_products_name ON products(name)",
+]
+
+# Версия каталога для HTTP-кэширования (ETag, Last-Modified).
+# Триггеры увеличивают счётчик при любом изменении товаров и категорий,
+# в том числе при списании остатков в checkout, — так версию видят
+# все процессы-воркеры, а не только тот, что изменил данные.
+CATALOG_VERSION_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL DEFAULT 1,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        holds INTEGER NOT NULL DEFAULT 0
+    );
+    """,
+    "INSERT OR IGNORE INTO catalog_version (id) VALUES (1)",
+] + [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {table}_version_{suffix} AFTER {event} ON {table} BEGIN
+        UPDATE catalog_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1;
+    END;
+    """
+    for table in ('products', 'categories')
+    for suffix, event in (('ai', 'INSERT'), ('ad', 'DELETE'), ('au', 'UPDATE'))
+]
+
+# Журнал изменений товаров для фасетного индекса (facets.py): товар
+# записывается при вставке, удалении, изменении полей фасетов и переходе
+# остатка через ноль. Хранятся последние FACET_LOG_SIZE записей —
+# отставший сильнее процесс перестраивает индекс целиком.
+FACET_LOG_SIZE = 100000
+FACET_FIELDS = ['category_id', 'manufacturer', 'material', 'age_min', 'price', 'batteries_included']
+PRODUCT_CHANGES_SCHEMA = [
     """
-    Инициализирует базу данных, создаёт таблицы и наполняет их тестовыми данными.
-    При наличии старой базы — удаляет её.
+    CREATE TABLE IF NOT EXISTS product_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        product_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_changes_ai AFTER INSERT ON products BEGIN
+        INSERT INTO product_changes (product_id) VALUES (NEW.id);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS product_changes_ad AFTER DELETE ON products BEGIN
+        INSERT INTO product_changes (product_id) VALUES (OLD.id);
+    END;
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS product_changes_au AFTER UPDATE ON products
+    WHEN (OLD.stock_quantity > 0) != (NEW.stock_quantity > 0)
+      OR {' OR '.join(f'OLD.{field} IS NOT NEW.{field}' for field in FACET_FIELDS)}
+    BEGIN
+        INSERT INTO product_changes (product_id) VALUES (NEW.id);
+    END;
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS product_changes_prune AFTER INSERT ON product_changes BEGIN
+        DELETE FROM product_changes WHERE seq <= NEW.seq - {FACET_LOG_SIZE};
+    END;
+    """,
+]
+
+# Серверные корзины. owner — "user:<id>" или "anon:<token>" гостя.
+# WITHOUT ROWID: таблица хранится прямо в B-дереве первичного ключа,
+# и любая операция над позицией — один поиск по (owner, product_id).
+CART_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cart_items (
+        owner TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL CHECK (quantity > 0),
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (owner, product_id),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    ) WITHOUT ROWID;
+"""
+
+# Журнал изменений заказов для отчётов (analytics.py): заказ записывается
+# при создании, удалении, смене статуса или даты и изменении позиций.
+# Хранятся последние ORDER_LOG_SIZE записей — отставшие сводки
+# перестраиваются целиком.
+ORDER_LOG_SIZE = 1000000
+ORDER_CHANGES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS order_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS order_changes_ai AFTER INSERT ON orders BEGIN
+        INSERT INTO order_changes (order_id) VALUES (NEW.id);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS order_changes_ad AFTER DELETE ON orders BEGIN
+        INSERT INTO order_changes (order_id) VALUES (OLD.id);
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS order_changes_au AFTER UPDATE OF status, order_date ON orders BEGIN
+        INSERT INTO order_changes (order_id) VALUES (NEW.id);
+    END;
+    """,
+] + [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS order_items_changes_{suffix} AFTER {event} ON order_items BEGIN
+        INSERT INTO order_changes (order_id) VALUES ({row}.order_id);
+    END;
+    """
+    for suffix, event, row in (('ai', 'INSERT', 'NEW'), ('ad', 'DELETE', 'OLD'), ('au', 'UPDATE', 'NEW'))
+] + [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS order_changes_prune AFTER INSERT ON order_changes BEGIN
+        DELETE FROM order_changes WHERE seq <= NEW.seq - {ORDER_LOG_SIZE};
+    END;
+    """,
+]
+
+# Очередь фоновых задач (jobs.py). status: queued — ждёт run_at,
+# running — выполняется до locked_until (после этого срока задача упавшего
+# воркера снова доступна), done, dead — исчерпала попытки.
+# idempotency_key не даёт поставить одну и ту же работу дважды.
+JOBS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        payload TEXT NOT NULL DEFAULT '{}',
+        idempotency_key TEXT UNIQUE,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_at REAL NOT NULL,
+        locked_until REAL,
+        last_error TEXT,
+        created_at REAL NOT NULL,
+        finished_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_jobs_status_run_at ON jobs(status, run_at)",
+]
+
+# Резервы товаров в корзинах (reservations.py): владелец корзины держит
+# quantity штук до expires_at; доступный остаток — stock_quantity минус
+# активные резервы. Индекс по (product_id, expires_at) — для суммы резервов товара
+RESERVATIONS_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS stock_reservations (
+        owner TEXT NOT NULL,
+        product_id INTEGER NOT NULL,
+        quantity INTEGER NOT NULL CHECK (quantity > 0),
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (owner, product_id),
+        FOREIGN KEY (product_id) REFERENCES products(id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_reservations_product ON stock_reservations(product_id, expires_at)",
+    "CREATE INDEX IF NOT EXISTS idx_reservations_expires ON stock_reservations(expires_at)",
+]
+
+# Счётчик изменений резервов (catalog_version.holds): входит в ETag страницы
+# товара, где показан остаток за вычетом чужих резервов. Версия каталога
+# при этом не меняется — кэши карточек и списков резервы не сбрасывают.
+# Продление резерва без смены количества остаток не меняет.
+HOLDS_VERSION_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS stock_reservations_version_{suffix} AFTER {event} ON stock_reservations
+    {condition} BEGIN
+        UPDATE catalog_version SET holds = holds + 1 WHERE id = 1;
+    END;
+    """
+    for suffix, event, condition in (('ai', 'INSERT', ''), ('ad', 'DELETE', ''),
+                                     ('au', 'UPDATE', 'WHEN OLD.quantity != NEW.quantity'))
+]
+
+# Рекомендации «с этим товаром покупают» (recommendations.py): до top_k
+# соседей товара по совместным покупкам, rank — место в списке.
+# Страница товара читает их одним поиском по первичному ключу.
+RECOMMENDATIONS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS product_recommendations (
+        product_id INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        neighbor_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (product_id, rank)
+    ) WITHOUT ROWID
+"""
+
+# Какие товары покупал пользователь: рекомендации пропускают купленное
+# одним запросом по первичному ключу (user_id, product_id IN соседи),
+# не перебирая историю заказов. Пополняется триггером на order_items.
+USER_PURCHASES_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS user_purchases (
+        user_id INTEGER NOT NULL,
+        product_id INTEGER NOT NULL,
+        PRIMARY KEY (user_id, product_id)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS user_purchases_ai AFTER INSERT ON order_items BEGIN
+        INSERT INTO user_purchases (user_id, product_id)
+        SELECT user_id, NEW.product_id FROM orders WHERE id = NEW.order_id AND user_id IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    END;
+    """,
+]
+USER_PURCHASES_BACKFILL = """
+    INSERT OR IGNORE INTO user_purchases (user_id, product_id)
+    SELECT user_id, product_id FROM (
+        SELECT oi.id, o.user_id, oi.product_id
+        FROM order_items oi JOIN orders o ON o.id = oi.order_id
+        WHERE o.user_id IS NOT NULL
+    )
+"""
+
+# Состояние платежа (payments.py): pending → authorized → captured / failed,
+# ключ идемпотентности попытки, идентификатор авторизации в шлюзе
+PAYMENT_COLUMNS = {
+    'state': "TEXT NOT NULL DEFAULT 'pending'",
+    'idempotency_key': 'TEXT',
+    'gateway_ref': 'TEXT',
+    'error': 'TEXT',
+    'updated_at': 'REAL',
+}
+PAYMENT_INDEXES = [
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_idempotency ON payments(idempotency_key)",
+]
+# Состояние для платежей, созданных до появления state; повторный запуск
+# (после прерванной миграции) не трогает платежи, ушедшие из pending
+PAYMENT_STATE_BACKFILL = """
+    UPDATE payments SET state = CASE WHEN state = 'pending' AND status = 'Успешно' THEN 'captured' ELSE state END
+"""
+
+# Денормализованные итоги заказа (orders.total_amount, orders.item_count).
+# Поддерживаются триггерами на order_items при любом способе изменения
+# позиций, поэтому страницы заказов не пересчитывают SUM/GROUP BY.
+ORDER_TOTALS_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS order_items_totals_ai AFTER INSERT ON order_items BEGIN
+        UPDATE orders
+        SET total_amount = total_amount + new.quantity * new.price,
+            item_count = item_count + new.quantity
+        WHERE id = new.order_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS order_items_totals_ad AFTER DELETE ON order_items BEGIN
+        UPDATE orders
+        SET total_amount = total_amount - old.quantity * old.price,
+            item_count = item_count - old.quantity
+        WHERE id = old.order_id;
+    END;
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS order_items_totals_au
+    AFTER UPDATE OF order_id, quantity, price ON order_items BEGIN
+        UPDATE orders
+        SET total_amount = total_amount - old.quantity * old.price,
+            item_count = item_count - old.quantity
+        WHERE id = old.order_id;
+        UPDATE orders
+        SET total_amount = total_amount + new.quantity * new.price,
+            item_count = item_count + new.quantity
+        WHERE id = new.order_id;
+    END;
+    """,
+]
+
+# Пересчёт итогов из order_items: используется для заполнения
+# новых колонок и для исправления расхождений
+BACKFILL_ORDER_TOTALS = """
+    UPDATE orders SET
+        total_amount = (SELECT COALESCE(SUM(quantity * price), 0)
+                        FROM order_items WHERE order_id = orders.id),
+        item_count = (SELECT COALESCE(SUM(quantity), 0)
+                      FROM order_items WHERE order_id = orders.id)
+"""
+
+# Допустимая погрешность суммы заказа (накопление ошибок REAL)
+TOTAL_TOLERANCE = 0.005
+
+
+def find_order_total_mismatches(conn):
+    """
+    Сверяет денормализованные итоги с order_items.
+    Возвращает список кортежей (order_id, total_amount, item_count,
+    actual_total, actual_count) для расходящихся заказов.
+    """
+    return conn.execute("""
+        SELECT o.id, o.total_amount, o.item_count,
+               COALESCE(SUM(oi.quantity * oi.price), 0) AS actual_total,
+               COALESCE(SUM(oi.quantity), 0) AS actual_count
+        FROM orders o
+        LEFT JOIN order_items oi ON oi.order_id = o.id
+        GROUP BY o.id
+        HAVING ABS(o.total_amount - actual_total) > ? OR o.item_count != actual_count
+    """, (TOTAL_TOLERANCE,)).fetchall()
+
+
+def fix_order_totals(conn, order_ids):
+    """
+    Пересчитывает итоги указанных заказов по order_items.
+    """
+    with conn:
+        conn.executemany(BACKFILL_ORDER_TOTALS + " WHERE id = ?",
+                         [(order_id,) for order_id in order_ids])
+
+
+def init_db(path=DATABASE):
+    """
+    Инициализирует базу данных по пути path, создаёт таблицы и наполняет их
+    тестовыми данными. При наличии старой базы — удаляет её.
     """
 
     # Удаление старой базы данных
-    if os.path.exists(DATABASE):
-        os.remove(DATABASE)
+    if os.path.exists(path):
+        os.remove(path)
     
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(path)
     cursor = conn.cursor()
 
     # === Создание таблиц ===
@@ -41,6 +403,7 @@ def init_db():
         full_name TEXT NOT NULL,
         address TEXT NOT NULL,
         phone TEXT,
+        image_filename TEXT,
         registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
     """)
@@ -76,6 +439,8 @@ def init_db():
         user_id INTEGER NOT NULL,
         status TEXT NOT NULL DEFAULT 'Создан',
         order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        total_amount REAL NOT NULL DEFAULT 0,
+        item_count INTEGER NOT NULL DEFAULT 0,
         FOREIGN KEY (user_id) REFERENCES users(id)
     );
     """)
@@ -101,6 +466,11 @@ def init_db():
         amount REAL NOT NULL CHECK (amount > 0),
         status TEXT NOT NULL DEFAULT 'Ожидание',
         payment_date TIMESTAMP,
+        state TEXT NOT NULL DEFAULT 'pending',
+        idempotency_key TEXT,
+        gateway_ref TEXT,
+        error TEXT,
+        updated_at REAL,
         FOREIGN KEY (order_id) REFERENCES orders(id)
     );
     """)
@@ -117,12 +487,41 @@ def init_db():
     );
     """)
 
+    cursor.execute(CART_SCHEMA)
+    for statement in ORDER_TOTALS_TRIGGERS:
+        cursor.execute(statement)
+    for statement in JOBS_SCHEMA:
+        cursor.execute(statement)
+    for statement in RESERVATIONS_SCHEMA:
+        cursor.execute(statement)
+
     # === Индексы для оптимизации ===
     cursor.execute("CREATE INDEX idx_products_category ON products(category_id)")
-    cursor.execute("CREATE INDEX idx_orders_user ON orders(user_id)")
+    # (user_id, order_date) обслуживает и фильтр по пользователю,
+    # и сортировку истории заказов по дате без отдельной сортировки
+    cursor.execute("CREATE INDEX idx_orders_user_date ON orders(user_id, order_date)")
     cursor.execute("CREATE INDEX idx_order_items_order ON order_items(order_id)")
     cursor.execute("CREATE INDEX idx_payments_order ON payments(order_id)")
+    for statement in PAYMENT_INDEXES:
+        cursor.execute(statement)
     cursor.execute("CREATE INDEX idx_delivery_order ON delivery(order_id)")
+    for statement in CATALOG_INDEXES:
+        cursor.execute(statement)
+
+    # === Полнотекстовый поиск по каталогу ===
+    for statement in SEARCH_SCHEMA:
+        cursor.execute(statement)
+    for statement in CATALOG_VERSION_SCHEMA:
+        cursor.execute(statement)
+    for statement in PRODUCT_CHANGES_SCHEMA:
+        cursor.execute(statement)
+    for statement in ORDER_CHANGES_SCHEMA:
+        cursor.execute(statement)
+    cursor.execute(RECOMMENDATIONS_SCHEMA)
+    for statement in USER_PURCHASES_SCHEMA:
+        cursor.execute(statement)
+    for statement in HOLDS_VERSION_TRIGGERS:
+        cursor.execute(statement)
 
     # === Заполнение таблиц тестовыми данными ===
 
@@ -232,6 +631,7 @@ def init_db():
         INSERT INTO payments (order_id, method, amount, status, payment_date)
         VALUES (?, ?, ?, ?, ?)
     """, payments)
+    cursor.execute(PAYMENT_STATE_BACKFILL)
 
     # Доставка
     deliveries = [
@@ -250,8 +650,13 @@ def init_db():
     """, deliveries)
 
     
-    # Закрытие соединения
     conn.commit()
+
+    # Новая база уже в актуальной схеме: migrate() только проставит версию
+    from migrations import migrate
+    migrate(conn)
+
+    # Закрытие соединения
     conn.close()
 
     print("✅ База данных успешно создана и заполнена тестовыми данными!")
@@ -0,0 +1,241 @@
+"""
+Очередь фоновых задач в SQLite (таблица jobs).
+
+Запрос ставит задачу через enqueue() в своей же транзакции — задача
+появляется в очереди тогда и только тогда, когда зафиксированы данные,
+к которым она относится (например, заказ). Выполняет задачи JobWorker:
+пул потоков в отдельном процессе (serve.py, flask jobs work).
+
+- Повторы: упавшая задача откладывается с экспоненциальной задержкой
+  (retry_base * 2^(попытка-1), не больше retry_cap, со случайным разбросом),
+  после max_attempts попыток получает статус dead и ждёт разбора
+  (flask jobs dead / flask jobs retry).
+- Ключ идемпотентности: повторная постановка с тем же ключом
+  возвращает уже существующую задачу.
+- Аренда: взятая задача помечается running до locked_until; если воркер
+  упал, по истечении срока её возьмёт другой. Поэтому обработчики
+  должны быть идемпотентны.
+
+Обработчик получает (conn, payload). Его изменения в базе фиксируются
+одной транзакцией вместе с отметкой о выполнении задачи.
+"""
+
+import json
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Обработчики задач по типу: {kind: handler(conn, payload)}
+handlers = {}
+
+
+def handler(kind):
+    """
+    Декоратор: регистрирует обработчик задач типа kind.
+    """
+    def decorator(func):
+        handlers[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(conn, kind, payload=None, key=None, delay=0.0, max_attempts=5):
+    """
+    Ставит задачу в очередь. Транзакцию не фиксирует — это делает
+    вызывающий код вместе со своими изменениями. Если задача с ключом
+    key уже есть, новая не создаётся. Возвращает id задачи.
+    """
+    now = time.time()
+    cursor = conn.execute("""
+        INSERT INTO jobs (kind, payload, idempotency_key, max_attempts, run_at, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT(idempotency_key) DO NOTHING
+    """, (kind, json.dumps(payload or {}, ensure_ascii=False), key, max_attempts, now + delay, now))
+    if cursor.rowcount:
+        return cursor.lastrowid
+    return conn.execute("SELECT id FROM jobs WHERE idempotency_key = ?", (key,)).fetchone()[0]
+
+
+def backoff(attempt, base, cap):
+    """
+    Задержка перед повтором после попытки attempt (с 1), в секундах.
+    """
+    return min(cap, base * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+
+
+class JobWorker:
+    """
+    Пул потоков, выполняющих задачи из очереди. Каждый поток берёт
+    соединения из pool (ConnectionPool) и опрашивает очередь раз
+    в poll_interval секунд, пока в ней нет готовых задач.
+    """
+
+    def __init__(self, pool, threads=2, poll_interval=1.0, lease=300.0, retry_base=5.0, retry_cap=3600.0):
+        self.pool = pool
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self._stop = threading.Event()
+        self._threads = []
+
+    def claim(self, conn):
+        """
+        Берёт одну готовую задачу (или задачу с истёкшей арендой)
+        и помечает её running. Возвращает словарь задачи или None.
+        """
+        now = time.time()
+        ready = ("SELECT * FROM jobs WHERE status = 'queued' AND run_at <= ? ORDER BY run_at LIMIT 1",
+                 "SELECT * FROM jobs WHERE status = 'running' AND locked_until <= ? ORDER BY locked_until LIMIT 1")
+        # Дешёвая проверка без блокировки записи: пустая очередь
+        # не должна мешать покупателям
+        if not any(conn.execute(sql, (now,)).fetchone() for sql in ready):
+            return None
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            job = None
+            for sql in ready:
+                job = conn.execute(sql, (now,)).fetchone()
+                if job:
+                    break
+            if job is None:
+                conn.rollback()
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_until = ? "
+                         "WHERE id = ?", (now + self.lease, job['id']))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        job = dict(job)
+        job['attempts'] += 1
+        return job
+
+    def run_one(self, conn):
+        """
+        Выполняет одну задачу. Возвращает False, если готовых задач нет.
+        """
+        job = self.claim(conn)
+        if job is None:
+            return False
+
+        started = time.perf_counter()
+        try:
+            func = handlers.get(job['kind'])
+            if func is None:
+                raise LookupError(f"Нет обработчика задач {job['kind']}")
+            func(conn, json.loads(job['payload']))
+            conn.execute("UPDATE jobs SET status = 'done', locked_until = NULL, last_error = NULL, "
+                         "finished_at = ? WHERE id = ?", (time.time(), job['id']))
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            self.fail(conn, job, e)
+        else:
+            logger.info(f"Задача {job['id']} ({job['kind']}) выполнена за "
+                        f"{(time.perf_counter() - started) * 1000:.1f} мс")
+        return True
+
+    def fail(self, conn, job, error):
+        """
+        Откладывает упавшую задачу или переводит её в dead.
+        """
+        message = f"{type(error).__name__}: {error}"
+        now = time.time()
+        if job['attempts'] >= job['max_attempts']:
+            status, run_at, finished_at = 'dead', job['run_at'], now
+            logger.error(f"Задача {job['id']} ({job['kind']}) исчерпала попытки: {message}")
+        else:
+            status, finished_at = 'queued', None
+            run_at = now + backoff(job['attempts'], self.retry_base, self.retry_cap)
+            logger.warning(f"Задача {job['id']} ({job['kind']}), попытка {job['attempts']}: {message}; "
+                           f"повтор через {run_at - now:.0f} с")
+        with conn:
+            conn.execute("UPDATE jobs SET status = ?, run_at = ?, locked_until = NULL, last_error = ?, "
+                         "finished_at = ? WHERE id = ?", (status, run_at, message, finished_at, job['id']))
+
+    def _loop(self):
+        conn = self.pool.acquire()
+        try:
+            while not self._stop.is_set():
+                try:
+                    busy = self.run_one(conn)
+                except Exception as e:
+                    # Ошибка самой очереди (например, база занята) — пауза и новая попытка
+                    logger.error(f"Ошибка обработки очереди: {e}")
+                    busy = False
+                if not busy:
+                    self._stop.wait(self.poll_interval)
+        finally:
+            self.pool.release(conn)
+            self.pool.close_all()
+
+    def start(self):
+        """
+        Запускает потоки-обработчики (демоны) и сразу возвращается.
+        """
+        self._stop.clear()
+        self._threads = [threading.Thread(target=self._loop, name=f"jobs-{n}", daemon=True)
+                         for n in range(self.threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Останавливает потоки, дождавшись текущих задач (не дольше timeout).
+        """
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+
+def queue_stats(conn):
+    """
+    Состояние очереди: число задач по типам и статусам, глубина
+    (готовые к выполнению), отложенные повторы и задержка — возраст
+    самой старой готовой задачи в секундах.
+    """
+    now = time.time()
+    counts = {}
+    for kind, status, count in conn.execute("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status"):
+        counts.setdefault(kind, {})[status] = count
+    depth, oldest = conn.execute(
+        "SELECT COUNT(*), MIN(run_at) FROM jobs WHERE status = 'queued' AND run_at <= ?", (now,)).fetchone()
+    delayed = conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND run_at > ?", (now,)).fetchone()[0]
+    return {
+        'counts': counts,
+        'depth': depth,
+        'delayed': delayed,
+        'lag_seconds': round(now - oldest, 3) if oldest is not None else 0.0,
+    }
+
+
+def requeue_dead(conn, job_ids=None):
+    """
+    Возвращает задачи из dead в очередь с обнулённым счётчиком попыток
+    (все или только job_ids). Возвращает число задач.
+    """
+    sql = "UPDATE jobs SET status = 'queued', attempts = 0, run_at = ?, finished_at = NULL WHERE status = 'dead'"
+    params = [time.time()]
+    if job_ids:
+        sql += f" AND id IN ({','.join(['?'] * len(job_ids))})"
+        params += list(job_ids)
+    with conn:
+        return conn.execute(sql, params).rowcount
+
+
+def purge_done(conn, older_than):
+    """
+    Удаляет выполненные задачи старше older_than секунд.
+    Возвращает число удалённых.
+    """
+    with conn:
+        return conn.execute("DELETE FROM jobs WHERE status = 'done' AND finished_at < ?",
+                            (time.time() - older_than,)).rowcount
@@ -0,0 +1,322 @@
+"""
+Версионные миграции схемы без потери данных.
+
+Номер применённой миграции хранится в PRAGMA user_version. Каждая
+миграция состоит из двух частей:
+- schema(conn) — изменения схемы; выполняется в транзакции BEGIN IMMEDIATE
+  с повторной проверкой версии, поэтому несколько процессов, запустившихся
+  одновременно, не применят её дважды;
+- backfill(conn) — необязательное заполнение данных порциями по id
+  в отдельных коротких транзакциях, чтобы работающий магазин не ждал
+  блокировку записи всё время миграции.
+Версия повышается только после backfill: прерванная миграция будет
+повторена целиком, включая backfill, даже если схема уже изменена
+(обе части идемпотентны).
+
+После миграций PLAN_CHECKS сверяет через EXPLAIN QUERY PLAN, что основные
+запросы действительно используют ожидаемые индексы.
+"""
+
+import logging
+import sqlite3
+import time
+
+from init_db import (BACKFILL_ORDER_TOTALS, CART_SCHEMA, CATALOG_INDEXES, CATALOG_VERSION_SCHEMA,
+                     HOLDS_VERSION_TRIGGERS, JOBS_SCHEMA, ORDER_CHANGES_SCHEMA, ORDER_TOTALS_TRIGGERS,
+                     PAYMENT_COLUMNS, PAYMENT_INDEXES, PAYMENT_STATE_BACKFILL, PRODUCT_CHANGES_SCHEMA,
+                     RECOMMENDATIONS_SCHEMA, RESERVATIONS_SCHEMA, SEARCH_SCHEMA, USER_PURCHASES_BACKFILL,
+                     USER_PURCHASES_SCHEMA)
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH = 5000
+
+
+class MigrationError(Exception):
+    """
+    Миграция не может быть применена к этой базе.
+    """
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def table_exists(conn, name):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def batched_update(conn, table, sql, batch_size=BACKFILL_BATCH, pause=0.0):
+    """
+    Выполняет UPDATE sql (без WHERE) для строк table диапазонами id
+    по batch_size, каждый диапазон — отдельная транзакция.
+    pause — пауза между порциями (с), чтобы пропустить запись приложения.
+    """
+    bounds = conn.execute(f"SELECT MIN(id), MAX(id) FROM {table}").fetchone()
+    if bounds[0] is None:
+        return
+    low, high = bounds
+    started = time.perf_counter()
+    for start in range(low, high + 1, batch_size):
+        with conn:
+            conn.execute(f"{sql} WHERE id BETWEEN ? AND ?", (start, start + batch_size - 1))
+        if pause:
+            time.sleep(pause)
+    logger.info(f"{table}: заполнено {high - low + 1} id за {time.perf_counter() - started:.1f} с")
+
+
+# === Миграции ===
+
+def cart_items_schema(conn):
+    conn.execute(CART_SCHEMA)
+
+
+def order_totals_schema(conn):
+    existing = columns(conn, 'orders')
+    if 'total_amount' not in existing:
+        conn.execute("ALTER TABLE orders ADD COLUMN total_amount REAL NOT NULL DEFAULT 0")
+    if 'item_count' not in existing:
+        conn.execute("ALTER TABLE orders ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0")
+    # Триггеры создаются до заполнения: заказы, оформленные во время
+    # backfill, учитываются ими, а пересчёт по order_items идемпотентен
+    for statement in ORDER_TOTALS_TRIGGERS:
+        conn.execute(statement)
+
+
+def order_totals_backfill(conn):
+    batched_update(conn, 'orders', BACKFILL_ORDER_TOTALS)
+
+
+def order_indexes_schema(conn):
+    # (user_id, order_date) заменяет индекс orders(user_id)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders(user_id, order_date)")
+    conn.execute("DROP INDEX IF EXISTS idx_orders_user")
+
+
+def catalog_indexes_schema(conn):
+    for statement in CATALOG_INDEXES:
+        conn.execute(statement)
+
+
+def search_index_schema(conn):
+    exists = table_exists(conn, 'products_fts')
+    for statement in SEARCH_SCHEMA:
+        conn.execute(statement)
+    if not exists:
+        # Заполнение внешнего FTS-индекса нельзя делить на порции:
+        # триггеры уже работают, и частично заполненный индекс
+        # получил бы «delete» для строк, которых в нём ещё нет
+        conn.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+
+def catalog_version_schema(conn):
+    for statement in CATALOG_VERSION_SCHEMA:
+        conn.execute(statement)
+
+
+def users_image_schema(conn):
+    # register() сохраняет image_filename, которой не было в схеме users
+    if 'image_filename' not in columns(conn, 'users'):
+        conn.execute("ALTER TABLE users ADD COLUMN image_filename TEXT")
+
+
+def jobs_schema(conn):
+    for statement in JOBS_SCHEMA:
+        conn.execute(statement)
+
+
+def payment_state_schema(conn):
+    existing = columns(conn, 'payments')
+    for name in PAYMENT_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE payments ADD COLUMN {name} {PAYMENT_COLUMNS[name]}")
+    for statement in PAYMENT_INDEXES:
+        conn.execute(statement)
+
+
+def payment_state_backfill(conn):
+    batched_update(conn, 'payments', PAYMENT_STATE_BACKFILL)
+
+
+def product_changes_schema(conn):
+    # Журнал начинается пустым: фасетный индекс строится по самим товарам
+    for statement in PRODUCT_CHANGES_SCHEMA:
+        conn.execute(statement)
+
+
+def reservations_schema(conn):
+    for statement in RESERVATIONS_SCHEMA:
+        conn.execute(statement)
+
+
+def order_changes_schema(conn):
+    # Журнал начинается пустым: сводки отчётов при первом обновлении
+    # строятся по всем заказам
+    for statement in ORDER_CHANGES_SCHEMA:
+        conn.execute(statement)
+
+
+def recommendations_schema(conn):
+    # Таблица заполняется построением рекомендаций (flask recommendations build)
+    conn.execute(RECOMMENDATIONS_SCHEMA)
+
+
+def user_purchases_schema(conn):
+    for statement in USER_PURCHASES_SCHEMA:
+        conn.execute(statement)
+
+
+def user_purchases_backfill(conn):
+    # Триггер уже пополняет таблицу новыми покупками; INSERT OR IGNORE
+    # не даёт повторам помешать заполнению порциями по order_items.id
+    batched_update(conn, 'order_items', USER_PURCHASES_BACKFILL)
+
+
+def holds_version_schema(conn):
+    if 'holds' not in columns(conn, 'catalog_version'):
+        conn.execute("ALTER TABLE catalog_version ADD COLUMN holds INTEGER NOT NULL DEFAULT 0")
+    for statement in HOLDS_VERSION_TRIGGERS:
+        conn.execute(statement)
+
+
+class Migration:
+    """
+    Одна миграция: номер (значение user_version после неё), описание,
+    изменение схемы и необязательный backfill.
+    """
+
+    def __init__(self, version, description, schema, backfill=None):
+        self.version = version
+        self.description = description
+        self.schema = schema
+        self.backfill = backfill
+
+
+MIGRATIONS = [
+    Migration(1, 'серверные корзины cart_items', cart_items_schema),
+    Migration(2, 'итоги заказов orders.total_amount/item_count', order_totals_schema, order_totals_backfill),
+    Migration(3, 'индекс orders(user_id, order_date)', order_indexes_schema),
+    Migration(4, 'индексы каталога', catalog_indexes_schema),
+    Migration(5, 'полнотекстовый индекс products_fts', search_index_schema),
+    Migration(6, 'версия каталога catalog_version', catalog_version_schema),
+    Migration(7, 'users.image_filename', users_image_schema),
+    Migration(8, 'очередь фоновых задач jobs', jobs_schema),
+    Migration(9, 'состояние и ключ идемпотентности платежей', payment_state_schema, payment_state_backfill),
+    Migration(10, 'журнал изменений товаров для фасетов', product_changes_schema),
+    Migration(11, 'резервы товаров в корзинах stock_reservations', reservations_schema),
+    Migration(12, 'журнал изменений заказов для отчётов', order_changes_schema),
+    Migration(13, 'рекомендации товаров product_recommendations', recommendations_schema),
+    Migration(14, 'купленные пользователями товары user_purchases', user_purchases_schema, user_purchases_backfill),
+    Migration(15, 'счётчик изменений резервов catalog_version.holds', holds_version_schema),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# Проверки планов: (описание, запрос, ожидаемый фрагмент EXPLAIN QUERY PLAN)
+PLAN_CHECKS = [
+    ('история заказов',
+     "SELECT id FROM orders WHERE user_id = 1 AND order_date < '9999' ORDER BY order_date DESC, id DESC LIMIT 20",
+     'idx_orders_user_date'),
+    ('каталог по категории и цене',
+     "SELECT id FROM products WHERE category_id = 1 AND stock_quantity > 0 ORDER BY price, id LIMIT 24",
+     'idx_products_category_stock_price'),
+    ('корзина', "SELECT product_id, quantity FROM cart_items WHERE owner = 'user:1'", 'PRIMARY KEY'),
+    ('поиск', "SELECT rowid FROM products_fts WHERE products_fts MATCH 'lego'", 'VIRTUAL TABLE'),
+    ('позиции заказа', "SELECT product_id FROM order_items WHERE order_id = 1", 'INDEX'),
+    ('очередь задач',
+     "SELECT id FROM jobs WHERE status = 'queued' AND run_at <= 0 ORDER BY run_at LIMIT 1",
+     'idx_jobs_status_run_at'),
+    ('резервы товара',
+     "SELECT SUM(quantity) FROM stock_reservations WHERE product_id = 1 AND expires_at > 0",
+     'idx_reservations_product'),
+    ('рекомендации товара',
+     "SELECT neighbor_id FROM product_recommendations WHERE product_id = 1 ORDER BY rank",
+     'PRIMARY KEY'),
+    ('купленные из рекомендаций',
+     "SELECT product_id FROM user_purchases WHERE user_id = 1 AND product_id IN (2, 3)",
+     'PRIMARY KEY'),
+]
+
+
+def get_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def set_version(conn, version):
+    conn.execute(f"PRAGMA user_version = {int(version)}")
+
+
+def apply_migration(conn, migration):
+    """
+    Применяет одну миграцию. Возвращает False, если её уже применил
+    другой процесс.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if get_version(conn) >= migration.version:
+            conn.rollback()
+            return False
+        migration.schema(conn)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    # Backfill выполняется при каждом применении, а не только когда схема
+    # только что изменилась: иначе после прерванного заполнения повтор
+    # увидел бы готовые колонки и поднял версию с незаполненными данными
+    if migration.backfill:
+        migration.backfill(conn)
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if get_version(conn) < migration.version:
+            set_version(conn, migration.version)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return True
+
+
+def pending(conn):
+    current = get_version(conn)
+    return [migration for migration in MIGRATIONS if migration.version > current]
+
+
+def migrate(conn, target=None):
+    """
+    Применяет все миграции новее PRAGMA user_version (до target включительно).
+    Возвращает список применённых миграций.
+    """
+    current = get_version(conn)
+    if current > LATEST_VERSION:
+        raise MigrationError(f"Версия базы {current} новее, чем знает приложение ({LATEST_VERSION})")
+
+    applied = []
+    for migration in pending(conn):
+        if target is not None and migration.version > target:
+            break
+        started = time.perf_counter()
+        if apply_migration(conn, migration):
+            applied.append(migration)
+            logger.info(f"Миграция {migration.version} ({migration.description}) применена "
+                        f"за {time.perf_counter() - started:.1f} с")
+    return applied
+
+
+def check_plans(conn):
+    """
+    Проверяет планы основных запросов. Возвращает список
+    (описание, план) для запросов, не использующих ожидаемый индекс.
+    """
+    failures = []
+    for description, sql, expected in PLAN_CHECKS:
+        try:
+            plan = '; '.join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}"))
+        except sqlite3.Error as e:
+            plan = f"ошибка: {e}"
+        if expected not in plan:
+            failures.append((description, plan))
+    return failures
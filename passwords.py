@@ -0,0 +1,83 @@
+"""
+Хэширование паролей вне потоков-обработчиков.
+
+generate_password_hash/check_password_hash из werkzeug намеренно дорогие
+(сотни тысяч итераций KDF) и держат GIL, поэтому всплеск попыток входа
+занимает все потоки и тормозит каталог. PasswordHasher выполняет их
+в ограниченном пуле процессов, а число одновременных операций ограничено:
+лишние запросы получают HasherBusy вместо ожидания в очереди.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+logger = logging.getLogger(__name__)
+
+
+class HasherBusy(Exception):
+    """
+    Все места для хэширования заняты дольше допустимого ожидания.
+    """
+
+
+class PasswordHasher:
+    """
+    Хэширование и проверка паролей в пуле из workers процессов.
+
+    method — текущие параметры KDF в формате werkzeug
+    (например, 'pbkdf2:sha256:600000'); хэши с другими параметрами
+    считаются устаревшими (needs_rehash). max_in_flight — сколько операций
+    может выполняться или ждать пула одновременно, queue_timeout — сколько
+    секунд запрос ждёт свободного места. При workers=0 хэширование
+    выполняется в потоке запроса (ограничение одновременности остаётся).
+    """
+
+    def __init__(self, method='pbkdf2:sha256:600000', workers=2, max_in_flight=8, queue_timeout=2.0):
+        self.method = method
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _pool(self):
+        # Пул создаётся лениво и заново после fork (serve.py):
+        # процессы пула родителя дочернему воркеру не принадлежат
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HasherBusy()
+        try:
+            if self.workers <= 0:
+                return func(*args)
+            return self._pool().submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """
+        True, если хэш получен с параметрами KDF, отличными от текущих.
+        """
+        return password_hash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
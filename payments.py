@@ -0,0 +1,243 @@
+"""
+Оплата заказов через платёжный шлюз.
+
+Платёж проходит состояния pending → authorized → captured; из pending
+и authorized возможен переход в failed, из failed — новая попытка (pending).
+Каждая попытка несёт ключ идемпотентности: шлюз по нему не проводит
+операцию дважды, а уникальный payments.idempotency_key не даёт повторной
+отправке формы начать новую попытку.
+
+Шлюз вызывается вне транзакций: состояние фиксируется короткими
+транзакциями до и после каждого вызова, поэтому ожидание ответа банка
+не держит ни блокировку записи, ни соединение из пула. Если шлюз не ответил
+за timeout, исход неизвестен: платёж остаётся в текущем состоянии
+и доводится повторным вызовом с тем же ключом.
+"""
+
+import random
+import threading
+import time
+import uuid
+
+from werkzeug.utils import import_string
+
+PENDING = 'pending'
+AUTHORIZED = 'authorized'
+CAPTURED = 'captured'
+FAILED = 'failed'
+
+TRANSITIONS = {
+    PENDING: {AUTHORIZED, FAILED},
+    AUTHORIZED: {CAPTURED, FAILED},
+    FAILED: {PENDING},
+    CAPTURED: set(),
+}
+
+# Статус для страниц (payments.status) по состоянию платежа
+STATUS_LABELS = {
+    PENDING: 'Ожидание',
+    AUTHORIZED: 'Авторизован',
+    CAPTURED: 'Успешно',
+    FAILED: 'Ошибка',
+}
+
+
+class PaymentError(Exception):
+    """
+    Платёж не может быть проведён сейчас.
+    """
+
+
+class GatewayDeclined(PaymentError):
+    """
+    Шлюз окончательно отклонил операцию.
+    """
+
+
+class GatewayTimeout(PaymentError):
+    """
+    Шлюз не ответил вовремя; операция могла пройти.
+    """
+
+
+class PaymentInProgress(PaymentError):
+    """
+    По заказу уже идёт другая попытка оплаты.
+    """
+
+
+class AlreadyPaid(PaymentError):
+    """
+    Заказ уже оплачен.
+    """
+
+
+class PaymentGateway:
+    """
+    Интерфейс платёжного шлюза. Повторный вызов с тем же ключом
+    идемпотентности должен возвращать тот же результат.
+    """
+
+    def authorize(self, key, amount, method, timeout):
+        """Блокирует сумму. Возвращает идентификатор авторизации в шлюзе."""
+        raise NotImplementedError
+
+    def capture(self, reference, key, timeout):
+        """Списывает ранее авторизованную сумму."""
+        raise NotImplementedError
+
+
+class StubGateway(PaymentGateway):
+    """
+    Шлюз-заглушка в памяти процесса для разработки и нагрузочных тестов.
+    latency — задержка каждого вызова (с), failure_rate — доля отказов
+    авторизации, timeout_rate — доля вызовов, ответ на которые «теряется»
+    (операция проходит, но вызывающий получает GatewayTimeout).
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, timeout_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._authorizations = {}
+        self._captured = set()
+
+    def _roll(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def _respond(self, timeout, result):
+        if self.latency > timeout:
+            time.sleep(timeout)
+            raise GatewayTimeout(f"Шлюз не ответил за {timeout} с")
+        time.sleep(self.latency)
+        if self._roll(self.timeout_rate):
+            raise GatewayTimeout("Ответ шлюза потерян")
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def authorize(self, key, amount, method, timeout):
+        with self._lock:
+            result = self._authorizations.get(key)
+        if result is None:
+            if self._roll(self.failure_rate):
+                result = GatewayDeclined("Платёж отклонён банком")
+            else:
+                result = f"stub-{uuid.uuid4().hex[:16]}"
+            with self._lock:
+                result = self._authorizations.setdefault(key, result)
+        return self._respond(timeout, result)
+
+    def capture(self, reference, key, timeout):
+        with self._lock:
+            known = self._authorizations.get(key) == reference
+            if known:
+                self._captured.add(reference)
+        return self._respond(timeout, None if known else GatewayDeclined("Неизвестная авторизация"))
+
+
+def load_gateway(spec, **stub_options):
+    """
+    Шлюз по настройке: 'stub' — StubGateway(**stub_options),
+    иначе путь к классу ('package.module:Class'), создаваемому без аргументов.
+    """
+    if spec == 'stub':
+        return StubGateway(**stub_options)
+    return import_string(spec)()
+
+
+def start_payment(conn, order_id, amount, method, key, stale_after):
+    """
+    Открывает попытку оплаты заказа одной короткой транзакцией.
+    Возвращает словарь платежа. Повтор с тем же ключом возвращает ту же
+    попытку; попытка, не обновлявшаяся stale_after секунд (упавший запрос),
+    продолжается со своим ключом. Выбрасывает AlreadyPaid и PaymentInProgress.
+    """
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT * FROM payments WHERE order_id = ?", (order_id,)).fetchone()
+        payment = dict(row) if row else None
+        in_progress = payment and payment['state'] in (PENDING, AUTHORIZED) and payment['idempotency_key']
+        if payment and payment['state'] == CAPTURED:
+            raise AlreadyPaid()
+        if payment and payment['idempotency_key'] == key and payment['state'] == FAILED:
+            conn.rollback()
+            return payment
+        if in_progress:
+            if payment['updated_at'] and now - payment['updated_at'] < stale_after:
+                raise PaymentInProgress()
+            conn.execute("UPDATE payments SET updated_at = ? WHERE id = ?", (now, payment['id']))
+            payment['updated_at'] = now
+        elif payment:
+            conn.execute("""
+                UPDATE payments SET state = ?, status = ?, method = ?, amount = ?, idempotency_key = ?,
+                                    gateway_ref = NULL, error = NULL, payment_date = NULL, updated_at = ?
+                WHERE id = ?
+            """, (PENDING, STATUS_LABELS[PENDING], method, amount, key, now, payment['id']))
+            payment = dict(conn.execute("SELECT * FROM payments WHERE id = ?", (payment['id'],)).fetchone())
+        else:
+            cursor = conn.execute("""
+                INSERT INTO payments (order_id, method, amount, status, state, idempotency_key, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (order_id, method, amount, STATUS_LABELS[PENDING], PENDING, key, now))
+            payment = dict(conn.execute("SELECT * FROM payments WHERE id = ?", (cursor.lastrowid,)).fetchone())
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return payment
+
+
+def transition(conn, payment, state, **fields):
+    """
+    Переводит платёж в состояние state, если он всё ещё в payment['state']
+    (иначе его уже продвинул другой процесс — PaymentError).
+    При переходе в captured заказ отмечается оплаченным.
+    """
+    if state not in TRANSITIONS[payment['state']]:
+        raise PaymentError(f"Недопустимый переход {payment['state']} → {state}")
+    fields.update(state=state, status=STATUS_LABELS[state], updated_at=time.time())
+    assignments = ', '.join(f"{name} = ?" for name in fields)
+    with conn:
+        cursor = conn.execute(f"UPDATE payments SET {assignments} WHERE id = ? AND state = ?",
+                              [*fields.values(), payment['id'], payment['state']])
+        if cursor.rowcount and state == CAPTURED:
+            conn.execute("UPDATE orders SET status = 'Оплачен' WHERE id = ?", (payment['order_id'],))
+    if not cursor.rowcount:
+        raise PaymentError(f"Платёж {payment['id']} уже изменён другим процессом")
+    return dict(payment, **fields)
+
+
+def complete_payment(gateway, payment, connection, timeout):
+    """
+    Доводит попытку до captured или failed через шлюз. connection() —
+    контекстный менеджер, дающий соединение на время записи состояния:
+    между вызовами шлюза соединение не удерживается.
+    Возвращает итоговый словарь платежа; GatewayTimeout пробрасывается,
+    платёж при этом остаётся в текущем состоянии.
+    """
+    key = payment['idempotency_key']
+    if payment['state'] == PENDING:
+        try:
+            reference = gateway.authorize(key, payment['amount'], payment['method'], timeout)
+        except GatewayDeclined as e:
+            with connection() as conn:
+                return transition(conn, payment, FAILED, error=str(e))
+        with connection() as conn:
+            payment = transition(conn, payment, AUTHORIZED, gateway_ref=reference)
+
+    if payment['state'] == AUTHORIZED:
+        try:
+            gateway.capture(payment['gateway_ref'], key, timeout)
+        except GatewayDeclined as e:
+            with connection() as conn:
+                return transition(conn, payment, FAILED, error=str(e))
+        with connection() as conn:
+            # В UTC, как CURRENT_TIMESTAMP у order_date и остальных дат
+            payment = transition(conn, payment, CAPTURED,
+                                 payment_date=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))
+    return payment
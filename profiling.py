@@ -0,0 +1,264 @@
+"""
+Профилирование SQL-запросов.
+
+InstrumentedConnection/InstrumentedCursor — подклассы sqlite3, которые
+замеряют каждый запрос (текст, длительность, число строк) и передают его
+в QueryProfiler. Профилировщик собирает запросы текущего HTTP-запроса,
+ищет N+1 (один и тот же запрос много раз за запрос), пишет в лог медленные
+запросы вместе с EXPLAIN QUERY PLAN и накапливает агрегаты по endpoint
+для выдачи в формате Prometheus.
+
+Если профилирование выключено, пул открывает обычные sqlite3.Connection —
+накладных расходов нет вовсе.
+"""
+
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+# Служебные операторы, для которых план запроса не строится
+_NO_PLAN = ('BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA', 'SAVEPOINT', 'RELEASE', 'EXPLAIN')
+
+
+def normalize_sql(sql):
+    """
+    Приводит текст запроса к одной строке без лишних пробелов.
+    """
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryRecord:
+    """
+    Один выполненный запрос: текст, длительность (с) и число строк.
+    """
+
+    __slots__ = ('sql', 'duration', 'rows')
+
+    def __init__(self, sql, duration, rows):
+        self.sql = sql
+        self.duration = duration
+        self.rows = rows
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Курсор, сообщающий профилировщику о каждом execute/executemany
+    и досчитывающий строки и время при выборке результатов.
+    """
+
+    _record = None
+
+    def _profiler(self):
+        return self.connection.profiler
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        super().execute(sql, parameters)
+        duration = time.perf_counter() - started
+        rows = self.rowcount if self.rowcount > 0 else 0
+        self._record = self._profiler().record(self.connection, sql, parameters, duration, rows)
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        duration = time.perf_counter() - started
+        rows = self.rowcount if self.rowcount > 0 else 0
+        self._record = self._profiler().record(self.connection, sql, None, duration, rows)
+        return self
+
+    def _fetched(self, rows, started):
+        if self._record is not None:
+            self._record.rows += rows
+            self._record.duration += time.perf_counter() - started
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(row is not None, started)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(len(rows), started)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), started)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        row = super().__next__()
+        self._fetched(1, started)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Соединение, все курсоры которого — InstrumentedCursor.
+    Встроенный Connection.execute() создаёт курсор в обход cursor(),
+    поэтому execute/executemany переопределены явно.
+    """
+
+    profiler = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class QueryProfiler:
+    """
+    Сборщик статистики SQL по HTTP-запросам.
+
+    slow_ms — порог медленного запроса (мс), n_plus_one — сколько раз
+    один и тот же запрос может выполниться за HTTP-запрос, прежде чем
+    это будет считаться N+1.
+    """
+
+    def __init__(self, slow_ms=100.0, n_plus_one=5):
+        self.slow_ms = slow_ms
+        self.n_plus_one = n_plus_one
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        self.slow_queries = 0
+
+    def connection_factory(self):
+        """
+        Возвращает класс соединения для sqlite3.connect(factory=...),
+        привязанный к этому профилировщику.
+        """
+        profiler = self
+
+        class Connection(InstrumentedConnection):
+            pass
+
+        Connection.profiler = profiler
+        return Connection
+
+    def start_request(self):
+        self._local.queries = []
+
+    def record(self, conn, sql, parameters, duration, rows):
+        entry = QueryRecord(sql, duration, rows)
+        queries = getattr(self._local, 'queries', None)
+        if queries is not None:
+            queries.append(entry)
+        if duration * 1000 >= self.slow_ms:
+            self._log_slow(conn, sql, parameters, duration)
+        return entry
+
+    def _log_slow(self, conn, sql, parameters, duration):
+        with self._lock:
+            self.slow_queries += 1
+        text = normalize_sql(sql)
+        plan = ''
+        if parameters is not None and not text.upper().startswith(_NO_PLAN):
+            try:
+                # Обычный курсор: сам EXPLAIN не должен попадать в статистику
+                rows = sqlite3.Cursor(conn).execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()
+                plan = '; '.join(row[3] for row in rows)
+            except sqlite3.Error as e:
+                plan = f"план недоступен: {e}"
+        logger.warning(f"Медленный запрос {duration * 1000:.1f} мс: {text} | план: {plan}")
+
+    def finish_request(self, endpoint):
+        """
+        Завершает учёт HTTP-запроса: ищет N+1 и добавляет его
+        запросы в агрегаты endpoint. Возвращает список QueryRecord.
+        """
+        queries = getattr(self._local, 'queries', None)
+        self._local.queries = None
+        if queries is None:
+            return []
+
+        repeats = {}
+        for entry in queries:
+            key = normalize_sql(entry.sql)
+            repeats[key] = repeats.get(key, 0) + 1
+        suspicious = {sql: n for sql, n in repeats.items() if n >= self.n_plus_one}
+        for sql, n in suspicious.items():
+            logger.warning(f"Возможный N+1 в {endpoint}: запрос выполнен {n} раз: {sql}")
+
+        endpoint = endpoint or 'unknown'
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'queries': 0, 'seconds': 0.0, 'rows': 0, 'n_plus_one': 0})
+            stats['requests'] += 1
+            stats['queries'] += len(queries)
+            stats['seconds'] += sum(entry.duration for entry in queries)
+            stats['rows'] += sum(entry.rows for entry in queries)
+            stats['n_plus_one'] += len(suspicious)
+        return queries
+
+    def snapshot(self):
+        """
+        Копия агрегатов: ({endpoint: stats}, число медленных запросов).
+        """
+        with self._lock:
+            return {name: dict(stats) for name, stats in self.endpoints.items()}, self.slow_queries
+
+
+def prometheus_metrics(profiler, caches):
+    """
+    Формирует текст метрик в формате Prometheus exposition.
+    profiler может быть None (профилирование выключено);
+    caches — словарь {имя: LRUCache}.
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+    endpoints, slow = profiler.snapshot() if profiler else ({}, 0)
+    for field, name, help_text in [
+        ('requests', 'toy_store_http_requests_total', 'Профилированные HTTP-запросы.'),
+        ('queries', 'toy_store_sql_queries_total', 'Выполненные SQL-запросы.'),
+        ('seconds', 'toy_store_sql_query_seconds_total', 'Суммарное время SQL-запросов.'),
+        ('rows', 'toy_store_sql_rows_total', 'Строки, прочитанные или изменённые SQL-запросами.'),
+        ('n_plus_one', 'toy_store_sql_n_plus_one_total', 'HTTP-запросы с повторяющимися SQL (N+1).'),
+    ]:
+        metric(name, 'counter', help_text,
+               [({'endpoint': endpoint}, round(stats[field], 6)) for endpoint, stats in sorted(endpoints.items())])
+    metric('toy_store_sql_slow_queries_total', 'counter', 'Запросы дольше порога.', [({}, slow)])
+    metric('toy_store_sql_profiling_enabled', 'gauge', 'Включено ли профилирование SQL.',
+           [({}, int(profiler is not None))])
+
+    for field, name, kind in [
+        ('hits', 'toy_store_cache_hits_total', 'counter'),
+        ('misses', 'toy_store_cache_misses_total', 'counter'),
+        ('evictions', 'toy_store_cache_evictions_total', 'counter'),
+        ('invalidations', 'toy_store_cache_invalidations_total', 'counter'),
+        ('size', 'toy_store_cache_entries', 'gauge'),
+    ]:
+        metric(name, kind, f"Кэш: {field}.",
+               [({'cache': cache_name}, cache.stats()[field]) for cache_name, cache in sorted(caches.items())])
+    metric('toy_store_cache_bytes', 'gauge', 'Кэш: занятая память (для кэшей с ограничением по объёму).',
+           [({'cache': cache_name}, cache.stats()['bytes']) for cache_name, cache in sorted(caches.items())
+            if 'bytes' in cache.stats()])
+
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,57 @@
+"""
+Ограничение частоты запросов алгоритмом token bucket.
+
+У каждого ключа (IP-адрес, email) своё «ведро» на capacity жетонов,
+которое пополняется со скоростью rate жетонов в секунду. Запрос забирает
+жетон; пустое ведро означает отказ. Вёдра хранятся в LRUCache, поэтому
+память ограничена, а давно не использовавшиеся ключи вытесняются.
+"""
+
+import threading
+import time
+
+from cache import LRUCache
+
+
+class RateLimiter:
+    """
+    Набор token bucket по ключам.
+    capacity — размер всплеска, rate — жетонов в секунду (больше нуля), max_keys —
+    сколько ключей помнить одновременно.
+    """
+
+    def __init__(self, capacity=5, rate=0.1, max_keys=10000, clock=time.monotonic):
+        self.capacity = capacity
+        self.rate = rate
+        self._clock = clock
+        # Полное ведро без обращений за capacity / rate секунд
+        # ничем не отличается от нового, поэтому дольше его хранить незачем
+        self._buckets = LRUCache(max_size=max_keys, ttl=capacity / rate, clock=clock)
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1):
+        """
+        Забирает cost жетонов из ведра key. Возвращает False,
+        если жетонов не хватает (ведро при этом не меняется).
+        """
+        with self._lock:
+            now = self._clock()
+            tokens, updated = self._buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets.set(key, (tokens, now))
+            return allowed
+
+    def retry_after(self, key, cost=1):
+        """
+        Через сколько секунд в ведре key наберётся cost жетонов.
+        """
+        with self._lock:
+            now = self._clock()
+            tokens, updated = self._buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                return 0.0
+            return (cost - tokens) / self.rate
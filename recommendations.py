@@ -0,0 +1,292 @@
+"""
+Рекомендации «с этим товаром покупают»: соседи товара по совместным покупкам.
+
+Матрица совместных покупок — разреженная таблица product_pairs
+(пара товаров → число заказов, где они встретились вместе; хранятся
+обе пары (a, b) и (b, a)) и product_orders (товар → число заказов с ним).
+Она живёт в отдельной базе RECOMMENDATIONS_DATABASE и считается самим
+SQLite: основная база подключается через ATTACH, а пары получаются
+самосоединением order_items по order_id с GROUP BY — порциями заказов
+по id, без цикла Python по строкам. Основная база при этом только читается.
+
+Из матрицы для каждого товара отбираются top_k соседей по мере Жаккара
+pairs(a, b) / (orders(a) + orders(b) - pairs(a, b)) — она не даёт самым
+популярным товарам попасть в соседи ко всем; пара должна встретиться
+не меньше min_support раз. Списки записываются в таблицу
+product_recommendations основной базы короткой транзакцией, которая
+меняет и версию каталога — по ней кэшируются страницы товаров. Страница
+товара читает список одним запросом по первичному ключу.
+
+Обновление инкрементальное: заказы с id больше водяного знака добавляют
+свои пары, и соседи пересчитываются только для товаров из этих заказов.
+Отмены и удаления заказов, а также изменение популярности соседей
+учитывает полное перестроение — не реже раза в rebuild_interval секунд.
+Отменённые заказы и заказы больше max_lines позиций (оптовые, дают
+квадратичное число пар) не учитываются.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CANCELLED = 'Отменен'
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)",
+    """
+    CREATE TABLE IF NOT EXISTS product_pairs (
+        product_id INTEGER NOT NULL,
+        other_id INTEGER NOT NULL,
+        orders INTEGER NOT NULL,
+        PRIMARY KEY (product_id, other_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE TABLE IF NOT EXISTS product_orders (product_id INTEGER PRIMARY KEY, orders INTEGER NOT NULL)",
+    # Готовые списки соседей перед копированием в основную базу
+    """
+    CREATE TABLE IF NOT EXISTS neighbors (
+        product_id INTEGER NOT NULL,
+        rank INTEGER NOT NULL,
+        neighbor_id INTEGER NOT NULL,
+        score REAL NOT NULL,
+        PRIMARY KEY (product_id, rank)
+    ) WITHOUT ROWID
+    """,
+]
+
+
+class Recommender:
+    """
+    Построение рекомендаций по основной базе store_path с матрицей
+    совместных покупок в базе path.
+    """
+
+    def __init__(self, store_path, path, top_k=10, min_support=2, max_lines=50):
+        self.store_path = store_path
+        self.path = path
+        self.top_k = top_k
+        self.min_support = min_support
+        self.max_lines = max_lines
+
+    def connect(self):
+        """
+        Соединение с базой матрицы и подключённой основной базой (store).
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute("PRAGMA cache_size = -64000")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+        conn.execute("ATTACH DATABASE ? AS store", (self.store_path,))
+        return conn
+
+    def _add_orders(self, conn, low, high):
+        """
+        Добавляет в матрицу заказы с id из [low, high].
+        """
+        batch = """
+            SELECT o.id FROM store.orders o
+            WHERE o.id BETWEEN ? AND ? AND o.status != ?
+              AND (SELECT COUNT(*) FROM store.order_items WHERE order_id = o.id) <= ?
+        """
+        params = (low, high, CANCELLED, self.max_lines)
+        conn.execute(f"""
+            INSERT INTO product_orders (product_id, orders)
+            SELECT product_id, COUNT(*) FROM store.order_items
+            WHERE order_id IN ({batch})
+            GROUP BY product_id
+            ON CONFLICT (product_id) DO UPDATE SET orders = orders + excluded.orders
+        """, params)
+        conn.execute(f"""
+            INSERT INTO product_pairs (product_id, other_id, orders)
+            SELECT a.product_id, b.product_id, COUNT(*)
+            FROM store.order_items a
+            JOIN store.order_items b ON b.order_id = a.order_id AND b.product_id != a.product_id
+            WHERE a.order_id IN ({batch})
+            GROUP BY a.product_id, b.product_id
+            ON CONFLICT (product_id, other_id) DO UPDATE SET orders = orders + excluded.orders
+        """, params)
+
+    def _rank(self, conn, touched=False):
+        """
+        Пересчитывает списки соседей в neighbors: всех товаров или (touched)
+        только перечисленных во временной таблице touched.
+        """
+        only = "AND p.product_id IN (SELECT product_id FROM touched)" if touched else ''
+        conn.execute("DELETE FROM neighbors" + (" WHERE product_id IN (SELECT product_id FROM touched)"
+                                                if touched else ''))
+        conn.execute(f"""
+            INSERT INTO neighbors (product_id, rank, neighbor_id, score)
+            SELECT product_id, rank, other_id, score FROM (
+                SELECT p.product_id, p.other_id,
+                       p.orders * 1.0 / (a.orders + b.orders - p.orders) AS score,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY p.product_id
+                           ORDER BY p.orders * 1.0 / (a.orders + b.orders - p.orders) DESC, p.orders DESC, p.other_id
+                       ) AS rank
+                FROM product_pairs p
+                JOIN product_orders a ON a.product_id = p.product_id
+                JOIN product_orders b ON b.product_id = p.other_id
+                WHERE p.orders >= ? {only}
+            )
+            WHERE rank <= ?
+        """, (self.min_support, self.top_k))
+
+    def _publish(self, conn, touched=False):
+        """
+        Копирует списки соседей (всех товаров или только touched) в основную
+        базу одной короткой транзакцией.
+        """
+        only = "WHERE product_id IN (SELECT product_id FROM touched)" if touched else ''
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(f"DELETE FROM store.product_recommendations {only}")
+            conn.execute(f"""
+                INSERT INTO store.product_recommendations (product_id, rank, neighbor_id, score)
+                SELECT product_id, rank, neighbor_id, score FROM neighbors {only}
+            """)
+            # Страницы товаров кэшируются по версии каталога (ETag):
+            # без её смены клиенты получали бы 304 со старыми соседями
+            conn.execute("UPDATE store.catalog_version SET version = version + 1, "
+                         "updated_at = CURRENT_TIMESTAMP WHERE id = 1")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def build(self, batch_size=20000):
+        """
+        Строит матрицу и списки соседей заново по всем заказам.
+        Возвращает статистику построения.
+        """
+        started = time.perf_counter()
+        conn = self.connect()
+        try:
+            high = conn.execute("SELECT COALESCE(MAX(id), 0) FROM store.orders").fetchone()[0]
+            # Без водяного знака прерванное построение начнётся заново
+            with conn:
+                conn.execute("DELETE FROM meta")
+                conn.execute("DELETE FROM product_pairs")
+                conn.execute("DELETE FROM product_orders")
+            for low in range(1, high + 1, batch_size):
+                with conn:
+                    self._add_orders(conn, low, min(high, low + batch_size - 1))
+            with conn:
+                self._rank(conn)
+            self._publish(conn)
+            with conn:
+                conn.executemany("INSERT INTO meta (key, value) VALUES (?, ?)",
+                                 [('watermark', high), ('built_at', time.time())])
+            stats = self.stats(conn)
+        finally:
+            conn.close()
+        stats['seconds'] = round(time.perf_counter() - started, 2)
+        logger.info(f"Рекомендации построены: {stats}")
+        return stats
+
+    def refresh(self, rebuild_interval=None):
+        """
+        Добавляет заказы, появившиеся после прошлого обновления, и пересчитывает
+        соседей затронутых товаров. Без построенной матрицы или если она старше
+        rebuild_interval секунд — build(). Возвращает число новых заказов.
+        """
+        conn = self.connect()
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        if 'watermark' not in meta or (rebuild_interval and time.time() - meta['built_at'] > rebuild_interval):
+            conn.close()
+            return self.build()['orders']
+        try:
+            low = meta['watermark'] + 1
+            high = conn.execute("SELECT COALESCE(MAX(id), 0) FROM store.orders").fetchone()[0]
+            if high < low:
+                return 0
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS touched (product_id INTEGER PRIMARY KEY)")
+            with conn:
+                conn.execute("DELETE FROM touched")
+                conn.execute("INSERT OR IGNORE INTO touched SELECT product_id FROM store.order_items "
+                             "WHERE order_id BETWEEN ? AND ?", (low, high))
+                self._add_orders(conn, low, high)
+                self._rank(conn, touched=True)
+                conn.execute("UPDATE meta SET value = ? WHERE key = 'watermark'", (high,))
+            self._publish(conn, touched=True)
+            return high - low + 1
+        finally:
+            conn.close()
+
+    def stats(self, conn):
+        """
+        Размеры матрицы: заказов, товаров, пар, соседей и байт базы.
+        """
+        pairs, products, neighbors = conn.execute("""
+            SELECT (SELECT COUNT(*) FROM product_pairs), (SELECT COUNT(*) FROM product_orders),
+                   (SELECT COUNT(*) FROM neighbors)
+        """).fetchone()
+        watermark = conn.execute("SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        # Размер по страницам базы: часть их может быть ещё только в WAL
+        size = conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+        return {'orders': watermark[0] if watermark else 0, 'products': products, 'pairs': pairs,
+                'neighbors': neighbors, 'bytes': size}
+
+
+def related_products(conn, product_id, user_id=None, limit=4):
+    """
+    Товары, которые покупают вместе с product_id, в наличии. Для вошедшего
+    пользователя пропускаются уже купленные им товары: соседи читаются
+    по первичному ключу product_recommendations, купленные среди них —
+    одним запросом по первичному ключу user_purchases.
+    """
+    rows = conn.execute("""
+        SELECT p.id, p.name, p.description, p.price, p.image_filename
+        FROM product_recommendations r
+        JOIN products p ON p.id = r.neighbor_id
+        WHERE r.product_id = ? AND p.stock_quantity > 0
+        ORDER BY r.rank
+    """, (product_id,)).fetchall()
+    if user_id is not None and rows:
+        ids = [row['id'] for row in rows]
+        bought = {row[0] for row in conn.execute(f"""
+            SELECT product_id FROM user_purchases
+            WHERE user_id = ? AND product_id IN ({','.join(['?'] * len(ids))})
+        """, [user_id, *ids])}
+        rows = [row for row in rows if row['id'] not in bought]
+    return rows[:limit]
+
+
+class RecommendationRefresher:
+    """
+    Фоновый поток, обновляющий рекомендации раз в interval секунд
+    и перестраивающий их раз в rebuild_interval секунд.
+    """
+
+    def __init__(self, recommender, interval=300.0, rebuild_interval=86400.0):
+        self.recommender = recommender
+        self.interval = interval
+        self.rebuild_interval = rebuild_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                added = self.recommender.refresh(self.rebuild_interval)
+                if added:
+                    logger.info(f"Рекомендации обновлены: {added} заказов")
+            except Exception as e:
+                logger.error(f"Ошибка обновления рекомендаций: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='recommendations-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
@@ -0,0 +1,261 @@
+"""
+Резервирование товаров в корзинах (таблица stock_reservations).
+
+Добавляя товар в корзину, покупатель получает резерв на это количество
+на ttl секунд. Доступный остаток — stock_quantity минус активные
+(не истёкшие) резервы других корзин; оформление заказа проверяет
+именно его и снимает резервы покупателя. Истёкшие резервы просто
+не учитываются, а ExpirySweeper периодически удаляет их из таблицы.
+
+Горячие товары (распродажа одной позиции) разгружает StockGate в памяти
+процесса: запросы к одному товару выстраиваются в очередь на его
+блокировке, а не на блокировке записи SQLite, и пока остаток известен
+как исчерпанный — до ближайшего истечения чужого резерва, но не дольше
+recheck секунд — новые попытки отклоняются без обращения к базе.
+Решение о резерве всегда принимает транзакция в базе, поэтому
+несколько процессов не раздадут больше, чем есть на складе.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Число полос блокировок StockGate: товары с одинаковым id по модулю
+# делят блокировку, память не растёт с размером каталога
+LOCK_STRIPES = 64
+
+
+class StockGate:
+    """
+    Блокировки по товарам и отрицательный кэш остатков:
+    {product_id: (доступно, до какого времени верно)}.
+    """
+
+    def __init__(self, recheck=1.0):
+        self.recheck = recheck
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._known = {}
+        self._lock = threading.Lock()
+
+    def lock(self, product_id):
+        return self._locks[product_id % LOCK_STRIPES]
+
+    def known_available(self, product_id):
+        """
+        Доступный остаток из кэша или None, если сведения устарели.
+        """
+        with self._lock:
+            entry = self._known.get(product_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._known[product_id]
+                return None
+            return entry[0]
+
+    def remember(self, product_id, available, next_expiry=None):
+        """
+        Запоминает остаток до next_expiry (ближайшее истечение чужого
+        резерва, после которого он вырастет), но не дольше recheck секунд.
+        """
+        until = time.time() + self.recheck
+        if next_expiry is not None:
+            until = min(until, next_expiry)
+        with self._lock:
+            self._known[product_id] = (available, until)
+
+    def forget(self, product_ids):
+        with self._lock:
+            for product_id in product_ids:
+                self._known.pop(product_id, None)
+
+
+class Reservations:
+    """
+    Резервы корзин: hold() при изменении количества в корзине,
+    release() при удалении, transfer() при входе (корзина гостя
+    переходит пользователю). ttl — время жизни резерва в секундах.
+    """
+
+    def __init__(self, ttl=900.0, recheck=1.0):
+        self.ttl = ttl
+        self.gate = StockGate(recheck)
+        # Счётчики увеличивают потоки запросов: += без блокировки теряет обновления
+        self._stats_lock = threading.Lock()
+        self.granted = 0
+        self.rejected = 0
+        self.absorbed = 0
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def hold(self, conn, owner, product_id, quantity):
+        """
+        Резервирует quantity штук товара за владельцем корзины (заменяя
+        его прежний резерв этого товара) и продлевает срок. Возвращает
+        (успех, доступно для владельца): при отказе резерв не меняется.
+        """
+        if quantity <= 0:
+            self.release(conn, owner, [product_id])
+            return True, None
+
+        # Отказ из памяти: остаток уже известен как недостаточный
+        known = self.gate.known_available(product_id)
+        if known is not None and known < quantity and not self._held(conn, owner, product_id):
+            self._count('absorbed')
+            return False, known
+
+        with self.gate.lock(product_id):
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("""
+                    SELECT p.stock_quantity,
+                           COALESCE(SUM(r.quantity), 0),
+                           MIN(r.expires_at)
+                    FROM products p
+                    LEFT JOIN stock_reservations r
+                        ON r.product_id = p.id AND r.owner != ? AND r.expires_at > ?
+                    WHERE p.id = ?
+                """, (owner, now, product_id)).fetchone()
+                if row[0] is None:
+                    conn.rollback()
+                    return False, 0
+                stock, held_by_others, next_expiry = row
+                available = max(0, stock - held_by_others)
+                if available < quantity:
+                    conn.rollback()
+                    self._count('rejected')
+                    # Без чужих резервов остаток может вырасти только
+                    # от поставки — перепроверка через recheck
+                    self.gate.remember(product_id, available, next_expiry)
+                    return False, available
+                conn.execute("""
+                    INSERT INTO stock_reservations (owner, product_id, quantity, expires_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (owner, product_id) DO UPDATE
+                    SET quantity = excluded.quantity, expires_at = excluded.expires_at
+                """, (owner, product_id, quantity, now + self.ttl))
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        self._count('granted')
+        self.gate.remember(product_id, available - quantity, next_expiry)
+        return True, available
+
+    def _held(self, conn, owner, product_id):
+        # Уменьшение своего резерва не должно отклоняться кэшем
+        return conn.execute("SELECT 1 FROM stock_reservations WHERE owner = ? AND product_id = ? "
+                            "AND expires_at > ?", (owner, product_id, time.time())).fetchone() is not None
+
+    def release(self, conn, owner, product_ids=None):
+        """
+        Снимает резервы владельца (все или только product_ids).
+        """
+        sql, params = "DELETE FROM stock_reservations WHERE owner = ?", [owner]
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            sql += f" AND product_id IN ({','.join(['?'] * len(product_ids))})"
+            params += product_ids
+        with conn:
+            released = [row[0] for row in conn.execute(f"{sql} RETURNING product_id", params).fetchall()]
+        self.gate.forget(released)
+
+    def transfer(self, conn, source, target):
+        """
+        Переносит резервы корзины source на target, складывая количества
+        (как CartStore.merge). Срок — по более позднему из двух.
+        """
+        now = time.time()
+        with conn:
+            conn.execute("""
+                INSERT INTO stock_reservations (owner, product_id, quantity, expires_at)
+                SELECT ?, product_id, quantity, expires_at FROM stock_reservations
+                WHERE owner = ? AND expires_at > ?
+                ON CONFLICT (owner, product_id) DO UPDATE
+                SET quantity = CASE WHEN expires_at > ? THEN quantity ELSE 0 END + excluded.quantity,
+                    expires_at = MAX(expires_at, excluded.expires_at)
+            """, (target, source, now, now))
+            conn.execute("DELETE FROM stock_reservations WHERE owner = ?", (source,))
+
+    def active(self, conn, owner):
+        """
+        Активные резервы владельца: {product_id: (quantity, expires_at)}.
+        """
+        rows = conn.execute("SELECT product_id, quantity, expires_at FROM stock_reservations "
+                            "WHERE owner = ? AND expires_at > ?", (owner, time.time()))
+        return {product_id: (quantity, expires_at) for product_id, quantity, expires_at in rows}
+
+    def stats(self):
+        with self._stats_lock:
+            return {'ttl': self.ttl, 'granted': self.granted, 'rejected': self.rejected, 'absorbed': self.absorbed}
+
+
+def held_by_others(conn, owner, product_ids):
+    """
+    Сколько штук каждого товара зарезервировано чужими активными резервами:
+    {product_id: quantity}. Вызывается внутри транзакции оформления заказа
+    и для остатка на странице товара.
+    """
+    product_ids = list(product_ids)
+    rows = conn.execute(f"""
+        SELECT product_id, SUM(quantity) FROM stock_reservations
+        WHERE product_id IN ({','.join(['?'] * len(product_ids))}) AND owner != ? AND expires_at > ?
+        GROUP BY product_id
+    """, [*product_ids, owner, time.time()])
+    return dict(rows.fetchall())
+
+
+def sweep(conn, batch_size=1000):
+    """
+    Удаляет истёкшие резервы порциями по batch_size (короткие транзакции).
+    Возвращает число удалённых.
+    """
+    removed = 0
+    while True:
+        with conn:
+            count = conn.execute("""
+                DELETE FROM stock_reservations WHERE rowid IN (
+                    SELECT rowid FROM stock_reservations WHERE expires_at <= ? LIMIT ?)
+            """, (time.time(), batch_size)).rowcount
+        removed += count
+        if count < batch_size:
+            return removed
+
+
+class ExpirySweeper:
+    """
+    Фоновый поток, удаляющий истёкшие резервы раз в interval секунд.
+    """
+
+    def __init__(self, pool, interval=60.0):
+        self.pool = pool
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            conn = self.pool.acquire()
+            try:
+                removed = sweep(conn)
+                if removed:
+                    logger.info(f"Удалено истёкших резервов: {removed}")
+            except Exception as e:
+                logger.error(f"Ошибка очистки резервов: {e}")
+            finally:
+                self.pool.release(conn)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='reservations-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
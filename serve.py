@@ -0,0 +1,179 @@
+"""
+Запуск магазина в боевом режиме.
+
+В отличие от `python app.py` (встроенный сервер разработки с отладчиком)
+поднимает несколько процессов-воркеров на общем сокете, каждый из которых
+обслуживает запросы в пуле потоков. Медленный запрос занимает один поток
+одного воркера и не задерживает остальных посетителей.
+
+Отдельный процесс выполняет фоновые задачи (jobs.py) в --job-threads
+потоках; 0 — не запускать его (задачи выполняет `flask jobs work`).
+
+Завершение по SIGTERM/SIGINT — мягкое: воркеры перестают принимать новые
+соединения, дожидаются текущих запросов и задач (не дольше --graceful-timeout)
+и закрывают соединения с базой.
+
+Запуск:
+    python serve.py --workers 4 --port 8000
+
+На Windows (нет fork) запускается один многопоточный процесс.
+Вместо этого скрипта можно использовать любой WSGI-сервер, например:
+    gunicorn --workers 4 --threads 8 --graceful-timeout 30 app:app
+"""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+logger = logging.getLogger('serve')
+
+
+def run_worker(store, sock, graceful_timeout):
+    """
+    Обслуживает запросы на уже открытом сокете до сигнала завершения.
+    store — модуль приложения (app.py).
+    """
+    host, port = sock.getsockname()[:2]
+    # Сокет общий для всех воркеров: о новом соединении узнают все сразу,
+    # а принимает его один. Блокирующий accept() у остальных повис бы
+    # до следующего соединения, неблокирующий просто вернёт ошибку.
+    sock.setblocking(False)
+    server = make_server(host, port, store.app, threaded=True, fd=sock.fileno())
+    # Потоки запросов не демоны: server_close() дождётся их завершения
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def stop(signum, frame):
+        # shutdown() нельзя вызывать из потока serve_forever()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    server.serve_forever()
+    closer = threading.Thread(target=server.server_close, daemon=True)
+    closer.start()
+    closer.join(graceful_timeout)
+    store.password_hasher.shutdown()
+    store.db_pool.close_all()
+    store.replicas.close_all()
+
+
+def run_job_worker(store, sock, graceful_timeout):
+    """
+    Выполняет фоновые задачи до сигнала завершения.
+    Слушающий сокет этому процессу не нужен и закрывается.
+    """
+    sock.close()
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    store.job_worker.start()
+    store.reservation_sweeper.start()
+    store.analytics_refresher.start()
+    store.recommendation_refresher.start()
+    while not stop.wait(1):
+        pass
+    store.recommendation_refresher.stop()
+    store.analytics_refresher.stop()
+    store.reservation_sweeper.stop()
+    store.job_worker.stop(graceful_timeout)
+    store.db_pool.close_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default=os.environ.get('HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)),
+                        help='число процессов-воркеров')
+    parser.add_argument('--graceful-timeout', type=float, default=30.0,
+                        help='сколько секунд ждать текущие запросы при остановке')
+    parser.add_argument('--job-threads', type=int, default=int(os.environ.get('JOB_THREADS', 2)),
+                        help='потоков процесса фоновых задач (0 — без него)')
+    args = parser.parse_args()
+
+    import app as store
+    store.init_db()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    logger.info(f"Магазин доступен на http://{args.host}:{args.port}, воркеров: {args.workers}")
+
+    store.job_worker.threads = args.job_threads
+    if not hasattr(os, 'fork') or (args.workers <= 1 and not args.job_threads):
+        # Один процесс: задачи выполняются потоками рядом с запросами
+        if args.job_threads:
+            store.job_worker.start()
+        store.reservation_sweeper.start()
+        store.analytics_refresher.start()
+        store.recommendation_refresher.start()
+        run_worker(store, sock, args.graceful_timeout)
+        store.recommendation_refresher.stop()
+        store.analytics_refresher.stop()
+        store.reservation_sweeper.stop()
+        store.job_worker.stop(args.graceful_timeout)
+        return
+
+    def spawn(target):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                target()
+            finally:
+                os._exit(0)
+        # Для перезапуска упавшего процесса запоминаем, что он выполнял
+        targets[pid] = target
+        return pid
+
+    targets = {}
+    children = [spawn(lambda: run_worker(store, sock, args.graceful_timeout)) for _ in range(args.workers)]
+    if args.job_threads:
+        children.append(spawn(lambda: run_job_worker(store, sock, args.graceful_timeout)))
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.remove(pid)
+        target = targets.pop(pid)
+        if not stopping:
+            # Воркер упал — заменяем его новым
+            logger.warning(f"Воркер {pid} завершился (статус {status}), перезапуск")
+            time.sleep(0.5)
+            children.append(spawn(target))
+
+    sock.close()
+    logger.info("Сервер остановлен")
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()